@@ -0,0 +1,70 @@
+''' Measure how fast each JSON codec encodes and decodes diagnostics for a large workspace
+
+Builds one publishDiagnostics notification per file, as compileAllRules sends them,
+and times encoding all of them to bytes and decoding the bytes back. Codecs whose
+library is not installed are skipped
+
+Usage: python -m benchmarks.bench_codec
+'''
+import time
+
+from yarals.base import errors as ce
+from yarals.base import protocol as lsp
+from yarals.base.server import get_codec
+
+FILES = 2000
+DIAGNOSTICS_PER_FILE = 20
+ROUNDS = 5
+
+
+def _notifications() -> list:
+    ''' A publishDiagnostics notification for every file in the workspace '''
+    notifications = []
+    for file_no in range(FILES):
+        diagnostics = [
+            lsp.Diagnostic(
+                lsp.Range(lsp.Position(line=line, char=4), lsp.Position(line=line, char=10000)),
+                severity=lsp.DiagnosticSeverity.ERROR if line % 2 else lsp.DiagnosticSeverity.WARNING,
+                message="undefined string \"$s{:d}\"".format(line)
+            )
+            for line in range(DIAGNOSTICS_PER_FILE)
+        ]
+        notifications.append({
+            "jsonrpc": "2.0",
+            "method": "textDocument/publishDiagnostics",
+            "params": {"uri": "file:///workspace/rules/{:04d}.yar".format(file_no), "diagnostics": diagnostics}
+        })
+    return notifications
+
+def _best(func) -> float:
+    ''' Fastest of several runs, in milliseconds '''
+    best = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    ''' Print encode and decode times for every available codec '''
+    notifications = _notifications()
+    expected = None
+    print("{:>8} {:>12} {:>12} {:>12}".format("codec", "bytes", "encode (ms)", "decode (ms)"))
+    for name in ("json", "orjson"):
+        try:
+            codec = get_codec(name)
+        except ce.NoDependencyFound:
+            print("{:>8} {:>12}".format(name, "not installed"))
+            continue
+        encoded = [codec.encode(message) for message in notifications]
+        if expected is None:
+            expected = encoded
+        assert encoded == expected, "{} does not match the output of the other codecs".format(name)
+        encode = _best(lambda: [codec.encode(message) for message in notifications])
+        decode = _best(lambda: [codec.decode(data) for data in encoded])
+        print("{:>8} {:>12d} {:>12.1f} {:>12.1f}".format(name, sum(len(data) for data in encoded), encode, decode))
+
+
+if __name__ == "__main__":
+    main()
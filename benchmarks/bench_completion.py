@@ -0,0 +1,101 @@
+''' Measure how long module completions take to look up and send
+
+Compares the previous lookup, which filtered every key of the parsed schema with
+str.startswith() and built new CompletionItems on every request, with the prefix tree
+in yarals.schema. Also reports the one-off cost of loading the schema, and the time to
+send a response when the items are serialized for every request compared to reusing
+the cached, already serialized result
+
+Usage: python -m benchmarks.bench_completion
+'''
+import asyncio
+import json
+import logging
+import time
+
+from benchmarks.stubs import NullWriter
+from yarals.base import protocol as lsp
+from yarals.schema import SCHEMA, ModuleSchema, get_schema
+from yarals.yarals import YaraLanguageServer
+
+ROUNDS = 2000
+QUERIES = (["pe", ""], ["pe", "is_"], ["pe", "vers"], ["cuckoo"], ["cuckoo", "network", "http"], ["math", "en"])
+
+
+def _legacy(schema: dict, symbols: list, trigger: str=".") -> list:
+    ''' The lookup before the prefix tree, kept here for comparison '''
+    results = []
+    for depth, symbol in enumerate(symbols):
+        if depth < len(symbols) - 1:
+            schema = schema[symbol]
+            continue
+        for term in filter(lambda k: str(k).startswith(symbol), schema):
+            completion_items = schema.get(term, {})
+            if isinstance(completion_items, str):
+                completion_items = {term: completion_items}
+            if isinstance(completion_items, list):
+                for label in completion_items:
+                    snippet = "{}[\"{}\"]".format(term, label)
+                    detail = trigger.join(symbols[:depth] + [snippet])
+                    results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.INTERFACE, detail=detail, insertText=snippet))
+                continue
+            for label, item_type in completion_items.items():
+                item_type = str(item_type).lower()
+                if item_type == "enum":
+                    results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.ENUM, detail=trigger.join(symbols[:depth] + [label])))
+                elif item_type == "property":
+                    results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.PROPERTY, detail=trigger.join(symbols[:depth] + [label])))
+                elif item_type == "function":
+                    snippet = "{}()".format(label)
+                    detail = trigger.join(symbols[:depth] + [snippet])
+                    results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.FUNCTION, insertText=snippet, detail=detail))
+                else:
+                    results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.CLASS, detail=trigger.join(symbols + [label])))
+    return results
+
+def _per_lookup(func, query: list) -> float:
+    ''' Average time of a single lookup, in microseconds '''
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        func(query)
+    return (time.perf_counter() - start) / ROUNDS * 1000000
+
+async def _per_response(get_result, server: YaraLanguageServer, query: list) -> float:
+    ''' Average time to look up and send a single response, in microseconds '''
+    writer = NullWriter()
+    start = time.perf_counter()
+    for msg_id in range(ROUNDS):
+        await server.send_response(msg_id, get_result(query), writer)
+    await server.flush(writer)
+    return (time.perf_counter() - start) / ROUNDS * 1000000
+
+async def _responses():
+    ''' Print the time per response for each query, serializing every time and with cached results '''
+    logging.disable(logging.CRITICAL)
+    server = YaraLanguageServer()
+    print("{:>24} {:>8} {:>16} {:>16}".format("query", "bytes", "encoded (us)", "cached (us)"))
+    for query in QUERIES:
+        encoded = await _per_response(get_schema().complete, server, query)
+        cached = await _per_response(lambda symbols: server._get_completions(".", symbols), server, query)
+        size = len(server._get_completions(".", query).encoded)
+        print("{:>24} {:>8d} {:>16.1f} {:>16.1f}".format(".".join(query), size, encoded, cached))
+
+def main():
+    ''' Print load time, then the time per lookup and per response for each query '''
+    start = time.perf_counter()
+    data = json.loads(SCHEMA.read_text())
+    parsed = time.perf_counter()
+    schema = ModuleSchema(data)
+    built = time.perf_counter()
+    print("read + parse schema: {:.2f} ms, build prefix tree: {:.2f} ms".format((parsed - start) * 1000, (built - parsed) * 1000))
+    print("{:>24} {:>8} {:>12} {:>12}".format("query", "items", "old (us)", "new (us)"))
+    for query in QUERIES:
+        old = _per_lookup(lambda symbols: _legacy(data, symbols), query)
+        new = _per_lookup(schema.complete, query)
+        print("{:>24} {:>8d} {:>12.1f} {:>12.1f}".format(".".join(query), len(schema.complete(query)), old, new))
+    print()
+    asyncio.run(_responses())
+
+
+if __name__ == "__main__":
+    main()
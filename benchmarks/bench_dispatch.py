@@ -0,0 +1,100 @@
+''' Measure hover latency while slow requests for another document are being handled
+
+Slow requests (such as formatting a large file) are simulated with a handler that waits
+in an executor. Running every request one at a time is compared with concurrent dispatch
+
+Usage: python -m benchmarks.bench_dispatch
+'''
+import asyncio
+import json
+import socket
+import statistics
+import time
+
+from yarals.yarals import YaraLanguageServer
+
+SLOW_SECONDS = 0.2
+REQUESTS = 50
+# a slow request is sent ahead of every few hovers, and hovers are sent a few milliseconds apart
+SLOW_EVERY = 10
+HOVER_INTERVAL = 0.01
+RULE = """rule Benchmark_{0:d}
+{{
+    strings:
+        $a = "benchmark string {0:d}"
+    condition:
+        $a and filesize < 100KB
+}}
+"""
+
+
+async def _slow_request(message: dict, has_started: bool, **kwargs):
+    ''' Stand-in for a request that spends a while in a worker '''
+    await asyncio.get_event_loop().run_in_executor(None, time.sleep, SLOW_SECONDS)
+    return []
+
+async def _send(server: YaraLanguageServer, writer: asyncio.StreamWriter, message: dict):
+    ''' Write a message to the server '''
+    await server.write_data(json.dumps(message), writer)
+
+async def _measure(max_tasks: int) -> list:
+    ''' Hover latencies, in seconds, with a slow request mixed in ahead of every few hovers '''
+    server = YaraLanguageServer()
+    server.MAX_CONCURRENT_TASKS = max_tasks
+    server.TASK_TIMEOUT = 60
+    server.SUPERSEDED_METHODS = set()
+    server.request_handlers["textDocument/formatting"] = _slow_request
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+    listener = await asyncio.start_server(server.handle_client, host="localhost", port=port)
+    reader, writer = await asyncio.open_connection("localhost", port)
+    await _send(server, writer, {"jsonrpc": "2.0", "id": 0, "method": "initialize", "params": {"rootUri": None, "capabilities": {}}})
+    await server.read_request(reader)
+    await _send(server, writer, {"jsonrpc": "2.0", "method": "initialized", "params": {}})
+    await server.read_request(reader)
+    text = "\n".join(RULE.format(index) for index in range(100))
+    await _send(server, writer, {"jsonrpc": "2.0", "method": "textDocument/didOpen", "params": {
+        "textDocument": {"uri": "file:///hover.yar", "version": 1, "text": text}
+    }})
+    sent = {}
+    latencies = []
+
+    async def _read_responses():
+        # read responses as they arrive, so the time spent sending doesn't count against them
+        while len(latencies) < REQUESTS:
+            response = await server.read_request(reader)
+            if response.get("id") in sent:
+                latencies.append(time.perf_counter() - sent.pop(response["id"]))
+
+    responses = asyncio.get_event_loop().create_task(_read_responses())
+    for index in range(REQUESTS):
+        msg_id = 2 * index + 1
+        if index % SLOW_EVERY == 0:
+            await _send(server, writer, {"jsonrpc": "2.0", "id": msg_id, "method": "textDocument/formatting", "params": {
+                "textDocument": {"uri": "file:///slow.yar"}, "options": {}
+            }})
+        await asyncio.sleep(HOVER_INTERVAL)
+        sent[msg_id + 1] = time.perf_counter()
+        await _send(server, writer, {"jsonrpc": "2.0", "id": msg_id + 1, "method": "textDocument/hover", "params": {
+            "textDocument": {"uri": "file:///hover.yar"}, "position": {"line": 7 * index + 5, "character": 9}
+        }})
+    await responses
+    writer.close()
+    listener.close()
+    await listener.wait_closed()
+    return latencies
+
+async def main():
+    ''' Print hover latency percentiles for sequential and concurrent dispatch '''
+    print("{:>12} {:>12} {:>12} {:>12}".format("max tasks", "p50 (ms)", "p95 (ms)", "max (ms)"))
+    for max_tasks in (1, YaraLanguageServer.MAX_CONCURRENT_TASKS):
+        latencies = sorted(await _measure(max_tasks))
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print("{:>12d} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            max_tasks, statistics.median(latencies) * 1e3, p95 * 1e3, latencies[-1] * 1e3
+        ))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
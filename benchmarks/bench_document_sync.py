@@ -0,0 +1,69 @@
+''' Measure the per-edit cost of keeping a document in sync with the client
+
+Compares full-document sync (the client sends, and the server parses, the whole buffer
+on every keystroke) with incremental sync (only the changed range is sent and applied)
+
+Usage: python -m benchmarks.bench_document_sync
+'''
+import json
+import random
+import time
+
+from yarals.base.document import TextDocument
+
+RULE = """rule Benchmark_{0:d}
+{{
+    meta:
+        description = "Generated rule {0:d}"
+    strings:
+        $a = "benchmark string {0:d}"
+        $b = {{ E2 34 ?? C8 A? FB }}
+    condition:
+        $a and $b
+}}
+"""
+EDITS = 500
+
+
+def _build_document(num_lines: int) -> str:
+    ''' Build a YARA document with roughly the given number of lines '''
+    per_rule = RULE.count("\n") + 1
+    return "\n".join(RULE.format(index) for index in range(num_lines // per_rule + 1))
+
+def _full_sync(text: str, edits: list) -> float:
+    ''' Seconds per edit when the whole document is sent with every change '''
+    lines = text.split("\n")
+    start = time.perf_counter()
+    for line, char in edits:
+        lines[line] = lines[line][:char] + "x" + lines[line][char:]
+        payload = json.dumps({"contentChanges": [{"text": "\n".join(lines)}]})
+        json.loads(payload)["contentChanges"][0]["text"].split("\n")
+    return (time.perf_counter() - start) / len(edits)
+
+def _incremental_sync(text: str, edits: list) -> float:
+    ''' Seconds per edit when only the changed range is sent with every change '''
+    document = TextDocument("file:///benchmark.yar", text)
+    start = time.perf_counter()
+    for line, char in edits:
+        payload = json.dumps({"contentChanges": [{
+            "range": {"start": {"line": line, "character": char}, "end": {"line": line, "character": char}},
+            "text": "x"
+        }]})
+        document.apply_changes(json.loads(payload)["contentChanges"])
+    return (time.perf_counter() - start) / len(edits)
+
+def main():
+    ''' Print per-edit latency for a range of document sizes '''
+    random.seed(0)
+    print("{:>8} {:>10} {:>16} {:>16}".format("lines", "bytes", "full (us/edit)", "incr (us/edit)"))
+    for num_lines in (1000, 5000, 20000, 100000):
+        text = _build_document(num_lines)
+        total_lines = text.count("\n") + 1
+        edits = [(random.randrange(total_lines), 0) for _ in range(EDITS)]
+        full = _full_sync(text, edits)
+        incremental = _incremental_sync(text, edits)
+        print("{:>8d} {:>10d} {:>16.1f} {:>16.1f}".format(total_lines, len(text), full * 1e6, incremental * 1e6))
+
+
+if __name__ == "__main__":
+    main()
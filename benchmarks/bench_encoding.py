@@ -0,0 +1,77 @@
+''' Measure how fast outgoing messages are serialized into framed bytes
+
+Compares the previous output path (json.dumps with a new encoder per message, formatting
+the frame as text with a character count, and encoding it twice including the debug log)
+with encode_message() and write_data(), for ASCII and non-ASCII payloads
+
+Usage: python -m benchmarks.bench_encoding
+'''
+import asyncio
+import json
+import logging
+import time
+
+from benchmarks.stubs import NullWriter
+from yarals.base import protocol as lsp
+from yarals.base.server import LanguageServer
+
+MESSAGES = 20000
+
+
+def _diagnostics(message: str, count: int) -> dict:
+    ''' publishDiagnostics parameters with the given message repeated '''
+    return {
+        "uri": "file:///rules/test.yar",
+        "diagnostics": [
+            lsp.Diagnostic(
+                lsp.Range(lsp.Position(line=index, char=4), lsp.Position(line=index, char=10000)),
+                severity=lsp.DiagnosticSeverity.ERROR,
+                message=message
+            )
+            for index in range(count)
+        ]
+    }
+
+async def _legacy(server: LanguageServer, params: dict, writer) -> int:
+    ''' The output path before encode_message(), kept here for comparison '''
+    message = json.dumps({"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics", "params": params}, cls=lsp.JSONEncoder)
+    server._logger.debug("output => %r", message.encode(server.ENCODING))
+    data = "Content-Length: {:d}\r\n\r\n{:s}".format(len(message), message).encode(server.ENCODING)
+    writer.write(data)
+    await writer.drain()
+    return len(data)
+
+async def _current(server: LanguageServer, params: dict, writer) -> int:
+    ''' The current output path '''
+    await server.send_notification("textDocument/publishDiagnostics", params, writer)
+    return 0
+
+async def _throughput(send, server: LanguageServer, params: dict) -> float:
+    ''' Messages sent per second '''
+    writer = NullWriter()
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        await send(server, params, writer)
+    await server.flush(writer)
+    return MESSAGES / (time.perf_counter() - start)
+
+async def main():
+    ''' Print messages per second for ASCII and non-ASCII diagnostics '''
+    logging.disable(logging.CRITICAL)
+    server = LanguageServer()
+    payloads = (
+        ("ascii", _diagnostics("undefined string \"$hex_string\"", 10)),
+        ("cyrillic", _diagnostics("неопределённая строка \"$hex_string\" в правиле", 10)),
+        ("cjk", _diagnostics("未定义的字符串 \"$hex_string\" 在规则中", 10)),
+    )
+    print("{:>10} {:>12} {:>12} {:>16} {:>16}".format("payload", "old bytes", "new bytes", "old (msg/s)", "new (msg/s)"))
+    for name, params in payloads:
+        old_size = len(json.dumps({"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics", "params": params}, cls=lsp.JSONEncoder).encode("utf-8"))
+        new_size = len(server.encode_message({"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics", "params": params}))
+        legacy = await _throughput(_legacy, server, params)
+        current = await _throughput(_current, server, params)
+        print("{:>10} {:>12d} {:>12d} {:>16.0f} {:>16.0f}".format(name, old_size, new_size, legacy, current))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+''' Measure how long formatting a large document takes
+
+Compares the previous formatter, which built a new plyara parser and rebuilt every rule of
+the document on each request, with formatting through the server. An already formatted
+document is formatted once, then a single rule is changed and it is formatted again, as
+happens with format-on-save. Changing another rule and formatting just that rule as a
+range is timed too. Along with the time to format, the longest the event loop went
+without running anything else is shown. Skipped if plyara is not installed
+
+Usage: python -m benchmarks.bench_format
+'''
+import asyncio
+import importlib
+import logging
+import time
+
+from yarals.base.document import TextDocument
+from yarals.yarals import YaraLanguageServer
+
+RULES = 10000
+FILE_URI = "file:///workspace/rules/large.yar"
+# seconds between checks that the event loop is still running other tasks
+TICK = 0.001
+
+
+def _document() -> str:
+    ''' A document of unformatted rules, each on a single line '''
+    rules = []
+    for rule_no in range(RULES):
+        rules.append("rule r{:05d} : tag {{ meta: author = \"bench\" strings: $a = \"s{:d}\" nocase condition: $a and filesize < {:d} }}".format(rule_no, rule_no, rule_no))
+    return "\n".join(rules) + "\n"
+
+def _legacy(text: str) -> int:
+    ''' The formatter before the parser was reused and rules were cached, kept here for comparison '''
+    plyara = importlib.import_module("plyara")
+    plyara_utils = importlib.import_module("plyara.utils")
+    parser = plyara.Plyara(store_raw_sections=True)
+    edits = 0
+    for rule in parser.parse_string(text):
+        if rule.get("imports"):
+            del rule["imports"]
+        plyara_utils.rebuild_yara_rule(rule).rstrip("\n").expandtabs(4)
+        edits += 1
+    return edits
+
+async def _format(server: YaraLanguageServer, document: TextDocument) -> list:
+    ''' Format an open document through the server '''
+    message = {"params": {"textDocument": {"uri": FILE_URI}, "options": {"tabSize": 4, "insertSpaces": True}}}
+    return await server.provide_formatting(message, True, dirty_files={FILE_URI: document})
+
+async def _format_range(server: YaraLanguageServer, document: TextDocument, line: int) -> list:
+    ''' Format the rules on a line of an open document through the server '''
+    message = {"params": {
+        "textDocument": {"uri": FILE_URI}, "options": {"tabSize": 4, "insertSpaces": True},
+        "range": {"start": {"line": line, "character": 0}, "end": {"line": line, "character": 0}}
+    }}
+    return await server.provide_range_formatting(message, True, dirty_files={FILE_URI: document})
+
+def _timed(func, *args) -> tuple:
+    ''' Result of a call, and how long it took in milliseconds '''
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+async def _stalled(coroutine) -> tuple:
+    ''' Result of a coroutine, and the longest the event loop was blocked while it ran, in milliseconds '''
+    task = asyncio.ensure_future(coroutine)
+    longest = 0.0
+    while not task.done():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        longest = max(longest, time.perf_counter() - start - TICK)
+    return task.result(), longest * 1000
+
+def main():
+    ''' Print the time to format the document each way '''
+    try:
+        importlib.import_module("plyara")
+    except ImportError:
+        print("plyara is not installed")
+        return
+    logging.disable(logging.CRITICAL)
+    loop = asyncio.new_event_loop()
+    # every rule is on a single line, so the edits are the formatted document
+    edits = loop.run_until_complete(_format(YaraLanguageServer(), TextDocument(FILE_URI, _document())))
+    document = TextDocument(FILE_URI, "\n".join(edit.newText for edit in edits) + "\n")
+    server = YaraLanguageServer()
+    print("{:>28} {:>8} {:>12} {:>12}".format("formatter", "edits", "time (ms)", "stall (ms)"))
+    edits, elapsed = _timed(_legacy, str(document))
+    # the previous formatter ran on the event loop, so it blocked it the whole time
+    print("{:>28} {:>8d} {:>12.1f} {:>12.1f}".format("previous", edits, elapsed, elapsed))
+    (edits, stall), elapsed = _timed(loop.run_until_complete, _stalled(_format(server, document)))
+    print("{:>28} {:>8d} {:>12.1f} {:>12.1f}".format("first format", len(edits), elapsed, stall))
+    # squash the end of a rule onto one line, as a client would send it in a didChange notification
+    line = document.lines.index("        $a and filesize < {:d}".format(RULES // 2))
+    document.apply_change({
+        "range": {"start": {"line": line, "character": 0}, "end": {"line": line + 1, "character": 1}},
+        "text": "        $a and filesize < 0 }"
+    })
+    edits, elapsed = _timed(_legacy, str(document))
+    print("{:>28} {:>8d} {:>12.1f} {:>12.1f}".format("previous, one rule changed", edits, elapsed, elapsed))
+    (edits, stall), elapsed = _timed(loop.run_until_complete, _stalled(_format(server, document)))
+    print("{:>28} {:>8d} {:>12.1f} {:>12.1f}".format("one rule changed", len(edits), elapsed, stall))
+    # and another rule, which is then formatted on its own
+    line = document.lines.index("        $a and filesize < {:d}".format(RULES // 4))
+    document.apply_change({
+        "range": {"start": {"line": line, "character": 0}, "end": {"line": line + 1, "character": 1}},
+        "text": "        $a and filesize < 0 }"
+    })
+    (edits, stall), elapsed = _timed(loop.run_until_complete, _stalled(_format_range(server, document, line)))
+    print("{:>28} {:>8d} {:>12.1f} {:>12.1f}".format("range, one rule changed", len(edits), elapsed, stall))
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
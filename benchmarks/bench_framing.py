@@ -0,0 +1,68 @@
+''' Measure how many framed messages per second can be read from a client stream
+
+Compares the line-based reader that used to parse every message (readline, readuntil,
+readexactly, decode, loads) with the buffered FrameParser behind read_request()
+
+Usage: python -m benchmarks.bench_framing
+'''
+import asyncio
+import json
+import logging
+import time
+
+from yarals.base.server import LanguageServer
+
+MESSAGES = 20000
+
+
+async def _legacy_read_request(reader: asyncio.StreamReader) -> dict:
+    ''' The reader used before FrameParser, kept here for comparison '''
+    request = {}
+    data = await reader.readline()
+    if data:
+        key, value = tuple(data.decode("utf-8").strip().split(" "))
+        await reader.readuntil(separator=b"\r\n")
+        if key == "Content-Length:":
+            data = await reader.readexactly(int(value))
+        else:
+            data = await reader.readline()
+        request = json.loads(data.decode("utf-8"))
+    return request
+
+def _stream(payload: bytes, count: int) -> asyncio.StreamReader:
+    ''' A stream with every message already buffered, as if pipelined by the client '''
+    reader = asyncio.StreamReader(limit=2**30)
+    frame = "Content-Length: {:d}\r\n\r\n".format(len(payload)).encode("utf-8") + payload
+    reader.feed_data(frame * count)
+    reader.feed_eof()
+    return reader
+
+async def _throughput(read, payload: bytes, count: int) -> float:
+    ''' Messages read per second '''
+    reader = _stream(payload, count)
+    start = time.perf_counter()
+    for _ in range(count):
+        await read(reader)
+    return count / (time.perf_counter() - start)
+
+async def main():
+    ''' Print messages per second for small and large messages '''
+    logging.disable(logging.CRITICAL)
+    server = LanguageServer()
+    hover = json.dumps({
+        "jsonrpc": "2.0", "id": 1, "method": "textDocument/hover",
+        "params": {"textDocument": {"uri": "file:///rules/test.yar"}, "position": {"line": 10, "character": 4}}
+    }).encode("utf-8")
+    change = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didChange",
+        "params": {"textDocument": {"uri": "file:///rules/test.yar", "version": 2}, "contentChanges": [{"text": "x" * 65536}]}
+    }).encode("utf-8")
+    print("{:>10} {:>10} {:>16} {:>16}".format("message", "bytes", "legacy (msg/s)", "framed (msg/s)"))
+    for name, payload, count in (("hover", hover, MESSAGES), ("didChange", change, MESSAGES // 20)):
+        legacy = await _throughput(_legacy_read_request, payload, count)
+        framed = await _throughput(server.read_request, payload, count)
+        print("{:>10} {:>10d} {:>16.0f} {:>16.0f}".format(name, len(payload), legacy, framed))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+''' Measure the memory and time taken to build and serialize protocol objects
+
+Builds 100k Locations (each with a Range and two Positions), then serializes them with
+lsp.JSONEncoder, the way a large references or definition response would be
+
+Usage: python -m benchmarks.bench_protocol
+'''
+import gc
+import json
+import time
+import tracemalloc
+
+from yarals.base import protocol as lsp
+
+LOCATIONS = 100000
+
+
+def _build() -> list:
+    ''' Create the Locations to serialize '''
+    return [
+        lsp.Location(
+            lsp.Range(lsp.Position(line=index, char=4), lsp.Position(line=index, char=16)),
+            "file:///rules/test_{:d}.yar".format(index % 100)
+        )
+        for index in range(LOCATIONS)
+    ]
+
+def main():
+    ''' Print the memory used by the objects, and the time to build and serialize them '''
+    gc.collect()
+    tracemalloc.start()
+    locations = _build()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del locations
+    gc.collect()
+    # time without tracing, which slows down every allocation
+    start = time.perf_counter()
+    locations = _build()
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    json.dumps(locations, cls=lsp.JSONEncoder)
+    encode_time = time.perf_counter() - start
+    print("{:>10} {:>14} {:>12} {:>12}".format("locations", "memory (MiB)", "build (ms)", "encode (ms)"))
+    print("{:>10d} {:>14.1f} {:>12.1f} {:>12.1f}".format(LOCATIONS, memory / 2**20, build_time * 1e3, encode_time * 1e3))
+
+
+if __name__ == "__main__":
+    main()
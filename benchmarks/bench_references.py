@@ -0,0 +1,102 @@
+''' Measure how long finding the references to a rule takes in a large document
+
+Compares the previous search, which built the pattern for every request and ran it over
+each line of the document separately, a single search over the whole text, and looking
+the rule up in the identifiers the rule index records for each rule through the server.
+The first lookup, which scans every rule, is timed separately from later ones. A rule
+referred to all over a 50,000-line document and one that is only declared are looked up
+
+Usage: python -m benchmarks.bench_references
+'''
+import asyncio
+from bisect import bisect_right
+import logging
+import re
+import time
+
+from yarals import helpers
+from yarals.base import protocol as lsp
+from yarals.base.document import TextDocument
+from yarals.yarals import YaraLanguageServer
+
+LINES = 50000
+ROUNDS = 20
+FILE_URI = "file:///workspace/rules/references.yar"
+
+
+def _document() -> TextDocument:
+    ''' A 50,000-line document where every rule after the first refers to it '''
+    rules = ["rule Base\n{\n    condition:\n        filesize < 100\n}"]
+    while len(rules) * 7 < LINES:
+        rules.append("rule Uses{0:05d}\n{{\n    strings:\n        $a{0:d} = \"s{0:d}\"\n    condition:\n        Base and $a{0:d}\n}}".format(len(rules)))
+    return TextDocument(FILE_URI, "\n\n".join(rules) + "\n")
+
+def _legacy(document: TextDocument, symbol: str) -> list:
+    ''' The search before patterns were cached and run over the whole text, kept here for comparison '''
+    results = []
+    pattern = "{}\\b".format(symbol.replace("*", ".*?").strip("()"))
+    for index, line in enumerate(document.lines):
+        for match in re.finditer(pattern, line):
+            locrange = lsp.Range(
+                start=lsp.Position(line=index, char=match.start()),
+                end=lsp.Position(line=index, char=match.end())
+            )
+            results.append(lsp.Location(locrange, FILE_URI))
+    return results
+
+def _search(document: TextDocument, symbol: str) -> list:
+    ''' A single search over the whole text, as done before identifiers were indexed '''
+    results = []
+    line_starts = document.line_starts
+    for match in helpers.symbol_pattern("rule", symbol).finditer(document.text):
+        line = bisect_right(line_starts, match.start()) - 1
+        char = match.start() - line_starts[line]
+        locrange = lsp.Range(
+            start=lsp.Position(line=line, char=char),
+            end=lsp.Position(line=line, char=char + match.end() - match.start())
+        )
+        results.append(lsp.Location(locrange, FILE_URI))
+    return results
+
+def _timed(func) -> tuple:
+    ''' Result of a call, and how long it took in milliseconds '''
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - start) * 1000
+
+def _best(func) -> tuple:
+    ''' Result of the fastest of several runs, and how long it took in milliseconds '''
+    best = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        result = func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def main():
+    ''' Print the time to find every reference to a rule each way '''
+    logging.disable(logging.CRITICAL)
+    document = _document()
+    server = YaraLanguageServer()
+    loop = asyncio.new_event_loop()
+    print("{:>10} {:>10} {:>8} {:>12}".format("rule", "search", "matches", "time (ms)"))
+    # a rule referred to all over the document, then one that is only declared
+    for symbol in ("Base", "Uses03000"):
+        line = document.lines.index("rule {}".format(symbol))
+        message = {"params": {"textDocument": {"uri": FILE_URI}, "position": {"line": line, "character": 6}}}
+        previous, elapsed = _best(lambda: _legacy(document, symbol))
+        print("{:>10} {:>10} {:>8d} {:>12.3f}".format(symbol, "previous", len(previous), elapsed))
+        searched, elapsed = _best(lambda: _search(document, symbol))
+        print("{:>10} {:>10} {:>8d} {:>12.3f}".format(symbol, "search", len(searched), elapsed))
+        lookup = lambda: loop.run_until_complete(server.provide_reference(message, True, dirty_files={FILE_URI: document}))
+        first, elapsed = _timed(lookup)
+        print("{:>10} {:>10} {:>8d} {:>12.3f}".format(symbol, "first", len(first), elapsed))
+        current, elapsed = _best(lookup)
+        print("{:>10} {:>10} {:>8d} {:>12.3f}".format(symbol, "indexed", len(current), elapsed))
+        assert [loc.range for loc in current] == [loc.range for loc in first] == [loc.range for loc in searched] == [loc.range for loc in previous]
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+''' Measure how long a freshly launched server takes to answer its first request
+
+Starts run_server as a client would, over TCP (polling the port until it accepts a connection)
+and over stdio, and times everything from launching the process to reading the reply to
+"initialize". An interpreter that does nothing is timed too, since it is a fixed cost of both
+
+Usage: python -m benchmarks.bench_startup
+'''
+import json
+from pathlib import Path
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROUNDS = 10
+HOST = "127.0.0.1"
+INITIALIZE = json.loads(Path(__file__).parent.parent.joinpath("tests", "initialize_msg.json").read_text())
+
+
+def _frame(message: dict) -> bytes:
+    ''' Frame a message the way a client sends it '''
+    body = json.dumps(message).encode("utf-8")
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+def _read_reply(stream) -> dict:
+    ''' Read one framed message from a file-like object '''
+    length = None
+    while True:
+        line = stream.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    return json.loads(stream.read(length))
+
+def _free_port() -> int:
+    ''' A port nothing is listening on right now '''
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+def _nothing(log: str) -> float:
+    ''' Launch an interpreter that exits straight away '''
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - start
+
+def _stdio(log: str) -> float:
+    ''' Launch the server on stdio and wait for its reply to "initialize" '''
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "yarals.run_server", "--stdio", "--log", log],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    proc.stdin.write(_frame(INITIALIZE))
+    proc.stdin.flush()
+    assert "capabilities" in _read_reply(proc.stdout)["result"]
+    elapsed = time.perf_counter() - start
+    proc.stdin.close()
+    proc.wait()
+    return elapsed
+
+def _tcp(log: str) -> float:
+    ''' Launch the server on a port, connect once it is listening and wait for its reply to "initialize" '''
+    port = _free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "yarals.run_server", HOST, str(port), "--log", log],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    while True:
+        try:
+            sock = socket.create_connection((HOST, port))
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.001)
+    with sock, sock.makefile("rb") as stream:
+        sock.sendall(_frame(INITIALIZE))
+        assert "capabilities" in _read_reply(stream)["result"]
+        elapsed = time.perf_counter() - start
+    proc.terminate()
+    proc.wait()
+    return elapsed
+
+def main():
+    ''' Print the median time to the first reply for each transport '''
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log = str(Path(tmpdir).joinpath("yara.log"))
+        print("{:>12} {:>14}".format("transport", "median (ms)"))
+        for name, launch in (("interpreter", _nothing), ("tcp", _tcp), ("stdio", _stdio)):
+            times = [launch(log) for _ in range(ROUNDS)]
+            print("{:>12} {:>14.1f}".format(name, statistics.median(times) * 1000))
+
+
+if __name__ == "__main__":
+    main()
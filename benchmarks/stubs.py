@@ -0,0 +1,16 @@
+''' Stand-ins shared by the benchmarks, so only the code being measured does any work '''
+
+
+class NullWriter():
+    ''' Stand-in for a StreamWriter that discards everything written to it '''
+    def is_closing(self) -> bool:
+        return False
+
+    def write(self, data: bytes):
+        pass
+
+    def writelines(self, frames: list):
+        pass
+
+    async def drain(self):
+        pass
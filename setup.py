@@ -29,6 +29,7 @@ setup(
     description=DESCRIPTION,
     download_url="https://github.com/ch0mler/yara-language-server",
     entry_points=entry_points,
+    extras_require={"orjson": ["orjson>=3.0"]},
     license='Apache 2.0',
     long_description=long_description,
     long_description_content_type="text/markdown",
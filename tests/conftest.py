@@ -15,10 +15,29 @@ def pytest_configure(config):
     config.addinivalue_line("markers", "integration: Run integration tests that require setting up a networked server instance")
     config.addinivalue_line("markers", "command: Run executeCommand integration tests")
     config.addinivalue_line("markers", "config: Run config unittests")
+    config.addinivalue_line("markers", "document: Run text document model unittests")
     config.addinivalue_line("markers", "helpers: Run helper function unittests")
+    config.addinivalue_line("markers", "index: Run rule index unittests")
     config.addinivalue_line("markers", "protocol: Run language server protocol unittests")
+    config.addinivalue_line("markers", "session: Run client session unittests")
     config.addinivalue_line("markers", "transport: Run network transport unittests")
 
+class RecordingWriter():
+    ''' Stand-in for a StreamWriter that records each batch written to it and can hold up drains '''
+    def __init__(self):
+        self.batches = []
+        self.can_drain = asyncio.Event()
+        self.can_drain.set()
+
+    def is_closing(self) -> bool:
+        return False
+
+    def writelines(self, frames: list):
+        self.batches.append(list(frames))
+
+    async def drain(self):
+        await self.can_drain.wait()
+
 @pytest.fixture
 def event_loop():
     ''' force asyncio to use this event loop regardless of OS
@@ -34,6 +53,11 @@ def yara_server():
     ''' Generate an instance of the YARA language server '''
     return yarals.YaraLanguageServer()
 
+@pytest.fixture(scope="function")
+def stream_writer():
+    ''' Stand-in for the StreamWriter of a connected client '''
+    return RecordingWriter()
+
 @pytest.fixture(scope="function")
 async def open_streams(unused_tcp_port, yara_server):
     ''' Set up a local asyncio network server
@@ -1,5 +1,7 @@
 ''' Command Tests '''
+import asyncio
 import json
+import logging
 import sys
 from textwrap import dedent
 
@@ -122,6 +124,14 @@ async def test_cmd_compile_all_rules_no_workspace(initialize_msg, initialized_ms
     assert len(notifications[0]["diagnostics"]) == 1
     assert notifications[0]["diagnostics"][0]["message"] == expected_msg
 
+@pytest.mark.asyncio
+async def test_cmd_without_result(yara_server):
+    ''' Ensure commands that don't run, or aren't known, still get an empty response '''
+    message = {"params": {"command": "yara.CompileAllRules", "arguments": []}}
+    assert await yara_server.execute_command(message, False) == {"result": None}
+    message = {"params": {"command": "yara.Unknown", "arguments": []}}
+    assert await yara_server.execute_command(message, True) == {"result": None}
+
 @pytest.mark.asyncio
 async def test__compile_all_rules_no_dirty_files(test_rules, yara_server):
     ''' Ensure the _compile_all_rules function returns the appropriate number of diagnostics when no workspace files are dirty '''
@@ -244,3 +254,39 @@ async def test__compile_all_rules_with_dirty_files(test_rules, yara_server):
     assert len(results) == len(expected), "Mismatched number of results. Got {:d} but expected {:d}".format(len(results), len(expected))
     print(json.dumps(results, cls=protocol.JSONEncoder))
     assert all(result in expected for result in results)
+
+@pytest.mark.asyncio
+async def test__compile_all_rules_workers(test_rules, yara_server):
+    ''' Ensure the _compile_all_rules function returns the same diagnostics regardless of the number of worker processes '''
+    single = await yara_server._compile_all_rules({}, workspace=test_rules, workers=1)
+    yara_server.diagnostic_cache.clear()
+    multiple = await yara_server._compile_all_rules({}, workspace=test_rules, workers=2)
+    assert sorted(yara_server._compile_pools) == [1, 2]
+    assert len(single) == len(multiple)
+    assert all(result in multiple for result in single)
+
+@pytest.mark.asyncio
+async def test__compile_all_rules_while_compiling(test_rules, yara_server):
+    ''' Ensure compiling a document with a different number of workers doesn't stop _compile_all_rules '''
+    yara_server.COMPILE_WORKERS = 1
+    expected = await yara_server._compile_all_rules({}, workspace=test_rules, workers=2)
+    yara_server.diagnostic_cache.clear()
+    results, diagnostics = await asyncio.gather(
+        yara_server._compile_all_rules({}, workspace=test_rules, workers=3),
+        yara_server.provide_diagnostic("rule WhileCompiling { condition: $true }")
+    )
+    assert len(diagnostics) == 1
+    assert len(results) == len(expected)
+    assert sorted(yara_server._compile_pools) == [1, 2, 3]
+
+@pytest.mark.asyncio
+async def test__compile_all_rules_timeout(caplog, yara_server):
+    ''' Ensure a compile that times out is reported as such, rather than as a file that couldn't be read '''
+    async def _timeout(*args):
+        raise asyncio.TimeoutError()
+    yara_server._run_compile = _timeout
+    with caplog.at_level(logging.WARNING, "yara"):
+        results = await yara_server._compile_all_rules({"file:///slow.yar": "rule Slow { condition: true }"})
+    assert results == []
+    message = "Compiling file:///slow.yar took longer than {} seconds".format(yara_server.COMPILE_TIMEOUT)
+    assert ("yara", logging.WARNING, message) in caplog.record_tuples
@@ -2,6 +2,7 @@
 
 import pytest
 from yarals import helpers
+from yarals import schema
 from yarals.base import protocol
 
 # don't care about pylint(protected-access) warnings since these are just tests
@@ -99,3 +100,38 @@ async def test_code_completion_module_function(test_rules, yara_server):
     result = await yara_server.provide_code_completion(message, True)
     assert len(result) == len(expected)
     assert result == expected
+
+def test_code_completion_schema():
+    ''' Ensure the module schema matches prefixes and names nested members by their full path '''
+    module_schema = schema.get_schema()
+    actual = module_schema.complete(["pe", "is_"])
+    assert [item.label for item in actual] == ["is_dll", "is_32bit", "is_64bit"]
+    assert actual[0].detail == "pe.is_dll()"
+    expected = [
+        protocol.CompletionItem("size", protocol.CompletionItemKind.PROPERTY, detail="pe.data_directories.size"),
+        protocol.CompletionItem("virtual_address", protocol.CompletionItemKind.PROPERTY, detail="pe.data_directories.virtual_address")
+    ]
+    assert module_schema.complete(["pe", "data_dir"]) == expected
+    assert module_schema.complete(["p"]) == module_schema.complete(["pe"])
+    # unknown modules and members without members of their own have nothing to complete
+    assert module_schema.complete(["unknown", ""]) == []
+    assert module_schema.complete(["pe", "is_dll", ""]) == []
+
+@pytest.mark.asyncio
+async def test_code_completion_cached(stream_writer, test_rules, yara_server):
+    ''' Ensure repeated completions reuse the serialized result, which is sent exactly as if it was encoded again '''
+    code_completion = str(test_rules.joinpath("code_completion.yara").resolve())
+    message = {
+        "params": {
+            "textDocument": {"uri": helpers.create_file_uri(code_completion)},
+            "position": {"line": 18, "character": 15}
+        }
+    }
+    first = await yara_server.provide_code_completion(message, True)
+    second = await yara_server.provide_code_completion(message, True)
+    assert second is first
+    assert len(first) == 10
+    await yara_server.send_response(7, first, stream_writer)
+    await yara_server.flush(stream_writer)
+    expected = yara_server.encode_message({"jsonrpc": "2.0", "id": 7, "result": list(first)})
+    assert stream_writer.batches[-1][-1] == expected
@@ -1,4 +1,5 @@
 ''' Tests for yarals configuration reactions '''
+import asyncio
 import json
 import logging
 import sys
@@ -68,3 +69,36 @@ async def test_compile_on_save_true(caplog, init_server, open_streams, test_rule
         assert ("yara", logging.DEBUG, "Changed workspace config to {}".format(json.dumps(new_config))) in caplog.record_tuples
     writer.close()
     await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.config
+@pytest.mark.integration
+async def test_compile_on_change(init_server, open_streams, yara_server):
+    ''' Ensure a burst of changes is compiled once, after the configured delay, when 'compile_on_change' set to true '''
+    file_uri = "file:///compile_on_change.yar"
+    change_config_msg = json.dumps({
+        "jsonrpc":"2.0", "method": "workspace/didChangeConfiguration",
+        "params": {"settings": {"yara": {"compile_on_change": True, "compile_on_change_delay": 50}}}
+    })
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    await yara_server.write_data(change_config_msg, writer)
+    for version, condition in enumerate(["true", "$a", "$b", "$true"]):
+        did_change = {
+            "jsonrpc":"2.0", "method": "textDocument/didChange",
+            "params": {
+                "textDocument": {"uri": file_uri, "version": version},
+                "contentChanges": [{"text": "rule OnChange {{ condition: {} }}".format(condition)}]
+            }
+        }
+        await yara_server.write_data(json.dumps(did_change), writer)
+    response = await yara_server.read_request(reader)
+    assert response["method"] == "textDocument/publishDiagnostics"
+    assert response["params"]["uri"] == file_uri
+    assert len(response["params"]["diagnostics"]) == 1
+    assert response["params"]["diagnostics"][0]["message"] == "undefined string \"$true\""
+    # superseded versions never publish their diagnostics
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(yara_server.read_request(reader), 0.5)
+    writer.close()
+    await writer.wait_closed()
@@ -142,3 +142,26 @@ async def test_no_definitions(test_rules, yara_server):
     }
     result = await yara_server.provide_definition(message, True)
     assert result == []
+
+@pytest.mark.asyncio
+async def test_definitions_workspace_rules(tmp_path, yara_server):
+    ''' Ensure definition is provided for a rule declared in another workspace file '''
+    private_rules = tmp_path.joinpath("private.yar")
+    private_rules.write_text("private rule shared_private_rule\n{\n    condition:\n        true\n}\n")
+    public_rules = tmp_path.joinpath("public.yar")
+    public_rules.write_text("include \"private.yar\"\n\nrule uses_shared_rule\n{\n    condition:\n        shared_private_rule\n}\n")
+    await yara_server._open_workspace(yara_server.session, tmp_path).indexing
+    message = {
+        "params": {
+            "textDocument": {"uri": helpers.create_file_uri(str(public_rules))},
+            "position": {"line": 5, "character": 12}
+        }
+    }
+    result = await yara_server.provide_definition(message, True)
+    assert len(result) == 1
+    assert result[0].uri == helpers.create_file_uri(str(private_rules))
+    assert result[0].range == protocol.Range(protocol.Position(line=0, char=13), protocol.Position(line=0, char=32))
+    # deleting the file removes its rules from the workspace
+    watched_files = {"params": {"changes": [{"uri": result[0].uri, "type": protocol.FileChangeType.DELETED}]}}
+    await yara_server.event_did_change_watched_files(True, message=watched_files, dirty_files={})
+    assert await yara_server.provide_definition(message, True) == []
@@ -1,6 +1,9 @@
 ''' Diagnostic Tests '''
+import asyncio
+import time
+
 import pytest
-from yarals import helpers
+from yarals import compiler
 from yarals.base import protocol
 from yarals.base import errors as ce
 
@@ -38,3 +41,138 @@ async def test_diagnostics_notify_user(uninstall_pkg, yara_server):
     with pytest.raises(ce.NoDependencyFound) as excinfo:
         await yara_server.provide_diagnostic(document)
     assert expected_msg == str(excinfo.value)
+
+@pytest.mark.asyncio
+async def test_diagnostics_superseded(yara_server):
+    ''' Ensure a newer compile of the same document cancels any compile still in progress '''
+    file_uri = "file:///superseded.yar"
+    stale = "rule StaleDiagnostic { condition: $true }"
+    latest = "rule LatestDiagnostic { condition: true }"
+    results = await asyncio.gather(
+        yara_server.provide_diagnostic(stale, file_uri=file_uri),
+        yara_server.provide_diagnostic(latest, file_uri=file_uri)
+    )
+    assert results == [None, []]
+    assert file_uri not in yara_server.session.compiles
+
+@pytest.mark.asyncio
+async def test_diagnostics_timeout(yara_server):
+    ''' Ensure a compile that takes too long is abandoned with a DiagnosticError '''
+    yara_server.COMPILE_TIMEOUT = 0
+    document = "rule TimeoutDiagnostic { condition: true }"
+    with pytest.raises(ce.DiagnosticError) as excinfo:
+        await yara_server.provide_diagnostic(document)
+    assert "timed out" in str(excinfo.value)
+
+@pytest.mark.asyncio
+async def test_diagnostics_timeout_stops_worker(yara_server):
+    ''' Ensure a compile that never finishes is stopped, so later compiles still get a worker '''
+    yara_server.COMPILE_WORKERS = 2
+    yara_server.COMPILE_TIMEOUT = 2
+    runaway = asyncio.ensure_future(yara_server._run_compile(2, time.sleep, 60))
+    await asyncio.sleep(1)
+    stopped = yara_server._compile_pools[2]
+    # still running when the pool is stopped, so it is run again in the new pool
+    running = asyncio.ensure_future(yara_server._run_compile(2, time.sleep, 1.5))
+    with pytest.raises(asyncio.TimeoutError):
+        await runaway
+    assert yara_server._compile_pools.get(2) is not stopped
+    assert await running is None
+    assert len(await yara_server.provide_diagnostic("rule AfterTimeout { condition: $true }")) == 1
+
+@pytest.mark.asyncio
+async def test_diagnostics_cached(yara_server):
+    ''' Ensure unchanged documents are only compiled once '''
+    document = "rule CachedDiagnostic { condition: $true }"
+    first = await yara_server.provide_diagnostic(document)
+    second = await yara_server.provide_diagnostic(document)
+    assert first == second
+    assert yara_server.diagnostic_cache.misses == 1
+    assert yara_server.diagnostic_cache.hits == 1
+    await yara_server.provide_diagnostic(document + "\n")
+    assert yara_server.diagnostic_cache.misses == 2
+
+def test_diagnostic_cache_bounds():
+    ''' Ensure the diagnostic cache evicts its least recently used entries once either bound is reached '''
+    diagnostic = protocol.Diagnostic(
+        protocol.Range(protocol.Position(line=0, char=0), protocol.Position(line=0, char=10)),
+        severity=protocol.DiagnosticSeverity.ERROR, message="x" * 100
+    )
+    cache = compiler.DiagnosticCache(max_entries=2)
+    keys = [cache.key("rule Cache{:d} {{ condition: true }}".format(index)) for index in range(3)]
+    cache.put(keys[0], [])
+    cache.put(keys[1], [])
+    assert cache.get(keys[0]) == []
+    cache.put(keys[2], [])
+    assert len(cache) == 2
+    assert cache.get(keys[1]) is None
+    assert cache.key("rule A { condition: true }", {"ext": 1}) != cache.key("rule A { condition: true }")
+    assert cache.key("rule A { condition: true }", {"ext": 1}) != cache.key("rule A { condition: true }", {"ext": 2})
+    assert cache.key("rule A { condition: true }", mode="rules") != cache.key("rule A { condition: true }")
+    cache = compiler.DiagnosticCache(max_bytes=500)
+    cache.put(keys[0], [diagnostic])
+    cache.put(keys[1], [diagnostic])
+    assert len(cache) == 1
+    assert cache.size <= cache.max_bytes
+    assert cache.get(keys[1]) == [diagnostic]
+
+@pytest.mark.asyncio
+async def test_diagnostics_includes_not_cached(tmp_path, yara_server):
+    ''' Ensure documents including other files are compiled again, in case the included files changed '''
+    included = tmp_path.joinpath("included.yar")
+    included.write_text("rule Included { condition: true }\n")
+    document = "include \"{}\"\nrule Including {{ condition: Included }}\n".format(included.as_posix())
+    assert await yara_server.provide_diagnostic(document) == []
+    # the rule the document refers to is renamed
+    included.write_text("rule Renamed { condition: true }\n")
+    assert len(await yara_server.provide_diagnostic(document)) == 1
+    assert len(yara_server.diagnostic_cache) == 0
+    results = await yara_server._compile_all_rules({"file:///including.yar": document})
+    assert len(results) == 1
+
+@pytest.mark.asyncio
+async def test_diagnostics_per_rule(yara_server):
+    ''' Ensure every broken rule is reported, at its own line, when rules are compiled one at a time '''
+    document = "\n".join([
+        "import \"pe\"",
+        "rule Valid { condition: pe.is_dll() }",
+        "rule Referencing",
+        "{",
+        "    condition:",
+        "        Valid and $missing",
+        "}",
+        "rule Valid { condition: true }",
+        "rule Unknown { condition: Undefined }"
+    ])
+    result = await yara_server.provide_diagnostic(document, per_rule=True)
+    assert [(diagnostic.range.start.line, diagnostic.message) for diagnostic in result] == [
+        # YARA reports undefined strings at the end of the rule
+        (6, "undefined string \"$missing\""),
+        (7, "duplicated identifier \"Valid\""),
+        (8, "undefined identifier \"Undefined\"")
+    ]
+    assert result[2].range.start.char == 0
+    # compiling the whole document only reports one error
+    assert len(await yara_server.provide_diagnostic(document)) == 1
+
+@pytest.mark.asyncio
+async def test_diagnostics_per_rule_forward_reference(yara_server):
+    ''' Ensure rules referenced before they are declared are reported, as they are when compiling the whole document '''
+    document = "rule Early { condition: Late }\nrule Late { condition: true }"
+    result = await yara_server.provide_diagnostic(document, per_rule=True)
+    assert [(diagnostic.range.start.line, diagnostic.message) for diagnostic in result] == [(0, "undefined identifier \"Late\"")]
+    assert len(await yara_server.provide_diagnostic(document)) == 1
+
+@pytest.mark.asyncio
+async def test_diagnostics_per_rule_directives(yara_server):
+    ''' Ensure problems with imports and includes between rules are reported once, at their own line '''
+    document = "\n".join([
+        "rule First { condition: true }",
+        "",
+        "import \"missing_module\"",
+        "rule Second { condition: true }",
+        "rule Third { condition: true }"
+    ])
+    result = await yara_server.provide_diagnostic(document, per_rule=True)
+    assert [diagnostic.range.start.line for diagnostic in result] == [2]
+    assert "missing_module" in result[0].message
@@ -0,0 +1,112 @@
+''' Tests for yarals.base.document module '''
+import pytest
+from yarals.base import protocol
+from yarals.base.document import TextDocument
+
+# don't care about pylint(protected-access) warnings since these are just tests
+# pylint: disable=W0212
+
+
+def _change(start_line, start_char, end_line, end_char, text):
+    ''' Build an incremental TextDocumentContentChangeEvent '''
+    return {
+        "range": {
+            "start": {"line": start_line, "character": start_char},
+            "end": {"line": end_line, "character": end_char}
+        },
+        "text": text
+    }
+
+@pytest.mark.document
+def test_full_change():
+    ''' Ensure changes without a range replace the whole document '''
+    document = TextDocument("file:///test.yar", "rule Old { condition: true }")
+    document.apply_changes([{"text": "rule New {\n condition: true\n}"}], version=2)
+    assert document.text == "rule New {\n condition: true\n}"
+    assert document.lines == ["rule New {", " condition: true", "}"]
+    assert document.version == 2
+
+@pytest.mark.document
+def test_incremental_insert():
+    ''' Ensure text is inserted when the range is empty '''
+    document = TextDocument("file:///test.yar", "rule Test {\n condition: true\n}")
+    document.apply_change(_change(1, 16, 1, 16, " and false"))
+    assert document.text == "rule Test {\n condition: true and false\n}"
+
+@pytest.mark.document
+def test_incremental_multiline():
+    ''' Ensure multi-line ranges are replaced and new lines are split out '''
+    document = TextDocument("file:///test.yar", "rule Test {\n strings:\n  $a = \"a\"\n condition:\n  $a\n}")
+    document.apply_change(_change(2, 2, 4, 4, "$b = \"b\"\n condition:\n  $b"))
+    assert document.lines == ["rule Test {", " strings:", "  $b = \"b\"", " condition:", "  $b", "}"]
+
+@pytest.mark.document
+def test_incremental_sequence():
+    ''' Ensure changes are applied in order, each against the result of the previous one '''
+    document = TextDocument("file:///test.yar", "abc")
+    document.apply_changes([_change(0, 3, 0, 3, "\n"), _change(1, 0, 1, 0, "def"), _change(0, 0, 0, 1, "")], version=5)
+    assert document.text == "bc\ndef"
+    assert document.version == 5
+
+@pytest.mark.document
+def test_incremental_out_of_bounds():
+    ''' Ensure positions past the end of a line or document are clamped '''
+    document = TextDocument("file:///test.yar", "abc\ndef")
+    document.apply_change(_change(0, 99, 0, 99, "!"))
+    document.apply_change(_change(10, 0, 10, 0, "?"))
+    assert document.text == "abc!\ndef?"
+
+@pytest.mark.document
+def test_incremental_utf16():
+    ''' Ensure character offsets are counted in UTF-16 code units, so characters outside the BMP take up two '''
+    document = TextDocument("file:///test.yar", "rule Test {\n meta: note = \"\U0001F600 \u00e9\" condition: true\n}")
+    # the emoji starts at code unit 15, and "\u00e9" is one code unit at 18
+    document.apply_change(_change(1, 18, 1, 19, "e"))
+    assert document.get_line(1) == " meta: note = \"\U0001F600 e\" condition: true"
+    document.apply_change(_change(1, 15, 1, 17, "smile"))
+    document.apply_change(_change(1, 39, 1, 39, " and true"))
+    assert document.get_line(1) == " meta: note = \"smile e\" condition: true and true"
+
+@pytest.mark.document
+def test_line_starts():
+    ''' Ensure the line index holds the offset of each line in the document text '''
+    document = TextDocument("file:///test.yar", "abc\n\nde\r\nf")
+    assert list(document.line_starts) == [0, 4, 5, 9]
+    assert document.get_line(2) == "de\r"
+    assert document.get_lines(1, 2) == ["", "de\r"]
+
+@pytest.mark.document
+def test_offset_conversions():
+    ''' Ensure positions and offsets can be converted back and forth '''
+    text = "rule Test {\n condition:\n  true\n}"
+    document = TextDocument("file:///test.yar", text)
+    for offset in range(len(text) + 1):
+        pos = document.position_at(offset)
+        assert document.offset_at(pos) == offset
+    assert document.position_at(text.index("true")) == protocol.Position(line=2, char=2)
+    assert document.offset_at(protocol.Position(line=3, char=0)) == text.index("}")
+
+@pytest.mark.document
+def test_line_starts_invalidated():
+    ''' Ensure the line index is rebuilt after the document changes '''
+    document = TextDocument("file:///test.yar", "abc\ndef")
+    assert list(document.line_starts) == [0, 4]
+    document.apply_change(_change(0, 1, 0, 1, "x\ny"))
+    assert list(document.line_starts) == [0, 3, 7]
+    assert document.position_at(7) == protocol.Position(line=2, char=0)
+
+@pytest.mark.asyncio
+async def test_did_open_then_change(yara_server):
+    ''' Ensure incremental didChange notifications are applied to the text sent with didOpen '''
+    file_uri = "file:///test.yar"
+    dirty_files = {}
+    did_open = {"params": {"textDocument": {"uri": file_uri, "version": 1, "text": "rule Test { condition: true }"}}}
+    did_change = {"params": {
+        "textDocument": {"uri": file_uri, "version": 2},
+        "contentChanges": [_change(0, 5, 0, 9, "Renamed")]
+    }}
+    await yara_server.event_did_open(True, message=did_open, dirty_files=dirty_files)
+    await yara_server.event_did_change(True, message=did_change, dirty_files=dirty_files)
+    assert dirty_files[file_uri].text == "rule Renamed { condition: true }"
+    assert dirty_files[file_uri].version == 2
+    assert yara_server._get_document(file_uri, dirty_files) == "rule Renamed { condition: true }"
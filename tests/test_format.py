@@ -1,7 +1,9 @@
 ''' Format Provider Tests '''
+import asyncio
 from textwrap import dedent
 
 import pytest
+from yarals import formatter
 from yarals import helpers
 from yarals.base import protocol
 from yarals.base import errors as ce
@@ -247,3 +249,202 @@ async def test_format_no_imports(test_rules, yara_server):
     full_text = "\n".join([edit.newText for edit in result])
     # should only be two imports - one for cuckoo and one for pe
     assert full_text.count("import ") == 0
+
+@pytest.mark.asyncio
+async def test_format_only_changed_rules(format_options, yara_server):
+    ''' Ensure rules that are already formatted are left alone, and unchanged rules are not parsed again '''
+    formatted = dedent("""\
+    rule Formatted
+    {
+        condition:
+            true
+    }""")
+    file_uri = "file:///tmp/changed_rules.yar"
+    dirty_files = {
+        file_uri: "{}\n\nrule Unformatted {{ condition: false }}\n".format(formatted)
+    }
+    message = {
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "options": format_options
+        }
+    }
+    result = await yara_server.provide_formatting(message, True, dirty_files=dirty_files)
+    assert len(result) == 1
+    assert result[0].range.start.line == 6
+    assert result[0].newText.startswith("rule Unformatted\n")
+    assert yara_server.format_cache.misses == 2
+    # only the rule that changed should be parsed again
+    dirty_files[file_uri] = "{}\n\nrule Unformatted {{ condition: true }}\n".format(formatted)
+    result = await yara_server.provide_formatting(message, True, dirty_files=dirty_files)
+    assert len(result) == 1
+    assert yara_server.format_cache.misses == 3
+    assert yara_server.format_cache.hits == 1
+
+def test_format_reuses_parser():
+    ''' Ensure parsers are reused, and give the same results as a new parser '''
+    plyara = pytest.importorskip("plyara")
+    source = "rule First { strings: $a = \"a\" condition: $a }"
+    expected = formatter.format_chunk(source)
+    parser = formatter.acquire_parser()
+    formatter.release_parser(parser)
+    assert formatter.format_chunk(source) == expected
+    assert formatter.acquire_parser() is parser
+    formatter.release_parser(parser)
+    # a broken rule should not leave anything behind for the next parse
+    with pytest.raises(plyara.exceptions.ParseTypeError) as excinfo:
+        formatter.format_chunk("rule Broken { strings: $a = { 4D 5X } condition: $a }", 10)
+    assert "line: 11" in str(excinfo.value)
+    assert formatter.format_chunk(source, 10) == expected
+
+def test_format_reuses_parser_documents():
+    ''' Ensure a pooled parser keeps nothing from one document when formatting the next '''
+    plyara = pytest.importorskip("plyara")
+    first = dedent("""\
+    import "pe"
+    include "other.yar"
+    // leading comment
+    rule First : tag1 tag2 {
+        meta:
+            author = "me"
+        strings:
+            $a = "a" wide
+            $b = { 4D 5A }
+        condition:
+            pe.is_dll() and any of them
+    }""")
+    second = "rule Second { strings: $c = \"c\" condition: $c and pe.is_dll() }"
+    # a pool with no parsers builds a new one for each document
+    formatter._PARSERS.clear()
+    expected = formatter.format_chunk(second)
+    formatter._PARSERS.clear()
+    formatter.format_chunk(first)
+    assert formatter.format_chunk(second) == expected
+    assert len(formatter._PARSERS) == 1
+    parser = formatter.acquire_parser()
+    assert parser.parse_string(second) == plyara.Plyara(store_raw_sections=True).parse_string(second)
+    formatter.release_parser(parser)
+
+@pytest.mark.asyncio
+async def test_format_range(format_options, yara_server):
+    ''' Ensure only the rules overlapping a range are parsed and formatted '''
+    file_uri = "file:///tmp/range_format.yar"
+    dirty_files = {
+        file_uri: "import \"pe\"\n\nrule First { condition: true }\n\nrule Second { condition: filesize < 10 and pe.is_dll }\n\nrule Third { condition: $a and }\n"
+    }
+    message = {
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "range": {"start": {"line": 4, "character": 5}, "end": {"line": 4, "character": 12}},
+            "options": format_options
+        }
+    }
+    result = await yara_server.provide_range_formatting(message, True, dirty_files=dirty_files)
+    assert len(result) == 1
+    assert result[0].range == protocol.Range(protocol.Position(line=4, char=0), protocol.Position(line=4, char=yara_server.MAX_LINE))
+    assert result[0].newText == dedent("""\
+    rule Second
+    {
+        condition:
+            filesize < 10 and pe.is_dll
+    }""")
+    # neither the imports, nor the broken rule after it, should have been parsed
+    assert yara_server.format_cache.misses == 1
+
+@pytest.mark.asyncio
+async def test_format_on_type(format_options, yara_server):
+    ''' Ensure the rule a closing brace was typed in is formatted, and parsing errors are not shown to the user '''
+    file_uri = "file:///tmp/on_type_format.yar"
+    dirty_files = {
+        file_uri: "rule First { condition: true }\nrule Second { strings: $a = { 4D 5A } condition: $a"
+    }
+    message = {
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 0, "character": 30},
+            "ch": "}",
+            "options": format_options
+        }
+    }
+    result = await yara_server.provide_on_type_formatting(message, True, dirty_files=dirty_files, writer=None)
+    assert len(result) == 1
+    assert result[0].range.start.line == 0
+    assert result[0].newText.startswith("rule First\n")
+    # the second rule is still being typed
+    message["params"]["position"] = {"line": 1, "character": 37}
+    result = await yara_server.provide_on_type_formatting(message, True, dirty_files=dirty_files, writer=None)
+    assert result == []
+
+@pytest.mark.asyncio
+async def test_format_partial(format_options, yara_server):
+    ''' Ensure the rules that were formatted in time are returned when formatting times out '''
+    file_uri = "file:///tmp/partial_format.yar"
+    dirty_files = {file_uri: "rule First { condition: true }\nrule Second { condition: true }\n"}
+    message = {
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "options": format_options
+        }
+    }
+    assert len(await yara_server.provide_formatting(message, True, dirty_files=dirty_files)) == 2
+    # the first rule is still cached after the second one changes, but there's no time to parse the second one.
+    # it is made large enough that the worker can't finish it before the timeout is noticed
+    yara_server.FORMAT_TIMEOUT_PER_LINE = 0
+    strings = " ".join("$s{0:d} = \"s{0:d}\"".format(num) for num in range(2000))
+    dirty_files[file_uri] = "rule First { condition: true }\nrule Second { strings: " + strings + " condition: any of them }\n"
+    result = await yara_server.provide_formatting(message, True, dirty_files=dirty_files, config={"format_timeout": 0})
+    assert [edit.range.start.line for edit in result] == [0]
+    assert result[0].newText.startswith("rule First\n")
+
+@pytest.mark.asyncio
+async def test_format_parse_error(format_options, yara_server):
+    ''' Ensure parsing errors in the formatter processes are reported without any edits '''
+    file_uri = "file:///tmp/broken_format.yar"
+    dirty_files = {file_uri: "rule First { condition: true }\nrule Broken { strings: $a = { 4D 5X } condition: $a }\n"}
+    message = {
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "options": format_options
+        }
+    }
+    result = await yara_server.provide_formatting(message, True, dirty_files=dirty_files, writer=None)
+    assert result == []
+    # parsing errors are not cached
+    assert len(yara_server.format_cache) == 0
+
+@pytest.mark.asyncio
+async def test_format_cancel(format_options, yara_server):
+    ''' Ensure formatting can be cancelled while rules are being parsed '''
+    file_uri = "file:///tmp/cancel_format.yar"
+    dirty_files = {file_uri: "rule First { condition: true }\n" * 200}
+    message = {
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "options": format_options
+        }
+    }
+    task = asyncio.get_event_loop().create_task(yara_server.provide_formatting(message, True, dirty_files=dirty_files))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+@pytest.mark.asyncio
+async def test_format_workers(format_options, yara_server):
+    ''' Ensure formatting with a different number of workers doesn't stop formatting already in progress '''
+    messages = []
+    for name in ("first", "second"):
+        messages.append({
+            "params": {
+                "textDocument": {"uri": "file:///tmp/{}_workers_format.yar".format(name)},
+                "options": format_options
+            }
+        })
+    results = await asyncio.gather(*[
+        yara_server.provide_formatting(message, True, config={"format_workers": workers}, dirty_files={
+            message["params"]["textDocument"]["uri"]: "rule Workers{:d} {{ condition: true }}\n".format(workers)
+        })
+        for workers, message in zip((1, 2), messages)
+    ])
+    assert [len(edits) for edits in results] == [1, 1]
+    assert sorted(yara_server._format_pools) == [1, 2]
@@ -0,0 +1,216 @@
+''' Tests for yarals.base.framing module '''
+import asyncio
+import json
+
+import pytest
+from yarals.base import errors as ce
+from yarals.base import protocol as lsp
+from yarals.base import server
+from yarals.base.framing import FrameParser, OutboundQueue
+
+# don't care about pylint(protected-access) warnings since these are just tests
+# pylint: disable=W0212
+
+
+def _frame(body: bytes, *headers: bytes) -> bytes:
+    ''' Build a framed message with a Content-Length header and any extra headers '''
+    return b"\r\n".join(headers + (b"Content-Length: " + str(len(body)).encode(),)) + b"\r\n\r\n" + body
+
+def _messages(parser: FrameParser) -> list:
+    ''' Take every complete message body out of a parser '''
+    bodies = []
+    body = parser.next_message()
+    while body is not None:
+        with body:
+            bodies.append(body.tobytes())
+        body = parser.next_message()
+    return bodies
+
+@pytest.mark.transport
+def test_pipelined_messages():
+    ''' Ensure several messages arriving in a single read are all parsed '''
+    parser = FrameParser()
+    parser.feed(_frame(b'{"id": 1}') + _frame(b'{"id": 2}') + _frame(b'{"id": 3}'))
+    assert _messages(parser) == [b'{"id": 1}', b'{"id": 2}', b'{"id": 3}']
+    assert len(parser) == 0
+
+@pytest.mark.transport
+def test_split_message():
+    ''' Ensure a message split across reads, even within its headers, is parsed once it is complete '''
+    data = _frame(b'{"id": 1}')
+    parser = FrameParser()
+    for index in range(len(data) - 1):
+        parser.feed(data[index:index+1])
+        assert parser.next_message() is None
+    parser.feed(data[-1:])
+    assert _messages(parser) == [b'{"id": 1}']
+
+@pytest.mark.transport
+def test_extra_headers():
+    ''' Ensure any number of headers are accepted, in any order and case '''
+    parser = FrameParser()
+    parser.feed(b"content-length: 2\r\nContent-Type: application/vscode-jsonrpc; charset=utf-8\r\n\r\n{}")
+    parser.feed(_frame(b"[]", b"Content-Type: application/vscode-jsonrpc; charset=utf-8"))
+    assert _messages(parser) == [b"{}", b"[]"]
+
+@pytest.mark.transport
+def test_multibyte_body():
+    ''' Ensure Content-Length is counted in bytes '''
+    body = json.dumps({"text": "правило 规则"}, ensure_ascii=False).encode("utf-8")
+    parser = FrameParser()
+    parser.feed(_frame(body) + _frame(b"{}"))
+    assert _messages(parser) == [body, b"{}"]
+
+@pytest.mark.transport
+def test_missing_content_length():
+    ''' Ensure messages without a valid Content-Length raise a ParseError '''
+    parser = FrameParser()
+    parser.feed(b"Content-Type: application/vscode-jsonrpc\r\n\r\n{}")
+    with pytest.raises(ce.ParseError):
+        parser.next_message()
+    parser.reset()
+    parser.feed(b"Content-Length: many\r\n\r\n{}")
+    with pytest.raises(ce.ParseError):
+        parser.next_message()
+
+@pytest.mark.transport
+def test_negative_content_length():
+    ''' Ensure a negative Content-Length raises a ParseError instead of parsing the same headers again '''
+    for headers in (b"Content-Length: -10\r\n\r\n{}", b"Content-Type: application/vscode-jsonrpc\r\nContent-Length: -1\r\n\r\n{}"):
+        parser = FrameParser()
+        parser.feed(headers)
+        with pytest.raises(ce.ParseError):
+            parser.next_message()
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_read_pipelined_requests(yara_server):
+    ''' Ensure read_request returns each pipelined message in turn, and an empty dict once the stream ends '''
+    reader = asyncio.StreamReader()
+    reader.feed_data(_frame(b'{"id": 1}', b"Content-Type: application/vscode-jsonrpc; charset=utf-8") + _frame(b'{"id": 2}'))
+    reader.feed_eof()
+    assert await yara_server.read_request(reader) == {"id": 1}
+    assert yara_server.has_buffered_messages(reader)
+    assert await yara_server.read_request(reader) == {"id": 2}
+    assert await yara_server.read_request(reader) == {}
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_read_truncated_request(yara_server):
+    ''' Ensure a message cut off by the client closing is dropped, rather than waited on forever '''
+    reader = asyncio.StreamReader()
+    reader.feed_data(_frame(b'{"id": 1}') + b'Content-Length: 100\r\n\r\n{"jsonrpc"')
+    reader.feed_eof()
+    assert await yara_server.read_request(reader) == {"id": 1}
+    assert await yara_server.read_request(reader) == {}
+    assert not yara_server.has_buffered_messages(reader)
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_client_closes_mid_message(open_streams, yara_server):
+    ''' Ensure a client that disconnects partway through a message is removed and its workspace released '''
+    _, writer = open_streams
+    workspace = yara_server.session.workspace
+    while yara_server.num_clients == 0:
+        await asyncio.sleep(0.01)
+    writer.write(b'Content-Length: 100\r\n\r\n{"jsonrpc"')
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+    for _ in range(50):
+        if workspace.refs == 1:
+            break
+        await asyncio.sleep(0.1)
+    # only the server's own session still refers to the workspace
+    assert workspace.refs == 1
+    assert yara_server.num_clients == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_outbound_batching(stream_writer):
+    ''' Ensure messages queued together are written with a single writelines call '''
+    writer = stream_writer
+    queue = OutboundQueue(writer)
+    for index in range(100):
+        queue.put(_frame(str(index).encode()))
+    await queue.flush()
+    assert len(writer.batches) == 1
+    assert len(writer.batches[0]) == 100
+    assert len(queue) == 0
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_outbound_backpressure(stream_writer):
+    ''' Ensure writers wait once too many bytes are waiting to be drained '''
+    writer = stream_writer
+    writer.can_drain.clear()
+    queue = OutboundQueue(writer, high_water=100, low_water=10)
+    queue.put(b"x" * 150)
+    waiting = asyncio.ensure_future(queue.wait())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    writer.can_drain.set()
+    await asyncio.wait_for(waiting, 1)
+    assert len(queue) == 0
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_write_data_order(stream_writer, yara_server):
+    ''' Ensure concurrent writes reach the client in the order they were made '''
+    writer = stream_writer
+    await asyncio.gather(*[yara_server.send_notification("test/order", {"index": index}, writer) for index in range(50)])
+    await yara_server.flush(writer)
+    reader = asyncio.StreamReader()
+    for batch in writer.batches:
+        reader.feed_data(b"".join(batch))
+    reader.feed_eof()
+    received = [(await yara_server.read_request(reader))["params"]["index"] for _ in range(50)]
+    assert received == list(range(50))
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_write_data_multibyte(stream_writer, yara_server):
+    ''' Ensure Content-Length counts bytes when messages contain non-ASCII text '''
+    writer = stream_writer
+    params = {"message": "правило не компилируется: 规则 ✓"}
+    await yara_server.send_notification("window/showMessage", params, writer)
+    await yara_server.send_notification("window/showMessage", {"message": "\ud800 unpaired"}, writer)
+    await yara_server.flush(writer)
+    data = b"".join(frame for batch in writer.batches for frame in batch)
+    assert "правило".encode("utf-8") in data
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    assert (await yara_server.read_request(reader))["params"] == params
+    assert (await yara_server.read_request(reader))["params"] == {"message": "\ud800 unpaired"}
+    assert await yara_server.read_request(reader) == {}
+
+@pytest.mark.transport
+@pytest.mark.skipif(server.orjson is None, reason="orjson is not installed")
+def test_codecs_match():
+    ''' Ensure every codec produces the same bytes and reads them back the same way '''
+    locrange = lsp.Range(lsp.Position(line=3, char=4), lsp.Position(line=3, char=10000))
+    messages = [
+        {"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics", "params": {
+            "uri": "file:///rules/правила.yar",
+            "diagnostics": [lsp.Diagnostic(locrange, lsp.DiagnosticSeverity.ERROR, "undefined string \"$a\" 规则 ✓ \U0001f600")]
+        }},
+        {"jsonrpc": "2.0", "id": 1, "result": lsp.Hover(lsp.MarkupContent(lsp.MarkupKind.Markdown, "<b>\t\\/</b>"), locrange)},
+        {"jsonrpc": "2.0", "id": 2, "result": [lsp.CompletionItem("pe", lsp.CompletionItemKind.CLASS)]},
+        {"jsonrpc": "2.0", "id": 3, "error": lsp.ResponseError(lsp.JsonRPCError.INTERNAL_ERROR, "\x00\x1f\u2028")},
+        {"jsonrpc": "2.0", "id": 4, "result": lsp.WorkspaceEdit("file:///rules/test.yar", [lsp.TextEdit(locrange, "new")])},
+        {"jsonrpc": "2.0", "id": 5, "result": {"unpaired": "\ud800", "wide": 2**70, "empty": [None, True, {}]}},
+    ]
+    std, fast = server.get_codec("json"), server.get_codec("orjson")
+    for message in messages:
+        encoded = std.encode(message)
+        assert fast.encode(message) == encoded
+        assert fast.decode(memoryview(encoded)) == std.decode(memoryview(encoded))
+
+@pytest.mark.transport
+def test_unknown_codec():
+    ''' Ensure asking for a codec that doesn't exist fails loudly '''
+    assert isinstance(server.get_codec("json"), server.JSONCodec)
+    with pytest.raises(ValueError):
+        server.get_codec("pickle")
@@ -78,3 +78,23 @@ def test_resolve_symbol():
     pos = protocol.Position(line=4, char=4)
     symbol = helpers.resolve_symbol(document, pos)
     assert symbol == "#a"
+
+@pytest.mark.helpers
+def test_symbol_pattern():
+    ''' Ensure symbol patterns translate wildcards, and are compiled once for each kind of symbol '''
+    pattern = helpers.symbol_pattern("rule", "Example")
+    assert helpers.symbol_pattern("rule", "Example") is pattern
+    assert [match.start() for match in pattern.finditer("Example and Examples or Example")] == [0, 24]
+    wildcard = helpers.symbol_pattern("string", "a*")
+    assert wildcard is not helpers.symbol_pattern("rule", "a*")
+    assert wildcard.fullmatch("abc")
+    assert not wildcard.fullmatch("ba")
+
+@pytest.mark.helpers
+def test_symbol_pattern_whole_words():
+    ''' Ensure rule patterns only match whole rule names, even when the name is a wildcard '''
+    text = "MyExample1 or Example2 or MyExample"
+    assert [match.group() for match in helpers.symbol_pattern("rule", "Example*").finditer(text)] == ["Example2"]
+    assert [match.start() for match in helpers.symbol_pattern("rule", "MyExample").finditer(text)] == [26]
+    # anything else in the symbol is taken literally
+    assert not helpers.symbol_pattern("rule", "My.xample*").search(text)
@@ -73,3 +73,23 @@ async def test_no_hover(test_rules, yara_server):
     }
     result = await yara_server.provide_hover(message, True)
     assert result is None
+
+@pytest.mark.asyncio
+async def test_no_hover_workspace_rules(tmp_path, yara_server):
+    ''' Ensure a rule declared in another workspace file does not show a line from the current document '''
+    private_rules = tmp_path.joinpath("private.yar")
+    private_rules.write_text("// shared rules\n\n\nprivate rule shared_private_rule\n{\n    condition:\n        true\n}\n")
+    public_rules = tmp_path.joinpath("public.yar")
+    public_rules.write_text(
+        "include \"private.yar\"\nrule uses_shared_rule\n{\n    strings: $a = \"unrelated\"\n"
+        "    condition:\n        shared_private_rule and $a\n}\n"
+    )
+    await yara_server._open_workspace(yara_server.session, tmp_path).indexing
+    message = {
+        "params": {
+            "textDocument": {"uri": helpers.create_file_uri(str(public_rules))},
+            "position": {"line": 5, "character": 12}
+        }
+    }
+    result = await yara_server.provide_hover(message, True)
+    assert result is None
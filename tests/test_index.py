@@ -0,0 +1,141 @@
+''' Tests for yarals.index module '''
+import random
+
+import pytest
+from yarals import index
+from yarals.base import protocol
+from yarals.base.document import TextDocument
+
+# don't care about pylint(protected-access) warnings since these are just tests
+# pylint: disable=W0212
+
+
+def _summary(rule_index):
+    ''' Reduce a RuleIndex to comparable tuples '''
+    return [(rule.name, rule.start_line, rule.end_line, rule.chunk_end, sorted(rule.strings)) for rule in rule_index.rules]
+
+@pytest.mark.index
+def test_rule_index(test_rules):
+    ''' Ensure rules, their sections, and their strings are indexed '''
+    peek_rules = test_rules.joinpath("peek_rules.yara").resolve()
+    document = TextDocument(peek_rules.as_uri(), peek_rules.read_text())
+    rule_index = index.get_rule_index(document)
+    assert [rule.name for rule in rule_index.rules] == ["SyntaxExample", "RuleReferenceExample"]
+    rule = rule_index.definitions("RuleReferenceExample")[0]
+    assert rule.range == protocol.Range(protocol.Position(line=33, char=0), protocol.Position(line=43, char=0))
+    assert rule.name_range == protocol.Range(protocol.Position(line=33, char=5), protocol.Position(line=33, char=25))
+    assert sorted(rule.sections) == ["condition", "meta", "strings"]
+    assert rule.sections["strings"].start.line == 39
+    assert rule.sections["condition"].start.line == 41
+    assert rule_index.rule_at(42) is rule
+    assert rule_index.rule_at(2) is None
+    assert rule_index.rules_between(0, 2) == []
+    assert rule_index.rules_between(40, 100) == [rule]
+    assert rule_index.rules_between(0, 33) == rule_index.rules
+    strings = rule_index.rule_at(20).strings
+    assert sorted(strings) == ["dstring", "false", "hex_string", "hex_string2", "reg_ex", "true"]
+    assert strings["dstring"].name_range == protocol.Range(protocol.Position(line=21, char=9), protocol.Position(line=21, char=16))
+    assert [use.start.line for use in strings["dstring"].uses] == [28, 29]
+
+@pytest.mark.index
+def test_rule_index_modifiers(test_rules):
+    ''' Ensure rule modifiers are indexed '''
+    private_rules = test_rules.joinpath("private_rule_goto.yara").resolve()
+    document = TextDocument(private_rules.as_uri(), private_rules.read_text())
+    rule_index = index.get_rule_index(document)
+    assert rule_index.definitions("my_private_rule")[0].modifiers == ["private"]
+    assert rule_index.definitions("my_public_rule")[0].modifiers == []
+
+@pytest.mark.index
+def test_rule_index_oneline(test_rules):
+    ''' Ensure rules declared on a single line are indexed '''
+    oneline = test_rules.joinpath("oneline.yar").resolve()
+    document = TextDocument(oneline.as_uri(), oneline.read_text())
+    rule = index.get_rule_index(document).rules[0]
+    assert rule.start_line == rule.end_line
+    assert list(rule.strings) == ["a"]
+    assert len(rule.strings["a"].uses) == 1
+
+@pytest.mark.index
+def test_rule_index_incremental():
+    ''' Ensure incremental updates give the same index as rebuilding from scratch '''
+    random.seed(1)
+    rule = "rule Rule{0:d}\n{{\n    strings:\n        $a{0:d} = \"a\"\n    condition:\n        $a{0:d}\n}}\n"
+    document = TextDocument("file:///test.yar", "import \"pe\"\n" + "\n".join(rule.format(num) for num in range(20)))
+    incremental = index.get_rule_index(document)
+    snippets = ["x", "\n", "}", "rule Inserted {\n condition: true\n}\n", "", "$b = \"b\"\n"]
+    for _ in range(200):
+        start_line = random.randrange(document.line_count)
+        end_line = min(start_line + random.randrange(3), document.line_count - 1)
+        start = {"line": start_line, "character": random.randrange(len(document.get_line(start_line)) + 1)}
+        end = {"line": end_line, "character": random.randrange(len(document.get_line(end_line)) + 1)}
+        if (end["line"], end["character"]) < (start["line"], start["character"]):
+            start, end = end, start
+        document.apply_change({"range": {"start": start, "end": end}, "text": random.choice(snippets)})
+        if random.random() < 0.5:
+            incremental.update(document)
+        if random.random() < 0.2:
+            incremental.update(document)
+            rebuilt = index.RuleIndex()
+            rebuilt.update(TextDocument(document.uri, document.text))
+            assert _summary(incremental) == _summary(rebuilt)
+    incremental.update(document)
+    rebuilt = index.RuleIndex()
+    rebuilt.update(TextDocument(document.uri, document.text))
+    assert _summary(incremental) == _summary(rebuilt)
+
+@pytest.mark.index
+def test_rule_index_only_touched_rules():
+    ''' Ensure rules away from an edit are not scanned again '''
+    rule = "rule Rule{0:d}\n{{\n    condition:\n        true\n}}\n"
+    document = TextDocument("file:///test.yar", "".join(rule.format(num) for num in range(10)))
+    rule_index = index.get_rule_index(document)
+    before = list(rule_index.rules)
+    document.apply_change({
+        "range": {"start": {"line": 23, "character": 0}, "end": {"line": 23, "character": 0}},
+        "text": "        and false\n"
+    })
+    rule_index = index.get_rule_index(document)
+    after = rule_index.rules
+    assert [rule.name for rule in after] == ["Rule{:d}".format(num) for num in range(10)]
+    # the edited rule and the one before it are re-scanned, everything else is re-used
+    assert [old is new for old, new in zip(before, after)] == [True]*3 + [False]*2 + [True]*5
+    assert after[5].start_line == 26
+
+@pytest.mark.index
+def test_rule_index_references():
+    ''' Ensure every full occurrence of an identifier is found, and kept up to date with edits '''
+    text = "rule Base { condition: true }\nrule MyBase { strings: $Base = \"Base\" condition: Base and $Base }\n// Base\n"
+    document = TextDocument("file:///test.yar", text)
+    rule_index = index.get_rule_index(document)
+    assert [(loc.start.line, loc.start.char, loc.end.char) for loc in rule_index.references("Base")] == [
+        (0, 5, 9), (1, 32, 36), (1, 49, 53), (2, 3, 7)
+    ]
+    assert rule_index.references("My") == []
+    # string identifiers are still only found with their uses in the condition
+    assert len(rule_index.rules[1].strings["Base"].uses) == 1
+    document.apply_change({
+        "range": {"start": {"line": 0, "character": 0}, "end": {"line": 0, "character": 0}},
+        "text": "\n"
+    })
+    rule_index = index.get_rule_index(document)
+    assert [loc.start.line for loc in rule_index.references("Base")] == [1, 2, 2, 3]
+
+@pytest.mark.index
+def test_workspace_index():
+    ''' Ensure rule names are mapped to their declarations across files '''
+    workspace_index = index.WorkspaceIndex()
+    first = TextDocument("file:///first.yar", "rule Shared { condition: true }\nrule First { condition: Shared }")
+    second = TextDocument("file:///second.yar", "private rule Shared { condition: false }")
+    workspace_index.update_file(first.uri, first)
+    workspace_index.update_file(second.uri, second)
+    assert sorted(loc.uri for loc in workspace_index.definitions("Shared")) == [first.uri, second.uri]
+    assert [loc.uri for loc in workspace_index.definitions("First")] == [first.uri]
+    # re-indexing a file replaces everything it used to declare
+    first.apply_change({"text": "rule Renamed { condition: true }"})
+    workspace_index.update_file(first.uri, first)
+    assert workspace_index.definitions("First") == []
+    assert [loc.uri for loc in workspace_index.definitions("Shared")] == [second.uri]
+    workspace_index.remove_file(second.uri)
+    assert workspace_index.definitions("Shared") == []
+    assert second.uri not in workspace_index
@@ -1,6 +1,7 @@
 ''' Rename Provider Tests '''
 import pytest
 from yarals import helpers
+from yarals.base import errors as ce
 from yarals.base import protocol
 
 # don't care about pylint(protected-access) warnings since these are just tests
@@ -30,3 +31,21 @@ async def test_renames(test_rules, yara_server):
         protocol.TextEdit(protocol.Range(protocol.Position(line=29, char=9), protocol.Position(line=29, char=16)), newText=new_text),
     ])
     assert result == expected
+
+@pytest.mark.asyncio
+async def test_renames_workspace_rules(tmp_path, yara_server):
+    ''' Ensure renaming a rule declared in another file is refused, instead of only renaming this file '''
+    private_rules = tmp_path.joinpath("private.yar")
+    private_rules.write_text("private rule shared_private_rule\n{\n    condition:\n        true\n}\n")
+    public_rules = tmp_path.joinpath("public.yar")
+    public_rules.write_text("include \"private.yar\"\n\nrule uses_shared_rule\n{\n    condition:\n        shared_private_rule\n}\n")
+    await yara_server._open_workspace(yara_server.session, tmp_path).indexing
+    message = {
+        "params": {
+            "textDocument": {"uri": helpers.create_file_uri(str(public_rules))},
+            "position": {"line": 5, "character": 12},
+            "newName": "renamed_rule"
+        }
+    }
+    with pytest.raises(ce.RenameError):
+        await yara_server.provide_rename(message, True)
@@ -1,9 +1,11 @@
 ''' General YaraLanguageServer Tests '''
+import asyncio
 import json
 import logging
 
 import pytest
 from yarals import helpers
+from yarals.base import protocol
 
 # don't care about pylint(protected-access) warnings since these are just tests
 # pylint: disable=W0212
@@ -17,11 +19,16 @@ except ImportError:
     from concurrent.futures import CancelledError
 
 
-@pytest.mark.skip(reason="not implemented")
+async def _slow_hover(message: dict, has_started: bool, **kwargs):
+    ''' Stand-in for a hover provider that never finishes on its own '''
+    await asyncio.sleep(60)
+
 @pytest.mark.asyncio
 @pytest.mark.integration
 async def test_cancel(initialize_msg, initialized_msg, open_streams, test_rules, yara_server):
     ''' Ensure a task can be cancelled before it returns '''
+    yara_server.TASK_TIMEOUT = 60
+    yara_server.request_handlers["textDocument/hover"] = _slow_hover
     # initialize the server
     reader, writer = open_streams
     await yara_server.write_data(initialize_msg, writer)
@@ -42,7 +49,6 @@ async def test_cancel(initialize_msg, initialized_msg, open_streams, test_rules,
         }
     }
     await yara_server.write_data(json.dumps(message), writer)
-    await yara_server.read_request(reader)
     # cancel that task
     cancel = {
         "jsonrpc": "2.0",
@@ -52,8 +58,87 @@ async def test_cancel(initialize_msg, initialized_msg, open_streams, test_rules,
         }
     }
     await yara_server.write_data(json.dumps(cancel), writer)
-    response = await yara_server.read_request(reader)
-    print(response)
+    response = await asyncio.wait_for(yara_server.read_request(reader), 5)
+    assert response["id"] == msg_id
+    assert response["error"]["code"] == protocol.JsonRPCError.REQUEST_CANCELLED
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.integration
+async def test_cancel_superseded(init_server, open_streams, test_rules, yara_server):
+    ''' Ensure a new hover request drops any earlier hover that is still running '''
+    yara_server.TASK_TIMEOUT = 60
+    yara_server.request_handlers["textDocument/hover"] = _slow_hover
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    file_uri = helpers.create_file_uri(str(test_rules.joinpath("apt_alienspy_rat.yar").resolve()))
+    for msg_id in (1, 2):
+        await yara_server.write_data(json.dumps({
+            "jsonrpc": "2.0", "id": msg_id, "method": "textDocument/hover",
+            "params": {"textDocument": {"uri": file_uri}, "position": {"line": 38, "character": 15}}
+        }), writer)
+    response = await asyncio.wait_for(yara_server.read_request(reader), 5)
+    assert response["id"] == 1
+    assert response["error"]["code"] == protocol.JsonRPCError.REQUEST_CANCELLED
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.integration
+async def test_concurrent_documents(init_server, open_streams, yara_server):
+    ''' Ensure a slow request for one document does not hold up requests for other documents '''
+    async def _slow_format(message: dict, has_started: bool, **kwargs):
+        await asyncio.sleep(0.5)
+        return []
+
+    async def _fast_hover(message: dict, has_started: bool, **kwargs):
+        return None
+
+    yara_server.request_handlers["textDocument/formatting"] = _slow_format
+    yara_server.request_handlers["textDocument/hover"] = _fast_hover
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "id": 1, "method": "textDocument/formatting",
+        "params": {"textDocument": {"uri": "file:///slow.yar"}, "options": {}}
+    }), writer)
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "id": 2, "method": "textDocument/hover",
+        "params": {"textDocument": {"uri": "file:///fast.yar"}, "position": {"line": 0, "character": 0}}
+    }), writer)
+    first = await yara_server.read_request(reader)
+    second = await yara_server.read_request(reader)
+    assert [first["id"], second["id"]] == [2, 1]
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.integration
+async def test_document_ordering(init_server, open_streams, yara_server):
+    ''' Ensure changes to a document wait for earlier requests about that document '''
+    file_uri = "file:///ordered.yar"
+
+    async def _slow_read(message: dict, has_started: bool, **kwargs):
+        await asyncio.sleep(0.2)
+        return str(kwargs["dirty_files"][file_uri])
+
+    yara_server.request_handlers["textDocument/formatting"] = _slow_read
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    for msg_id, text in enumerate(["before", "after"]):
+        await yara_server.write_data(json.dumps({
+            "jsonrpc": "2.0", "method": "textDocument/didChange",
+            "params": {"textDocument": {"uri": file_uri, "version": msg_id}, "contentChanges": [{"text": text}]}
+        }), writer)
+        await yara_server.write_data(json.dumps({
+            "jsonrpc": "2.0", "id": msg_id + 1, "method": "textDocument/formatting",
+            "params": {"textDocument": {"uri": file_uri}, "options": {}}
+        }), writer)
+    responses = [await yara_server.read_request(reader) for _ in range(2)]
+    assert [(response["id"], response["result"]) for response in responses] == [(1, "before"), (2, "after")]
+    writer.close()
+    await writer.wait_closed()
 
 @pytest.mark.asyncio
 async def test_dirty_files(test_rules, yara_server):
@@ -131,7 +216,8 @@ async def test_initialize(initialize_msg, initialized_msg, open_streams, yara_se
             "capabilities": {
                 "completionProvider":{"resolveProvider": False, "triggerCharacters": ["."]},
                 "definitionProvider": True, "documentFormattingProvider": True, "hoverProvider": True,
-                "renameProvider": True, "referencesProvider": True, "textDocumentSync": 1,
+                "documentRangeFormattingProvider": True, "documentOnTypeFormattingProvider": {"firstTriggerCharacter": "}"},
+                "renameProvider": True, "referencesProvider": True, "textDocumentSync": 2,
                 "executeCommandProvider": {"commands": ["yara.CompileRule", "yara.CompileAllRules"]}
             }
         }
@@ -167,7 +253,8 @@ async def test_initialize_without_plyara(initialize_msg, initialized_msg, open_s
             "capabilities": {
                 "completionProvider":{"resolveProvider": False, "triggerCharacters": ["."]},
                 "definitionProvider": True, "documentFormattingProvider": True, "hoverProvider": True,
-                "renameProvider": True, "referencesProvider": True, "textDocumentSync": 1,
+                "documentRangeFormattingProvider": True, "documentOnTypeFormattingProvider": {"firstTriggerCharacter": "}"},
+                "renameProvider": True, "referencesProvider": True, "textDocumentSync": 2,
                 "executeCommandProvider": {"commands": ["yara.CompileRule", "yara.CompileAllRules"]}
             }
         }
@@ -198,7 +285,8 @@ async def test_initialize_without_yara(initialize_msg, initialized_msg, open_str
             "capabilities": {
                 "completionProvider":{"resolveProvider": False, "triggerCharacters": ["."]},
                 "definitionProvider": True, "documentFormattingProvider": True, "hoverProvider": True,
-                "renameProvider": True, "referencesProvider": True, "textDocumentSync": 1,
+                "documentRangeFormattingProvider": True, "documentOnTypeFormattingProvider": {"firstTriggerCharacter": "}"},
+                "renameProvider": True, "referencesProvider": True, "textDocumentSync": 2,
                 "executeCommandProvider": {"commands": []}
             }
         }
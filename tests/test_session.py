@@ -0,0 +1,101 @@
+''' Tests for yarals.session module '''
+import asyncio
+import json
+
+import pytest
+from yarals import helpers
+from yarals.base import errors as ce
+from yarals.session import Session
+
+# don't care about pylint(protected-access) warnings since these are just tests
+# pylint: disable=W0212
+
+
+def _session(yara_server, writer) -> Session:
+    ''' A session for a client that hasn't opened a workspace folder yet '''
+    return Session(yara_server._acquire_workspace(None), writer)
+
+@pytest.mark.asyncio
+@pytest.mark.session
+async def test_shared_workspace(initialize_msg, stream_writer, tmp_path, yara_server):
+    ''' Ensure clients opening the same folder share its index, which is dropped once the last of them leaves '''
+    rules = tmp_path.joinpath("shared.yar")
+    rules.write_text("rule SharedRule { condition: true }\n")
+    message = json.loads(initialize_msg)
+    message["params"]["rootUri"] = helpers.create_file_uri(str(tmp_path))
+    first, second = _session(yara_server, stream_writer), _session(yara_server, stream_writer)
+    await yara_server.initialize(message, False, session=first)
+    await yara_server.initialize(message, False, session=second)
+    assert first.workspace is second.workspace
+    assert first.workspace.refs == 2
+    await first.workspace.indexing
+    assert [loc.uri for loc in second.definitions("SharedRule")] == [helpers.create_file_uri(str(rules))]
+    yara_server._release_workspace(first.workspace)
+    assert yara_server._workspaces[tmp_path] is second.workspace
+    yara_server._release_workspace(second.workspace)
+    assert tmp_path not in yara_server._workspaces
+
+@pytest.mark.asyncio
+@pytest.mark.session
+async def test_unsaved_changes_isolated(stream_writer, tmp_path, yara_server):
+    ''' Ensure a client's unsaved changes are only seen by other clients once they are saved '''
+    rules = tmp_path.joinpath("rules.yar")
+    rules.write_text("rule OnDisk { condition: true }\n")
+    file_uri = helpers.create_file_uri(str(rules))
+    editor, viewer = _session(yara_server, stream_writer), _session(yara_server, stream_writer)
+    await yara_server._open_workspace(editor, tmp_path).indexing
+    yara_server._open_workspace(viewer, tmp_path)
+    unsaved = "rule Unsaved { condition: true }\n"
+    change = {"params": {"textDocument": {"uri": file_uri, "version": 2}, "contentChanges": [{"text": unsaved}]}}
+    await yara_server.event_did_change(True, message=change, dirty_files=editor.dirty_files, session=editor)
+    assert [loc.uri for loc in editor.definitions("Unsaved")] == [file_uri]
+    assert editor.definitions("OnDisk") == []
+    assert viewer.definitions("Unsaved") == []
+    assert [loc.uri for loc in viewer.definitions("OnDisk")] == [file_uri]
+    assert file_uri not in viewer.dirty_files
+    rules.write_text(unsaved)
+    save = {"params": {"textDocument": {"uri": file_uri}}}
+    await yara_server.event_did_save(True, message=save, dirty_files=editor.dirty_files, writer=editor.writer, session=editor)
+    assert [loc.uri for loc in viewer.definitions("Unsaved")] == [file_uri]
+    assert viewer.definitions("OnDisk") == []
+
+@pytest.mark.asyncio
+@pytest.mark.session
+async def test_compiles_isolated(stream_writer, yara_server):
+    ''' Ensure compiling a document for one client doesn't cancel another client's compile of it '''
+    file_uri = "file:///shared.yar"
+    first, second = _session(yara_server, stream_writer), _session(yara_server, stream_writer)
+    results = await asyncio.gather(
+        yara_server.provide_diagnostic("rule Broken { condition: $a }", file_uri=file_uri, session=first),
+        yara_server.provide_diagnostic("rule Working { condition: true }", file_uri=file_uri, session=second)
+    )
+    assert len(results[0]) == 1
+    assert results[1] == []
+    assert not first.compiles and not second.compiles
+
+@pytest.mark.asyncio
+@pytest.mark.session
+async def test_rename_isolated(stream_writer, tmp_path, yara_server):
+    ''' Ensure a rename is only refused for a rule declared in another file as seen by the client asking '''
+    private_rules = tmp_path.joinpath("private.yar")
+    private_rules.write_text("private rule shared_rule { condition: true }\n")
+    public_rules = tmp_path.joinpath("public.yar")
+    public_rules.write_text("include \"private.yar\"\nrule uses_shared_rule { condition: shared_rule }\n")
+    private_uri = helpers.create_file_uri(str(private_rules))
+    editor, viewer = _session(yara_server, stream_writer), _session(yara_server, stream_writer)
+    await yara_server._open_workspace(editor, tmp_path).indexing
+    yara_server._open_workspace(viewer, tmp_path)
+    # the editor renames the declaration without saving
+    change = {"params": {"textDocument": {"uri": private_uri, "version": 2}, "contentChanges": [{"text": "private rule other_rule { condition: true }\n"}]}}
+    await yara_server.event_did_change(True, message=change, dirty_files=editor.dirty_files, session=editor)
+    message = {
+        "params": {
+            "textDocument": {"uri": helpers.create_file_uri(str(public_rules))},
+            "position": {"line": 1, "character": 42},
+            "newName": "renamed_rule"
+        }
+    }
+    result = await yara_server.provide_rename(message, True, session=editor)
+    assert [edit.range.start.line for edit in result.changes] == [1]
+    with pytest.raises(ce.RenameError):
+        await yara_server.provide_rename(message, True, session=viewer)
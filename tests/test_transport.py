@@ -1,8 +1,13 @@
 ''' Test the various transport mechanisms used between client and server
-    Currently only TCP is supported, though ideally anything supported by
+    TCP and stdio (pipes) are supported, though ideally anything supported by
     the asyncio library will be fully integrated and tested in the future
 '''
+import asyncio
+import os
+import sys
+
 import pytest
+from yarals.base.server import open_pipe_streams
 
 
 @pytest.mark.asyncio
@@ -24,3 +29,49 @@ async def test_tcp_opened(open_streams):
     assert reader.at_eof() is False
     writer.close()
     await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.integration
+@pytest.mark.transport
+@pytest.mark.skipif(sys.platform == "win32", reason="asyncio can't wait on pipes with the SelectorEventLoop used on Windows")
+async def test_stdio(yara_server, initialize_msg):
+    ''' Ensure a client can talk to the server over a pair of pipes, like stdin/stdout '''
+    server_in, client_out = os.pipe()
+    client_in, server_out = os.pipe()
+    server_reader, server_writer = await open_pipe_streams(os.fdopen(server_in, "rb"), os.fdopen(server_out, "wb"))
+    reader, writer = await open_pipe_streams(os.fdopen(client_in, "rb"), os.fdopen(client_out, "wb"))
+    server = asyncio.ensure_future(yara_server.handle_client(server_reader, server_writer))
+    await yara_server.write_data(initialize_msg, writer)
+    response = await yara_server.read_request(reader)
+    assert "capabilities" in response["result"]
+    # closing the client's end of the pipe ends the session
+    await yara_server.remove_client(writer)
+    await asyncio.wait_for(server, timeout=5)
+    await yara_server.remove_client(server_writer)
+    assert await yara_server.read_request(reader) == {}
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+@pytest.mark.skipif(sys.platform == "win32", reason="asyncio can't wait on pipes with the SelectorEventLoop used on Windows")
+async def test_stdio_drain():
+    ''' Ensure writing more to a pipe than it can buffer waits for the other end to read it '''
+    server_in, client_out = os.pipe()
+    client_in, server_out = os.pipe()
+    server_reader, server_writer = await open_pipe_streams(os.fdopen(server_in, "rb"), os.fdopen(server_out, "wb"))
+    reader, writer = await open_pipe_streams(os.fdopen(client_in, "rb"), os.fdopen(client_out, "wb"))
+    data = os.urandom(4 * 1024 * 1024)
+
+    async def _write():
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+    task = asyncio.ensure_future(_write())
+    assert await server_reader.readexactly(len(data)) == data
+    await asyncio.wait_for(task, timeout=5)
+    assert writer.is_closing()
+    assert await server_reader.read() == b""
+    server_writer.close()
+    await server_writer.wait_closed()
+    assert await reader.read() == b""
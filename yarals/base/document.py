@@ -0,0 +1,167 @@
+''' Text document model used to keep track of the files a client has open '''
+from array import array
+from bisect import bisect_right
+from itertools import accumulate, chain
+from typing import Iterable, Optional
+
+from . import protocol as lsp
+
+
+def utf16_index(line: str, units: int) -> int:
+    '''Convert a character offset counted in UTF-16 code units, as LSP positions are, to an index into a line
+
+    Only characters outside the Basic Multilingual Plane, such as emoji, take up two code units
+    '''
+    if units <= 0 or line.isascii():
+        return units
+    count = 0
+    for index, char in enumerate(line):
+        if count >= units:
+            return index
+        count += 2 if ord(char) > 0xFFFF else 1
+    return len(line) + units - count
+
+
+class TextDocument():
+    '''In-memory copy of a text document that is kept in sync with the client
+
+    Text is stored as a list of lines (without their line feeds) so incremental edits
+    only rebuild the lines inside the changed range. The full text is only joined back
+    together when a feature asks for it, and is cached until the next change.
+    The same goes for the table of line start offsets used to convert between
+    positions and offsets.
+
+    Every change bumps the document's revision and is recorded in a short edit log,
+    so anything derived from the text can be updated for just the lines that changed
+    '''
+    # number of edits to remember before consumers have to rebuild from scratch
+    MAX_EDITS = 256
+
+    def __init__(self, uri: str, text: str="", version: Optional[int]=None):
+        self.uri = str(uri)
+        self.version = version
+        self.revision = 0
+        self._lines = text.split("\n")
+        self._text = text
+        self._line_starts = None
+        # (start line, old end line, new end line) for each change after self._edits_base
+        self._edits = []
+        self._edits_base = 0
+
+    @property
+    def lines(self) -> list:
+        ''' Lines in the document, without line feeds '''
+        return self._lines
+
+    @property
+    def line_count(self) -> int:
+        ''' Number of lines in the document '''
+        return len(self._lines)
+
+    @property
+    def line_starts(self) -> array:
+        ''' Offset of the first character of each line in the document text '''
+        if self._line_starts is None:
+            self._line_starts = array("I", accumulate(chain((0,), (len(line) + 1 for line in self._lines[:-1]))))
+        return self._line_starts
+
+    @property
+    def text(self) -> str:
+        ''' Full text of the document '''
+        if self._text is None:
+            self._text = "\n".join(self._lines)
+        return self._text
+
+    def _clamp(self, line: int, char: int, utf16: bool=False) -> tuple:
+        '''Restrict a line/character pair to a valid location in the document
+
+        :utf16: (Optional) the character is counted in UTF-16 code units, as it is in positions from the client
+        '''
+        last_line = len(self._lines) - 1
+        if line > last_line:
+            return last_line, len(self._lines[last_line])
+        line = max(int(line), 0)
+        if utf16:
+            char = utf16_index(self._lines[line], int(char))
+        return line, min(max(int(char), 0), len(self._lines[line]))
+
+    def _invalidate(self):
+        ''' Drop everything derived from the text after it has changed '''
+        self._text = None
+        self._line_starts = None
+
+    def apply_change(self, change: dict):
+        '''Apply a single TextDocumentContentChangeEvent to the document
+
+        :change: Dictionary with the new "text" and, for incremental changes, the "range" it replaces.
+                 If no range is given, the text replaces the whole document
+        '''
+        text = change.get("text", "")
+        locrange = change.get("range")
+        self._invalidate()
+        self.revision += 1
+        if locrange is None:
+            self._lines = text.split("\n")
+            self._text = text
+            # every line changed, so there's no point in remembering earlier edits
+            self._edits.clear()
+            self._edits_base = self.revision
+            return
+        # the server doesn't negotiate a position encoding, so clients count characters in UTF-16 code units
+        start_line, start_char = self._clamp(locrange["start"]["line"], locrange["start"]["character"], utf16=True)
+        end_line, end_char = self._clamp(locrange["end"]["line"], locrange["end"]["character"], utf16=True)
+        head = self._lines[start_line][:start_char]
+        tail = self._lines[end_line][end_char:]
+        new_lines = (head + text + tail).split("\n")
+        self._lines[start_line:end_line+1] = new_lines
+        self._edits.append((start_line, end_line, start_line + len(new_lines) - 1))
+        if len(self._edits) > self.MAX_EDITS:
+            dropped = len(self._edits) // 2
+            del self._edits[:dropped]
+            self._edits_base += dropped
+
+    def apply_changes(self, changes: Iterable[dict], version: Optional[int]=None):
+        '''Apply a list of content changes in the order they were sent
+
+        :changes: List of TextDocumentContentChangeEvents from a didChange notification
+        :version: (Optional) version number of the document after all changes are applied
+        '''
+        for change in changes:
+            self.apply_change(change)
+        if version is not None:
+            self.version = version
+
+    def edits_since(self, revision: int) -> Optional[list]:
+        '''Line-based edits made after the given revision, oldest first
+
+        Each edit is a tuple of (start line, old end line, new end line).
+        Returns None if the edits are no longer known, such as after the whole text was replaced
+        '''
+        if revision < self._edits_base:
+            return None
+        return self._edits[revision-self._edits_base:]
+
+    def get_line(self, line: int) -> str:
+        ''' Text of a single line, without its line feed '''
+        return self._lines[line]
+
+    def get_lines(self, start: int, end: int) -> list:
+        ''' Text of the lines from start up to and including end '''
+        return self._lines[start:end+1]
+
+    def offset_at(self, pos: lsp.Position) -> int:
+        ''' Convert a position to an offset into the document text '''
+        line, char = self._clamp(pos.line, pos.char)
+        return self.line_starts[line] + char
+
+    def position_at(self, offset: int) -> lsp.Position:
+        ''' Convert an offset into the document text to a position '''
+        offset = max(int(offset), 0)
+        line = bisect_right(self.line_starts, offset) - 1
+        return lsp.Position(line=line, char=min(offset - self.line_starts[line], len(self._lines[line])))
+
+    def __str__(self) -> str:
+        return self.text
+
+    def __repr__(self):
+        return "<TextDocument(uri={}, version={}, lines={:d})>".format(self.uri, self.version, len(self._lines))
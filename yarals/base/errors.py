@@ -12,6 +12,9 @@ class DiagnosticError(Exception):
 class FormatError(Exception):
     ''' Custom error for formatting feature '''
 
+class FormatParseError(FormatError):
+    ''' Custom error for rules that could not be parsed for formatting '''
+
 class HighlightError(Exception):
     ''' Custom error for highlight feature '''
 
@@ -21,6 +24,9 @@ class HoverError(Exception):
 class NoDependencyFound(Exception):
     ''' Custom error for when a dependency was not found '''
 
+class ParseError(Exception):
+    ''' Custom error for messages that can't be parsed out of the input stream '''
+
 class RenameError(Exception):
     ''' Custom error for symbol rename feature '''
 
@@ -0,0 +1,161 @@
+''' Parse Language Server Protocol messages out of a stream of bytes, and batch them back into one '''
+import asyncio
+from typing import Optional
+
+from . import errors as ce
+
+HEADER_END = b"\r\n\r\n"
+CONTENT_LENGTH = b"Content-Length: "
+
+
+class FrameParser():
+    '''Buffers incoming bytes and splits them into message bodies
+
+    Each message is a set of "Name: value" headers, a blank line and a body of exactly
+    Content-Length bytes. Any number of headers may be sent, in any order, and several
+    messages may arrive in a single read. Bodies are handed out as memoryviews into the
+    buffer, so they are only copied when they are decoded
+    '''
+    # compact the buffer once this many bytes at its start have been consumed
+    COMPACT_SIZE = 64 * 1024
+    # give up on a message whose headers are longer than this
+    MAX_HEADER_SIZE = 8 * 1024
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # start of the unconsumed bytes in the buffer
+        self._offset = 0
+        # length of the body being waited on, once its headers have been parsed
+        self._content_length = None
+
+    def __len__(self) -> int:
+        ''' Number of buffered bytes that have not been parsed into a message yet '''
+        return len(self._buffer) - self._offset
+
+    def feed(self, data: bytes):
+        ''' Add bytes read from the stream to the buffer '''
+        if self._offset >= self.COMPACT_SIZE and self._offset * 2 >= len(self._buffer):
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer += data
+
+    @staticmethod
+    def _parse_headers(headers: bytes) -> int:
+        ''' Find the Content-Length in a block of headers '''
+        # fast path for the usual case where it's the only header
+        if headers.startswith(CONTENT_LENGTH) and b"\r\n" not in headers:
+            try:
+                length = int(headers[len(CONTENT_LENGTH):])
+                if length >= 0:
+                    return length
+            except ValueError:
+                pass
+        for header in headers.split(b"\r\n"):
+            name, _, value = header.partition(b":")
+            if name.strip().lower() == b"content-length":
+                try:
+                    length = int(value.strip())
+                except ValueError:
+                    raise ce.ParseError("Invalid Content-Length header: {!r}".format(header))
+                # a negative length would move the parser back over headers it already read
+                if length < 0:
+                    raise ce.ParseError("Invalid Content-Length header: {!r}".format(header))
+                return length
+        raise ce.ParseError("Message is missing a Content-Length header: {!r}".format(headers))
+
+    def next_message(self) -> Optional[memoryview]:
+        '''Take the next complete message body out of the buffer
+
+        Returns None if more bytes are needed first. The returned view must be released before the next call to feed()
+        '''
+        buffer = self._buffer
+        if self._content_length is None:
+            end = buffer.find(HEADER_END, self._offset)
+            if end < 0:
+                if len(self) > self.MAX_HEADER_SIZE:
+                    raise ce.ParseError("Message headers are longer than {:d} bytes".format(self.MAX_HEADER_SIZE))
+                return None
+            headers = bytes(buffer[self._offset:end])
+            self._offset = end + len(HEADER_END)
+            self._content_length = self._parse_headers(headers)
+        start = self._offset
+        end = start + self._content_length
+        if end > len(buffer):
+            return None
+        self._offset = end
+        self._content_length = None
+        body = memoryview(buffer)[start:end]
+        if end == len(buffer):
+            # everything has been consumed, so the next feed() can start from the beginning.
+            # the buffer can't be resized while the view is held, so swap in a new one
+            self._buffer = bytearray()
+            self._offset = 0
+        return body
+
+    def reset(self):
+        ''' Drop everything in the buffer, such as after a message could not be parsed '''
+        self._buffer = bytearray()
+        self._offset = 0
+        self._content_length = None
+
+
+class OutboundQueue():
+    '''Coalesces the messages written to a stream
+
+    Messages are queued and written by a single task, which hands everything queued so far
+    to the transport with one writelines() call and then drains the stream once per batch.
+    Once more than high_water bytes are waiting, writers have to wait until the queue
+    has drained below low_water
+    '''
+    def __init__(self, writer: asyncio.StreamWriter, high_water: int=1024*1024, low_water: int=256*1024):
+        self._writer = writer
+        self.high_water = high_water
+        self.low_water = low_water
+        self._frames = []
+        # bytes queued or written but not yet drained
+        self._size = 0
+        self._task = None
+        self._below_high_water = asyncio.Event()
+        self._below_high_water.set()
+
+    def __len__(self) -> int:
+        ''' Number of bytes that have not been drained to the client yet '''
+        return self._size
+
+    def put(self, *chunks: bytes):
+        ''' Queue the chunks of a framed message to be written with the next batch '''
+        if self._writer.is_closing():
+            return
+        for chunk in chunks:
+            self._frames.append(chunk)
+            self._size += len(chunk)
+        if self._size >= self.high_water:
+            self._below_high_water.clear()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._flush())
+
+    async def wait(self):
+        ''' Wait until there is room in the queue again '''
+        await self._below_high_water.wait()
+
+    async def flush(self):
+        ''' Wait until everything queued so far has been drained to the client '''
+        while self._task is not None and not self._task.done():
+            await asyncio.shield(self._task)
+
+    async def _flush(self):
+        ''' Write batches until the queue is empty '''
+        try:
+            while self._frames:
+                frames, self._frames = self._frames, []
+                self._writer.writelines(frames)
+                await self._writer.drain()
+                self._size -= sum(len(frame) for frame in frames)
+                if self._size <= self.low_water:
+                    self._below_high_water.set()
+        except BaseException:
+            # the client is gone, so don't keep anyone waiting on it
+            self._frames.clear()
+            self._size = 0
+            self._below_high_water.set()
+            raise
@@ -24,6 +24,11 @@ class CompletionTriggerKind(IntEnum):
     # Completion was re-triggered as the current completion list is incomplete.
     INCOMPLETE = 3
 
+class FileChangeType(IntEnum):
+    CREATED = 1
+    CHANGED = 2
+    DELETED = 3
+
 class JsonRPCError(IntEnum):
     # Defined by JSON RPC
     PARSE_ERROR = -32700
@@ -69,6 +74,8 @@ class TextSyncKind(IntEnum):
     INCREMENTAL = 2
 
 class Position():
+    __slots__ = ("line", "char")
+
     def __init__(self, line: int, char: int):
         ''' Line position in a document (zero-based)
 
@@ -83,6 +90,10 @@ class Position():
         self.line = int(line)
         self.char = int(char)
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {"line": self.line, "character": self.char}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.line == other.line) and (self.char == other.char)
@@ -101,6 +112,8 @@ class Position():
         return "<Position(line={:d}, char={:d})>".format(self.line, self.char)
 
 class Range():
+    __slots__ = ("start", "end")
+
     def __init__(self, start: Position, end: Position):
         ''' A range in a text document expressed as (zero-based) start and end positions
 
@@ -113,6 +126,10 @@ class Range():
         self.start = start
         self.end = end
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {"start": self.start.to_json(), "end": self.end.to_json()}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.start == other.start) and (self.end == other.end)
@@ -129,6 +146,8 @@ class Range():
         return "<Range(start={}, end={})>".format(self.start, self.end)
 
 class CompletionItem():
+    __slots__ = ("label", "kind", "insertText", "detail")
+
     def __init__(self, label: str, kind: CompletionItemKind=CompletionItemKind.CLASS, detail: Optional[str]=None, insertText: Optional[str]=None):
         ''' Suggested items for the user '''
         self.label = str(label)
@@ -138,6 +157,10 @@ class CompletionItem():
         self.insertText = str(label) if insertText is None else str(insertText)
         self.detail = str(label) if detail is None else str(detail)
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {"label": self.label, "kind": self.kind, "insertText": self.insertText, "detail": self.detail}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.label == other.label) and (self.kind == other.kind) and \
@@ -156,6 +179,8 @@ class CompletionItem():
         return "<CompletionItem(label=\"{}\", kind={:d}, insertText=\"{}\")>".format(self.label, self.kind, self.insertText)
 
 class Diagnostic():
+    __slots__ = ("message", "range", "relatedInformation", "severity")
+
     def __init__(self, locrange: Range, severity: int, message: str, relatedInformation: Optional[List]=None):
         ''' Represents a diagnostic, such as a compiler error or warning
 
@@ -173,6 +198,15 @@ class Diagnostic():
         self.relatedInformation = relatedInformation
         self.severity = int(severity)
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {
+            "message": self.message,
+            "range": self.range.to_json(),
+            "relatedInformation": self.relatedInformation,
+            "severity": self.severity
+        }
+
     def __eq__(self, other) -> bool:
         try:
             return (self.severity == other.severity) and \
@@ -195,6 +229,8 @@ class Diagnostic():
         return "<Diagnostic(severity={:d}, message={})>".format(self.severity, self.message)
 
 class Location():
+    __slots__ = ("range", "uri")
+
     def __init__(self, locrange: Range, uri: str):
         ''' Represents a location inside a resource
         such as a line inside a text file
@@ -204,6 +240,10 @@ class Location():
         self.range = locrange
         self.uri = str(uri)
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {"range": self.range.to_json(), "uri": self.uri}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.range == other.range) and (self.uri == other.uri)
@@ -220,6 +260,8 @@ class Location():
         return "<Location(range={}, uri={})>".format(self.range, self.uri)
 
 class MarkupContent():
+    __slots__ = ("kind", "value")
+
     def __init__(self, kind: MarkupKind, content: str):
         ''' Represents a string value which content is interpreted base on its kind flag '''
         if not isinstance(kind, MarkupKind):
@@ -227,6 +269,10 @@ class MarkupContent():
         self.kind = kind
         self.value = str(content)
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {"kind": self.kind.value, "value": self.value}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.value == other.value) and (self.kind == other.kind)
@@ -243,6 +289,8 @@ class MarkupContent():
         return "<MarkupContent(value={}, kind={:d})>".format(self.value, self.kind)
 
 class Hover():
+    __slots__ = ("range", "contents")
+
     def __init__(self, contents: MarkupContent, locrange: Optional[Range]=None):
         ''' Represents hover information at a given text document position '''
         if locrange:
@@ -253,6 +301,12 @@ class Hover():
             raise TypeError("Contents cannot be {}. Must be MarkupContent".format(type(contents)))
         self.contents = contents
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        if hasattr(self, "range"):
+            return {"range": self.range.to_json(), "contents": self.contents.to_json()}
+        return {"contents": self.contents.to_json()}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.range == other.range) and (self.contents == other.contents)
@@ -266,6 +320,8 @@ class Hover():
             return True
 
 class ResponseError():
+    __slots__ = ("code", "message", "data")
+
     def __init__(self, code: int, message: str, data: Optional[Any]=None):
         ''' The error object in case a request fails '''
         self.code = code
@@ -289,6 +345,10 @@ class ResponseError():
             code = JsonRPCError.INTERNAL_ERROR
         return ResponseError(code=code, message=message, data=data)
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {"code": self.code, "message": self.message, "data": self.data}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.code == other.code) and (self.message == other.message) and (self.data == other.data)
@@ -305,6 +365,8 @@ class ResponseError():
         return "<ResponseError(code={:d}, message={})>".format(self.code, self.message)
 
 class TextEdit():
+    __slots__ = ("range", "newText")
+
     def __init__(self, locrange: Range, newText: str):
         ''' A textual edit applicable to a text document. '''
         if not isinstance(locrange, Range):
@@ -315,6 +377,10 @@ class TextEdit():
         # pylint: disable=C0103
         self.newText = newText
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {"range": self.range.to_json(), "newText": self.newText}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.range == other.range) and (self.newText == other.newText)
@@ -331,6 +397,8 @@ class TextEdit():
         return "<TextEdit(newText={})>".format(self.newText)
 
 class WorkspaceEdit():
+    __slots__ = ("changes", "uri")
+
     def __init__(self, file_uri, changes: Optional[List]=None):
         '''Represents changes to many resources
         managed in the workspace
@@ -352,6 +420,10 @@ class WorkspaceEdit():
             raise TypeError("Change cannot be {}. Must be TextEdit".format(type(change)))
         return self.changes.append(change)
 
+    def to_json(self) -> dict:
+        ''' Convert to a dictionary that can be serialized as JSON '''
+        return {"changes": {self.uri: self.changes}}
+
     def __eq__(self, other) -> bool:
         try:
             return (self.changes == other.changes) and (self.uri == other.uri)
@@ -367,76 +439,48 @@ class WorkspaceEdit():
     def __repr__(self):
         return "<WorkspaceEdit(changes={:d})>".format(len(self.changes))
 
+class EncodedResult(list):
+    __slots__ = ("encoded",)
+
+    def __init__(self, items: List, encoded: bytes):
+        '''A list result that was serialized ahead of time, so it can be sent again without encoding it again.
+        It still behaves like the list it was built from, but must not be modified
+
+        :items: Items in the result
+        :encoded: The items serialized as JSON
+        '''
+        super().__init__(items)
+        self.encoded = encoded
+
+    def __repr__(self):
+        return "<EncodedResult(items={:d}, bytes={:d})>".format(len(self), len(self.encoded))
+
+# type => function converting instances of that type to something JSON can serialize
+_ENCODERS = {
+    cls: cls.to_json for cls in (
+        CompletionItem, Diagnostic, Hover, Location, MarkupContent,
+        Position, Range, ResponseError, TextEdit, WorkspaceEdit
+    )
+}
+_ENCODERS[MarkupKind] = lambda o: o.value
+
+def to_json(o):
+    '''Convert a protocol object to something JSON can serialize
+
+    Raises a TypeError for any other kind of object
+    '''
+    encode = _ENCODERS.get(type(o))
+    if encode is None:
+        # subclasses of the protocol types are rare, so only check for them after the lookup fails
+        for cls, cls_encode in _ENCODERS.items():
+            if isinstance(o, cls):
+                encode = cls_encode
+                break
+        else:
+            raise TypeError("Object of type {} is not JSON serializable".format(type(o).__name__))
+    return encode(o)
+
 class JSONEncoder(json.JSONEncoder):
     ''' Custom JSON encoder '''
     def default(self, o):
-        final_dict = {}
-        # TODO: Define a "json_encoded" method in each class and just call that
-        if isinstance(o, CompletionItem):
-            final_dict = {
-                "label": o.label,
-                "kind": o.kind,
-                "insertText": o.insertText,
-                "detail": o.detail
-            }
-        elif isinstance(o, Diagnostic):
-            final_dict = {
-                "message": o.message,
-                "range": o.range,
-                "relatedInformation": o.relatedInformation,
-                "severity": o.severity
-            }
-        elif isinstance(o, Hover):
-            if hasattr(o, "range"):
-                final_dict = {
-                    "range": o.range,
-                    "contents": o.contents
-                }
-            else:
-                final_dict = {
-                    "contents": o.contents
-                }
-        elif isinstance(o, Location):
-            final_dict = {
-                "range": o.range,
-                "uri": o.uri
-            }
-        elif isinstance(o, MarkupContent):
-            final_dict = {
-                "kind": o.kind,
-                "value": o.value
-            }
-        elif isinstance(o, MarkupKind):
-            return o.value
-        elif isinstance(o, Position):
-            final_dict = {
-                "line": o.line,
-                "character": o.char
-            }
-        elif isinstance(o, Range):
-            final_dict = {
-                "start": o.start,
-                "end": o.end
-            }
-        elif isinstance(o, ResponseError):
-            final_dict = {
-                "code": o.code,
-                "message": o.message,
-                "data": o.data
-            }
-        elif isinstance(o, TextEdit):
-            final_dict = {
-                "range": o.range,
-                "newText": o.newText
-            }
-        elif isinstance(o, WorkspaceEdit):
-            final_dict = {
-                "changes": {
-                    o.uri: o.changes
-                }
-            }
-        else:
-            # if we get down here a TypeError will be thrown by the base class
-            # because this encoder doesn't recognize the type
-            super().default(o)
-        return final_dict
+        return to_json(o)
@@ -4,11 +4,21 @@ A basic implementation of the Language Server Protocol
 '''
 import asyncio
 from enum import IntEnum
+from functools import partial
 import json
 import logging
+from typing import Awaitable, Callable, Optional, Tuple, Union
+from weakref import WeakKeyDictionary
 
 from . import errors as ce
 from . import protocol as lsp
+from .document import TextDocument
+from .framing import FrameParser, OutboundQueue
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class RouteType(IntEnum):
@@ -17,6 +27,202 @@ class RouteType(IntEnum):
     EVENT = 1       # Event notification from the client, such as 'didChange', 'didSave', etc.
     COMMAND = 2     # Command to provide
 
+class DocumentQueue():
+    '''Schedules a connection's work so that messages about the same document are handled in order,
+       while work on different documents runs concurrently
+
+    Requests only read a document, so they wait for earlier notifications about it but not for each other.
+    Notifications change the document, so they wait for everything before them.
+    At most max_tasks scheduled tasks run at the same time
+    '''
+    def __init__(self, max_tasks: int):
+        self._semaphore = asyncio.Semaphore(max_tasks)
+        # file_uri => (task of the last notification, tasks of the requests since then)
+        self._documents = {}
+
+    async def _run(self, factory: Callable[[], Awaitable], waits_for: list):
+        ''' Wait for earlier work on the same document, then run once there's room '''
+        if waits_for:
+            await asyncio.wait(waits_for)
+        async with self._semaphore:
+            return await factory()
+
+    def _forget(self, file_uri: str, task: asyncio.Task):
+        ''' Stop tracking a document once all of its work has finished '''
+        last_write, reads = self._documents.get(file_uri, (None, []))
+        if task in reads:
+            reads.remove(task)
+        if not reads and (last_write is None or last_write.done()):
+            self._documents.pop(file_uri, None)
+
+    def schedule(self, factory: Callable[[], Awaitable], file_uri: Optional[str]=None, writes: bool=False) -> asyncio.Task:
+        '''Run a coroutine as a task, after any earlier work on the same document
+
+        :factory: Called with no arguments to create the coroutine once it is ready to run
+        :file_uri: (Optional) URI of the document the work is about. Work without one is never held back
+        :writes: (Optional) True if the work changes the document, such as a didChange notification
+        '''
+        last_write, reads = self._documents.get(file_uri, (None, []))
+        waits_for = [last_write] + reads if writes else [last_write]
+        waits_for = [task for task in waits_for if task is not None and not task.done()]
+        task = asyncio.get_event_loop().create_task(self._run(factory, waits_for))
+        if file_uri:
+            if writes:
+                self._documents[file_uri] = (task, [])
+            else:
+                reads.append(task)
+                self._documents[file_uri] = (last_write, reads)
+            task.add_done_callback(partial(self._forget, file_uri))
+        return task
+
+
+class JSONCodec():
+    '''Converts JSON-RPC messages to and from the UTF-8 bytes sent over the wire, using the standard library
+
+    Output is compact and non-ASCII text is sent as UTF-8 rather than escaped
+    '''
+    name = "json"
+
+    def __init__(self):
+        # reused for every outgoing message, which skips creating an encoder each time
+        self._encoder = lsp.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def encode(self, message) -> bytes:
+        ''' Serialize a message to bytes '''
+        try:
+            return self._encoder.encode(message).encode("utf-8")
+        except UnicodeEncodeError:
+            # unpaired surrogates can only be sent as escape sequences
+            return json.dumps(message, cls=lsp.JSONEncoder).encode("utf-8")
+
+    def decode(self, data: Union[bytes, memoryview]):
+        ''' Deserialize a message from bytes. Raises a ValueError if they are not valid JSON '''
+        return json.loads(str(data, "utf-8"))
+
+
+class OrjsonCodec(JSONCodec):
+    '''Converts JSON-RPC messages using orjson, which does the work in native code
+
+    Produces the same bytes as JSONCodec. Anything orjson refuses, such as unpaired surrogates
+    or integers wider than 64 bits, is handed to JSONCodec instead. Floats are the one exception:
+    orjson drops the "+" and leading zero from exponents and writes null for NaN and Infinity,
+    which no message sent by the server contains
+    '''
+    name = "orjson"
+
+    def encode(self, message) -> bytes:
+        try:
+            return orjson.dumps(message, default=lsp.to_json)
+        except TypeError:
+            return super().encode(message)
+
+    def decode(self, data: Union[bytes, memoryview]):
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # the standard library accepts a little more, such as NaN and very large integers
+            return super().decode(data)
+
+
+def get_codec(name: Optional[str]=None) -> JSONCodec:
+    '''Create the codec with the given name, or the fastest one available
+
+    :name: (Optional) "json" or "orjson". Defaults to orjson when it is installed
+    '''
+    if name is None:
+        name = "json" if orjson is None else "orjson"
+    if name == "orjson":
+        if orjson is None:
+            raise ce.NoDependencyFound("orjson is not installed")
+        return OrjsonCodec()
+    if name == "json":
+        return JSONCodec()
+    raise ValueError("Unknown JSON codec: {}".format(name))
+
+
+class _PipeWriterProtocol(asyncio.Protocol):
+    ''' Keeps track of when a pipe can be written to again, and when it has closed '''
+    def __init__(self):
+        loop = asyncio.get_event_loop()
+        self.closed = loop.create_future()
+        self._drained = loop.create_future()
+        self._drained.set_result(None)
+
+    def pause_writing(self):
+        if self._drained.done():
+            self._drained = asyncio.get_event_loop().create_future()
+
+    def resume_writing(self):
+        if not self._drained.done():
+            self._drained.set_result(None)
+
+    def connection_lost(self, exc):
+        self.resume_writing()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    async def drain(self):
+        ''' Wait until the pipe's buffer is below its high water mark '''
+        if self.closed.done():
+            raise ConnectionResetError("Connection lost")
+        await asyncio.shield(self._drained)
+
+
+class PipeWriter():
+    '''Write to a pipe through the parts of the StreamWriter interface the server uses
+
+    asyncio only has public APIs for building StreamWriters on sockets, so pipes get their own writer
+    '''
+    def __init__(self, transport: asyncio.WriteTransport, protocol: _PipeWriterProtocol):
+        self.transport = transport
+        self._protocol = protocol
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+    def writelines(self, data: list):
+        self.transport.writelines(data)
+
+    def can_write_eof(self) -> bool:
+        return self.transport.can_write_eof()
+
+    def write_eof(self):
+        self.transport.write_eof()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    async def drain(self):
+        ''' Wait until it's appropriate to write to the pipe again '''
+        await self._protocol.drain()
+
+    async def wait_closed(self):
+        ''' Wait until the pipe has closed '''
+        await asyncio.shield(self._protocol.closed)
+
+
+async def open_pipe_streams(read_pipe, write_pipe) -> Tuple[asyncio.StreamReader, PipeWriter]:
+    '''Wrap a pair of pipes in streams like the ones a TCP connection would get, such as stdin and stdout
+
+    Pipes need an event loop that supports them. On Windows that is the ProactorEventLoop, which
+    asyncio uses by default from Python 3.8. Other loops raise NotImplementedError
+
+    :read_pipe: File object the client writes messages to
+    :write_pipe: File object the client reads messages from
+    '''
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), read_pipe)
+    transport, protocol = await loop.connect_write_pipe(_PipeWriterProtocol, write_pipe)
+    return reader, PipeWriter(transport, protocol)
+
+
 class LanguageServer():
     '''
     Abstracts some of the functions needed to build a JSON-RPC language server
@@ -25,6 +231,11 @@ class LanguageServer():
     ENCODING = "utf-8"
     EOL=b"\r\n"
     MAX_LINE = 10000
+    # number of bytes to read from a client at a time
+    READ_SIZE = 64 * 1024
+    # bytes waiting to be sent to a client before writers have to wait for them to drain, and how far they have to drain
+    WRITE_HIGH_WATER = 1024 * 1024
+    WRITE_LOW_WATER = 256 * 1024
 
     def __init__(self):
         ''' Handle the details of the Language Server Protocol '''
@@ -34,6 +245,12 @@ class LanguageServer():
         self.command_handlers = {}
         self.event_handlers = {}
         self.request_handlers = {}
+        # converts messages to and from bytes
+        self.codec = get_codec()
+        # StreamReader => parser holding the bytes read from it that haven't been handled yet
+        self._parsers = WeakKeyDictionary()
+        # StreamWriter => messages waiting to be written to it
+        self._outbound = WeakKeyDictionary()
 
     def _exc_handler(self, loop, context: dict):
         ''' Appropriately handle exceptions '''
@@ -63,34 +280,49 @@ class LanguageServer():
             self._logger.exception(err)
 
     async def event_cancel(self, has_started: bool, **kwargs):
-        ''' Ignore cancellation requests for now until I can figure out how to cancel tasks '''
+        '''Cancel a request that is still running.
+           The request's task replies with a REQUEST_CANCELLED error once it stops
+        '''
         try:
             if has_started:
                 message = kwargs.pop("message", {})
+                tasks = kwargs.pop("tasks", {})
                 params = message.get("params", {})
                 msg_id = int(params.get("id"))
                 task_name = "Message-{:d}".format(msg_id)
                 self._logger.debug("Client requested cancellation for %s", task_name)
+                # removing the task from the registry marks it as cancelled by the client
+                entry = tasks.pop(task_name, None)
+                if entry is None:
+                    self._logger.debug("%s already finished", task_name)
+                else:
+                    entry[1].cancel()
         except ValueError as err:
             self._logger.warning("Could not convert message ID to integer: %s", err)
         except Exception as err:
             self._logger.warning("Ignoring error that occurred during task cancellation: %s", err)
 
     async def event_did_change(self, has_started: bool, **kwargs):
-        '''If file has new unsaved changes, start tracking it as dirty,
+        '''Apply new unsaved changes to the tracked copy of a file,
            so other commands will continue to work with appropriate text locations
         '''
         message = kwargs.pop("message", {})
         params = message.get("params", {})
-        file_uri = params.get("textDocument", {}).get("uri", None)
+        text_document = params.get("textDocument", {})
+        file_uri = text_document.get("uri", None)
         if has_started and file_uri:
-            self._logger.debug("Adding %s to dirty files list", file_uri)
             dirty_files = kwargs.pop("dirty_files", {})
-            for changes in params.get("contentChanges", []):
-                # full text is submitted with each change
-                change = changes.get("text", None)
-                if change:
-                    dirty_files[file_uri] = change
+            changes = params.get("contentChanges", [])
+            document = dirty_files.get(file_uri)
+            if not isinstance(document, TextDocument):
+                if any("range" in change for change in changes) and document is None:
+                    # incremental changes can't be applied without knowing the original text
+                    self._logger.warning("Ignoring incremental changes to %s, which was never opened", file_uri)
+                    return
+                self._logger.debug("Adding %s to dirty files list", file_uri)
+                document = TextDocument(file_uri, document or "")
+                dirty_files[file_uri] = document
+            document.apply_changes(changes, version=text_document.get("version"))
 
     async def event_did_close(self, has_started: bool, **kwargs):
         ''' If file was previously tracked as 'dirty', remove tracking. '''
@@ -104,19 +336,29 @@ class LanguageServer():
                 del dirty_files[file_uri]
                 self._logger.debug("Removed %s from dirty files list", file_uri)
 
+    async def event_did_open(self, has_started: bool, **kwargs):
+        '''Start tracking a newly-opened file, so incremental changes
+           have the original text to be applied against
+        '''
+        message = kwargs.pop("message", {})
+        params = message.get("params", {})
+        text_document = params.get("textDocument", {})
+        file_uri = text_document.get("uri", "")
+        if has_started and file_uri:
+            dirty_files = kwargs.pop("dirty_files", {})
+            dirty_files[file_uri] = TextDocument(file_uri, text_document.get("text", ""), text_document.get("version"))
+            self._logger.debug("Added %s to dirty files list", file_uri)
+
     async def event_did_save(self, has_started: bool, **kwargs):
-        '''If file was previously tracked as 'dirty', remove tracking.
-           If 'compile_on_save' is True, analyze saved document and publish diagnostics
+        '''File contents on disk now match the tracked copy.
+           Tracking continues until the file is closed, since later incremental changes
+           are applied on top of the tracked copy
         '''
         message = kwargs.pop("message", {})
         params = message.get("params", {})
         file_uri = params.get("textDocument", {}).get("uri", "")
         if has_started and file_uri:
-            dirty_files = kwargs.pop("dirty_files", {})
-            # file is no longer dirty after saving
-            if file_uri in dirty_files:
-                del dirty_files[file_uri]
-                self._logger.debug("Removed %s from dirty files list", file_uri)
+            self._logger.debug("Saved %s", file_uri)
 
     async def event_exit(self, has_started: bool, **kwargs):
         ''' Remove client (StreamWriter) from the list of tracked clients and exit process '''
@@ -129,29 +371,75 @@ class LanguageServer():
     async def read_request(self, reader: asyncio.StreamReader) -> dict:
         ''' Read data from the client '''
         # we don't want handle_client() to deal with anything other than dicts
-        request = {}
-        data = await reader.readline()
-        if data:
-            # self._logger.debug("header <= %r", data)
-            key, value = tuple(data.decode(self.ENCODING).strip().split(" "))
-            # read the extra separator after the initial header
-            await reader.readuntil(separator=self.EOL)
-            if key == "Content-Length:":
-                data = await reader.readexactly(int(value))
-            else:
-                data = await reader.readline()
-            self._logger.debug("input <= %r", data)
-            request = json.loads(data.decode(self.ENCODING))
-        return request
+        parser = self._parsers.get(reader)
+        if parser is None:
+            parser = FrameParser()
+            self._parsers[reader] = parser
+        while True:
+            try:
+                body = parser.next_message()
+            except ce.ParseError as err:
+                # there's no telling where the next message starts, so start over with the next read
+                self._logger.error(err)
+                parser.reset()
+                return {}
+            if body is not None:
+                with body:
+                    if self._logger.isEnabledFor(logging.DEBUG):
+                        self._logger.debug("input <= %r", body.tobytes())
+                    try:
+                        return self.codec.decode(body)
+                    except ValueError as err:
+                        self._logger.error("Could not decode message: %s", err)
+                        return {}
+            data = await reader.read(self.READ_SIZE)
+            if not data:
+                if len(parser) > 0:
+                    # the client hung up partway through a message, which will never be completed
+                    self._logger.warning("Client closed with %d bytes of an incomplete message", len(parser))
+                    parser.reset()
+                return {}
+            parser.feed(data)
+
+    def has_buffered_messages(self, reader: asyncio.StreamReader) -> bool:
+        ''' Check if bytes from a client are waiting to be parsed, even though its stream may have closed '''
+        parser = self._parsers.get(reader)
+        return parser is not None and len(parser) > 0
 
     async def remove_client(self, writer: asyncio.StreamWriter):
         ''' Close the cient input & output streams '''
+        await self.flush(writer)
         if writer.can_write_eof():
             writer.write_eof()
         writer.close()
         await writer.wait_closed()
         self._logger.info("Disconnected client")
 
+    def track_request(self, task: asyncio.Task, message: dict, writer: asyncio.StreamWriter, tasks: dict):
+        '''Keep a running request in the connection's registry as "Message-{id}" until it finishes
+
+        If it is removed from the registry and cancelled, such as by event_cancel(),
+        the client is sent a REQUEST_CANCELLED error in place of the response
+
+        :task: Task that handles the request and sends its response
+        :message: Request message from the client
+        :writer: Transport stream to write responses to
+        :tasks: Registry of the connection's running requests: task name => (method, task)
+        '''
+        loop = asyncio.get_event_loop()
+        msg_id = message.get("id")
+        task_name = "Message-{}".format(msg_id)
+
+        def _on_done(task: asyncio.Task):
+            if tasks.get(task_name, (None, None))[1] is task:
+                del tasks[task_name]
+            elif task.cancelled() and not writer.is_closing():
+                self._logger.debug("Cancelled %s", task_name)
+                loop.create_task(self.send_error(lsp.JsonRPCError.REQUEST_CANCELLED, msg_id, "Request cancelled", writer))
+
+        task.add_done_callback(_on_done)
+        tasks[task_name] = (message.get("method", ""), task)
+
     def route(self, request: str, method, request_type: RouteType=RouteType.FEATURE):
         '''Route JSON-RPC requests to the appropriate method
 
@@ -160,7 +448,7 @@ class LanguageServer():
         :request_type: string. Type of request being handled.
         '''
         method_object_name = method.__self__.__class__.__name__
-        logging.debug("Routing '%s' to '%s.%s()'", request, method_object_name, method.__name__)
+        self._logger.debug("Routing '%s' to '%s.%s()'", request, method_object_name, method.__name__)
         if request_type == RouteType.EVENT:
             self.event_handlers[request] = method
         elif request_type == RouteType.COMMAND:
@@ -170,32 +458,36 @@ class LanguageServer():
 
     async def send_error(self, code: int, curr_id: int, msg: str, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC error message to the client '''
-        message = json.dumps({
+        message = self.encode_message({
             "jsonrpc": "2.0",
             "id": curr_id,
             "error": {
                 "code": code,
                 "message": msg
             }
-        }, cls=lsp.JSONEncoder)
+        })
         await self.write_data(message, writer)
 
     async def send_notification(self, method: str, params: dict, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC notification to the client '''
-        message = json.dumps({
+        message = self.encode_message({
             "jsonrpc": "2.0",
             "method": method,
             "params": params
-        }, cls=lsp.JSONEncoder)
+        })
         await self.write_data(message, writer)
 
     async def send_response(self, curr_id: int, response: dict, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC response to the client '''
-        message = json.dumps({
-            "jsonrpc": "2.0",
-            "id": curr_id,
-            "result": response,
-        }, cls=lsp.JSONEncoder)
+        if isinstance(response, lsp.EncodedResult):
+            # the result was serialized ahead of time, so only the rest of the message needs to be
+            message = b'{"jsonrpc":"2.0","id":%b,"result":%b}' % (self.encode_message(curr_id), response.encoded)
+        else:
+            message = self.encode_message({
+                "jsonrpc": "2.0",
+                "id": curr_id,
+                "result": response,
+            })
         await self.write_data(message, writer)
 
     async def shutdown(self, message: dict, has_started: bool, **kwargs):
@@ -210,8 +502,31 @@ class LanguageServer():
             # explicitly clear the dirty files on shutdown
             dirty_files.clear()
 
-    async def write_data(self, message: str, writer: asyncio.StreamWriter):
-        ''' Write a JSON-RPC message to the given stream with the proper encoding and formatting '''
-        self._logger.debug("output => %r", message.encode(self.ENCODING))
-        writer.write("Content-Length: {:d}\r\n\r\n{:s}".format(len(message), message).encode(self.ENCODING))
-        await writer.drain()
+    def encode_message(self, message: dict) -> bytes:
+        ''' Serialize a JSON-RPC message straight to the bytes sent to the client '''
+        return self.codec.encode(message)
+
+    async def write_data(self, message: Union[str, bytes], writer: asyncio.StreamWriter):
+        '''Write a JSON-RPC message to the given stream with the proper encoding and formatting
+
+        :message: Serialized message, either as text or already encoded bytes
+        :writer: Transport stream to write the message to
+        '''
+        if isinstance(message, str):
+            message = message.encode(self.ENCODING)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("output => %r", message)
+        # messages are batched together, so a burst of them costs a single write and drain
+        queue = self._outbound.get(writer)
+        if queue is None:
+            queue = OutboundQueue(writer, self.WRITE_HIGH_WATER, self.WRITE_LOW_WATER)
+            self._outbound[writer] = queue
+        # Content-Length counts bytes, not characters
+        queue.put(b"Content-Length: %d\r\n\r\n" % len(message), message)
+        await queue.wait()
+
+    async def flush(self, writer: asyncio.StreamWriter):
+        ''' Wait until every message written to a stream has been sent to the client '''
+        queue = self._outbound.get(writer)
+        if queue is not None:
+            await queue.flush()
@@ -0,0 +1,206 @@
+''' Compile YARA rules in worker processes, away from the event loop '''
+from collections import OrderedDict
+import hashlib
+import importlib
+import json
+import os
+import re
+from typing import List, Optional, Tuple
+
+from .base import protocol as lsp
+from .base.document import TextDocument
+from . import helpers
+from .index import get_rule_index
+
+# import and include statements are shared by every rule in a document
+DIRECTIVE_PATTERN = re.compile(r'^\s*(?:import|include)\s+"')
+INCLUDE_PATTERN = re.compile(r'^\s*include\s+"', re.MULTILINE)
+IDENTIFIER_PATTERN = re.compile(r"\b\w+\b")
+
+# (severity, zero-based line number, first non-whitespace character, message)
+CompileResult = Tuple[int, int, int, str]
+# (first line of the chunk in its document, line of the document each header line was copied from
+#  if the chunk is the one reporting problems with it, or None, source)
+RuleChunk = Tuple[int, List[Optional[int]], str]
+
+
+def init_worker(pids):
+    '''Report the ID of a new worker process, so the server can stop it if a compile never finishes
+
+    :pids: Queue shared with the server
+    '''
+    pids.put(os.getpid())
+
+def compile_source(source: str, externals: dict=None) -> List[CompileResult]:
+    '''Compile YARA rules and return any errors or warnings. Safe to run in another process
+
+    :source: Text of the YARA rules to compile
+    :externals: (Optional) external variables to define for the rules
+    '''
+    # weird way to get around Python compiler that thinks yara is not installed
+    yara = importlib.import_module("yara")
+    try:
+        yara.compile(source=source, externals=externals or {})
+    except yara.SyntaxError as error:
+        return [_to_result(source, lsp.DiagnosticSeverity.ERROR, str(error))]
+    except yara.WarningError as warning:
+        return [_to_result(source, lsp.DiagnosticSeverity.WARNING, str(warning))]
+    return []
+
+def compile_chunks(chunks: List[RuleChunk]) -> List[CompileResult]:
+    '''Compile chunks from split_rules() one at a time, so every broken rule is reported.
+       Safe to run in another process
+
+    :chunks: Chunks to compile. Line numbers in the results refer to the original document
+    '''
+    results = []
+    for first_line, header, source in chunks:
+        for severity, line_no, first_char, msg in compile_source(source):
+            if line_no >= len(header):
+                results.append((severity, line_no - len(header) + first_line, first_char, msg))
+            elif header[line_no] is not None:
+                # problems in a header are reported by the chunk the statement came from, at its own line
+                results.append((severity, header[line_no], first_char, msg))
+    return results
+
+def split_rules(document: TextDocument) -> List[RuleChunk]:
+    '''Split a document into chunks that can be compiled independently of each other
+
+    Anything before the first rule is one chunk. Every rule is another, preceded by a header
+    with a line for each of the document's imports and includes, plus a line of stubs for the
+    rules declared before it that it references, so that the rule still compiles on its own.
+    Rules declared after it are not stubbed, since YARA doesn't allow references to them
+
+    :document: Document to split up
+    '''
+    lines = document.lines
+    rules = get_rule_index(document).rules
+    directives = [(line_no, line.strip()) for line_no, line in enumerate(lines) if DIRECTIVE_PATTERN.match(line)]
+    declared = set()
+    chunks = []
+    first_rule = rules[0].start_line if rules else len(lines)
+    if first_rule > 0:
+        chunks.append((0, [], "\n".join(lines[:first_rule])))
+    for rule in rules:
+        # the header already has every directive, so blank any in the rule to keep its line numbers
+        body = ["" if DIRECTIVE_PATTERN.match(line) else line for line in lines[rule.start_line:rule.chunk_end+1]]
+        referenced = set(IDENTIFIER_PATTERN.findall("\n".join(body))) & declared
+        referenced.discard(rule.name)
+        declared.add(rule.name)
+        stubs = ["private rule {} {{ condition: false }}".format(name) for name in sorted(referenced)]
+        # only directives from this rule's own lines are reported by it. Those before the first rule are compiled in place
+        header = [line_no if rule.start_line <= line_no <= rule.chunk_end else None for line_no, _ in directives] + [None]
+        source = [directive for _, directive in directives] + [" ".join(stubs)] + body
+        chunks.append((rule.start_line, header, "\n".join(source)))
+    return chunks
+
+def find_duplicate_rules(document: TextDocument) -> List[CompileResult]:
+    '''Report rules declared more than once, which compiling rules independently cannot catch
+
+    :document: Document to check
+    '''
+    index = get_rule_index(document)
+    results = []
+    for rule in index.rules:
+        if index.definitions(rule.name)[0] is not rule:
+            first_char = helpers.get_first_non_whitespace_index(document.get_line(rule.start_line))
+            msg = "duplicated identifier \"{}\"".format(rule.name)
+            results.append((int(lsp.DiagnosticSeverity.ERROR), rule.start_line, first_char or 0, msg))
+    return results
+
+def to_diagnostics(results: List[CompileResult], max_line: int) -> List[lsp.Diagnostic]:
+    '''Convert compile results into Diagnostics
+
+    :results: Results from compile_source()
+    :max_line: Character to end each diagnostic's range at
+    '''
+    diagnostics = []
+    for severity, line_no, first_char, msg in results:
+        symbol_range = lsp.Range(
+            start=lsp.Position(line_no, first_char),
+            end=lsp.Position(line_no, max_line)
+        )
+        diagnostics.append(lsp.Diagnostic(locrange=symbol_range, severity=severity, message=msg))
+    return diagnostics
+
+def _to_result(source: str, severity: int, result: str) -> CompileResult:
+    ''' Parse a YARA error or warning into a CompileResult '''
+    line_no, msg = helpers.parse_result(result)
+    # VSCode is zero-indexed
+    line_no -= 1
+    first_char = helpers.get_first_non_whitespace_index(helpers.to_document(source).get_line(line_no))
+    return int(severity), line_no, first_char or 0, msg
+
+
+class DiagnosticCache():
+    '''Least recently used cache of the diagnostics for documents that have already been compiled
+
+    Entries are keyed on a hash of the document's text, the yara-python version and any
+    externals, so unchanged documents are never compiled twice. The cache is bounded by both
+    its number of entries and the approximate encoded size of the diagnostics it holds.
+    Documents that include other files are never cached, since the files they include can
+    change without the document changing
+    '''
+    def __init__(self, max_entries: int=1024, max_bytes: int=16*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        # key => (diagnostics, size)
+        self._entries = OrderedDict()
+        self._version = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, source: str, externals: dict=None, mode: str="") -> Optional[str]:
+        '''Compute the cache key for a document, or None if it includes other files and can't be cached
+
+        :source: Text of the YARA rules
+        :externals: (Optional) external variables the rules are compiled with
+        :mode: (Optional) name of the way the rules are compiled, such as "rules" for per-rule compiles
+        '''
+        if INCLUDE_PATTERN.search(source):
+            return None
+        if self._version is None:
+            self._version = getattr(importlib.import_module("yara"), "__version__", "")
+        digest = hashlib.sha256()
+        digest.update("{}\0{}\0".format(self._version, mode).encode("utf-8"))
+        digest.update(json.dumps(externals or {}, sort_keys=True).encode("utf-8"))
+        digest.update(source.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[List[lsp.Diagnostic]]:
+        ''' Cached diagnostics for a key, or None if the document has not been compiled yet or can't be cached '''
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return list(entry[0])
+
+    def put(self, key: Optional[str], diagnostics: List[lsp.Diagnostic]):
+        ''' Cache the diagnostics for a key, evicting the least recently used entries to stay within bounds '''
+        if key is None:
+            return
+        size = len(key) + len(json.dumps(diagnostics, cls=lsp.JSONEncoder))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (list(diagnostics), size)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    def clear(self):
+        ''' Drop every cached entry and reset the counters '''
+        self._entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
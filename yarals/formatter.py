@@ -0,0 +1,179 @@
+''' Format YARA rules with plyara, one rule at a time, in worker processes away from the event loop '''
+from bisect import bisect_right
+from collections import OrderedDict
+import importlib
+from typing import List, Optional, Tuple
+
+from .base import errors as ce
+from .base.document import TextDocument
+from .index import get_rule_index
+
+# (first line of the chunk in its document, text of the chunk)
+FormatChunk = Tuple[int, str]
+# (first line, last line, rule name, text rebuilt by plyara), with lines relative to the start of its chunk
+FormattedRule = Tuple[int, int, str, str]
+
+# parsers that are ready to be used again. Building one generates plyara's lexer and parser tables
+_PARSERS = []
+
+
+def acquire_parser():
+    ''' Take a parser from the pool, building a new one if every parser is in use '''
+    if _PARSERS:
+        return _PARSERS.pop()
+    plyara = importlib.import_module("plyara")
+    return plyara.Plyara(store_raw_sections=True)
+
+def release_parser(parser):
+    '''Return a parser to the pool, ready to parse something else
+
+    plyara's own clear() also regenerates the lexer and parser tables, which takes
+    far longer than parsing a typical rule, so only the parsed state is reset here.
+    That state is plyara's own, which is why requirements.txt pins its version
+    '''
+    parser.rules = []
+    parser.current_rule = {}
+    # rules keep references to some of these, so replace them instead of clearing them
+    for name in ("string_modifiers", "imports", "includes", "terms", "scopes", "tags", "comments", "_rule_comments", "_stringnames"):
+        setattr(parser, name, type(getattr(parser, name))())
+    for name in ("_raw_input", "_meta_start", "_meta_end", "_strings_start", "_strings_end", "_condition_start", "_condition_end"):
+        setattr(parser, name, None)
+    parser.lexer.lineno = 1
+    parser.lexer.begin("INITIAL")
+    _PARSERS.append(parser)
+
+def init_worker():
+    ''' Import plyara and build a parser when a worker process starts, rather than on its first request '''
+    release_parser(acquire_parser())
+
+def format_chunk(text: str, first_line: int=0) -> List[FormattedRule]:
+    '''Parse the rules in a chunk of a document and rebuild each of them
+
+    :text: Text of the chunk
+    :first_line: (Optional) line of the document the chunk starts on,
+                 so that any parsing errors refer to the right line
+    '''
+    plyara_utils = importlib.import_module("plyara.utils")
+    parser = acquire_parser()
+    # plyara counts lines from one
+    parser.lexer.lineno = first_line + 1
+    rules = list(parser.parse_string(text))
+    # a parser that raised an error may be left in any state, so only reuse it after a successful parse
+    release_parser(parser)
+    results = []
+    for rule in rules:
+        # imports are kept where they are, rather than copied into every rule that uses them
+        rule.pop("imports", None)
+        # by default plyara appends a newline - it is removed here and added back according to the format options
+        formatted_text = plyara_utils.rebuild_yara_rule(rule).rstrip("\n")
+        results.append((rule["start_line"] - 1 - first_line, rule["stop_line"] - 1 - first_line, rule["rule_name"], formatted_text))
+    return results
+
+def split_chunks(document: TextDocument, start_line: int=0, end_line: Optional[int]=None) -> List[FormatChunk]:
+    '''Split a document into chunks that can be parsed independently of each other
+
+    Anything before the first rule is one chunk, and every rule is another, running up
+    to the next rule's declaration. Unlike compiler.split_rules(), chunks are left as-is,
+    so that unchanged rules are found in the cache wherever they are in the document
+
+    :document: Document to split up
+    :start_line: (Optional) only include chunks with lines from here...
+    :end_line: (Optional) ...up to and including this line. Defaults to the end of the document
+    '''
+    lines = document.lines
+    index = get_rule_index(document)
+    if end_line is None:
+        end_line = len(lines) - 1
+    chunks = []
+    first_rule = index.rules[0].start_line if index.rules else len(lines)
+    if first_rule > 0 and start_line < first_rule:
+        chunks.append((0, "\n".join(lines[:first_rule])))
+    for rule in index.rules_between(start_line, end_line):
+        chunks.append((rule.start_line, "\n".join(lines[rule.start_line:rule.chunk_end+1])))
+    return chunks
+
+
+def format_run(chunks: List[FormatChunk]) -> List[List[FormattedRule]]:
+    '''Parse chunks that follow one another in their document all at once, and split up the results.
+       Safe to run in another process
+
+    Each call into plyara has some overhead, so this is quicker than formatting each chunk on its own.
+    plyara's own exceptions can't be sent back from another process, so errors are raised as FormatParseErrors
+
+    :chunks: Chunks to format, with no lines missing between them
+    '''
+    plyara = importlib.import_module("plyara")
+    first_line = chunks[0][0]
+    starts = [start - first_line for start, _ in chunks]
+    results = [[] for _ in chunks]
+    try:
+        rules = format_chunk("\n".join(text for _, text in chunks), first_line)
+    except plyara.exceptions.ParseError as err:
+        raise ce.FormatParseError(str(err))
+    for start_line, stop_line, rule_name, formatted_text in rules:
+        index = max(bisect_right(starts, start_line) - 1, 0)
+        offset = starts[index]
+        results[index].append((start_line - offset, stop_line - offset, rule_name, formatted_text))
+    return results
+
+def group_chunks(chunks: List[Tuple[int, FormatChunk]], max_lines: int) -> List[List[Tuple[int, FormatChunk]]]:
+    '''Group chunks into runs that format_run() can parse at once
+
+    A run ends at a gap between chunks, or once it has at least the given number of lines,
+    so that a large document is spread over several worker processes
+
+    :chunks: Chunks to group, each with a number to tell them apart, in the order they appear in the document
+    :max_lines: Number of lines to stop adding chunks to a run at
+    '''
+    runs = []
+    lines = 0
+    for item in chunks:
+        first_line, text = item[1]
+        if runs and lines < max_lines:
+            prev_line, prev_text = runs[-1][-1][1]
+            if first_line == prev_line + prev_text.count("\n") + 1:
+                runs[-1].append(item)
+                lines += text.count("\n") + 1
+                continue
+        runs.append([item])
+        lines = text.count("\n") + 1
+    return runs
+
+
+class FormatCache():
+    '''Least recently used cache of the rules plyara rebuilt from each chunk of a document
+
+    Entries are keyed on the chunk's text, so a rule is only parsed again once it changes,
+    no matter how much the rest of the document has changed around it
+    '''
+    def __init__(self, max_entries: int=16384):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # chunk text => formatted rules
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, text: str) -> Optional[List[FormattedRule]]:
+        ''' Cached rules for a chunk's text, or None if it has not been formatted yet '''
+        rules = self._entries.get(text)
+        if rules is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(text)
+        return rules
+
+    def put(self, text: str, rules: List[FormattedRule]):
+        ''' Cache the formatted rules for a chunk, evicting the least recently used entries to stay within bounds '''
+        self._entries[text] = rules
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        ''' Drop every cached entry and reset the counters '''
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -1,10 +1,14 @@
 ''' Helper functions that don't quite fit elsewhere '''
+from functools import lru_cache
+import os
+from pathlib import Path
 import re
-from typing import Tuple
+from typing import Iterator, Pattern, Tuple, Union
 from urllib.parse import quote, unquote, urlsplit
 from urllib.request import url2pathname
 
 from yarals.base import protocol as lsp
+from yarals.base.document import TextDocument
 
 
 def create_file_uri(path: str):
@@ -15,6 +19,17 @@ def create_file_uri(path: str):
     # if this is a windows path, the slashes need to be reversed
     return "file://{}".format(quote(str(path).replace("\\", "/"), safe="/\\"))
 
+def find_rule_files(folder: Path) -> Iterator[Path]:
+    '''Find every YARA rule file under a given folder
+
+    :folder: Folder to recursively search for *.yara and *.yar files
+    '''
+    # walk the folder once and check both extensions, rather than globbing for each
+    for root, _, filenames in os.walk(str(folder)):
+        for filename in filenames:
+            if filename.endswith((".yara", ".yar")):
+                yield Path(root).joinpath(filename)
+
 def get_first_non_whitespace_index(line: str) -> int:
     '''Get the first non-whitespace character index in a given line
 
@@ -25,16 +40,16 @@ def get_first_non_whitespace_index(line: str) -> int:
             # self._logger.debug("first char is {} at position {:d}".format(char, index))
             return index
 
-def get_rule_range(document: str, pos: lsp.Position) -> lsp.Range:
+def get_rule_range(document: Union[str, TextDocument], pos: lsp.Position) -> lsp.Range:
     '''Get the range of the YARA rule that a given symbol is in
 
-    :document: Text to search in
+    :document: Text or TextDocument to search in
                To determine line numbers, text is split at newlines, and carriage returns are ignored
     :pos: Symbol position to base range off of
     '''
     start_pattern = re.compile(r"^((private|global) )?rule\b")
-    end_pattern = re.compile("^}$")
-    lines = document.replace("\r", "").split("\n")
+    end_pattern = re.compile("^}\r?$")
+    lines = to_document(document).lines
     # default to assuming the entire document is within range
     start_pos = lsp.Position(line=0, char=0)
     end_pos = lsp.Position(line=len(lines), char=0)
@@ -74,15 +89,15 @@ def parse_uri(uri: str, encoding="utf-8"):
         url = urlsplit(unquote(uri, encoding=encoding))
         return url2pathname(url.path)
 
-def resolve_symbol(document: str, pos: lsp.Position) -> str:
+def resolve_symbol(document: Union[str, TextDocument], pos: lsp.Position) -> str:
     '''Resolve a symbol located at the given position
 
-    :document: Text to search in
+    :document: Text or TextDocument to search in
                To determine line numbers, text is split at newlines, and carriage returns are ignored
     :pos: Symbol position to base range off of
     '''
     try:
-        symbol_line = document.split("\n")[pos.line]
+        symbol_line = to_document(document).get_line(pos.line)
         line_end = len(symbol_line)
         # find the left-bound of the symbol by looking backwards until a whitespace
         index = pos.char - 1
@@ -105,3 +120,27 @@ def resolve_symbol(document: str, pos: lsp.Position) -> str:
         return symbol_line[left_bound:right_bound]
     except IndexError:
         return ""
+
+@lru_cache(maxsize=256)
+def symbol_pattern(kind: str, symbol: str) -> Pattern:
+    '''Compile the regex that finds a symbol, keeping the most recently used patterns
+
+    :kind: "rule" to search text for uses of a rule name,
+           or "string" to match whole string identifiers (without their leading "$")
+    :symbol: Symbol to find. YARA wildcards ("*") match the rest of an identifier
+    '''
+    # replace the YARA wildcard with a Python re equivalent, which stays inside one identifier
+    pattern = re.escape(symbol).replace(r"\*", r"\w*?")
+    if kind == "rule":
+        pattern = r"\b{}\b".format(pattern)
+    return re.compile(pattern)
+
+def to_document(document: Union[str, TextDocument], uri: str="") -> TextDocument:
+    '''Wrap plain text in a TextDocument, so its line index can be shared between features
+
+    :document: Text or TextDocument. TextDocuments are returned as-is
+    :uri: (Optional) URI to give a newly-created TextDocument
+    '''
+    if isinstance(document, TextDocument):
+        return document
+    return TextDocument(uri, str(document))
@@ -0,0 +1,392 @@
+''' Indexes of the YARA rules defined in a document or across a workspace '''
+from bisect import bisect_right
+import re
+from typing import Dict, List, Optional
+from weakref import WeakKeyDictionary
+
+from .base import protocol as lsp
+from .base.document import TextDocument
+
+# start of a rule declaration, such as "private rule Name : tag1 tag2"
+HEADER_PATTERN = re.compile(r"^\s*((?:(?:private|global)\s+)*)rule\s+(\w+)")
+SECTION_PATTERN = re.compile(r"\b(meta|strings|condition)\s*:")
+# every token a rule is scanned for, in one pass: string definitions, which are only recognized
+# at the start of a line or after whitespace, uses of "$", "#", "@" and "!" string identifiers,
+# and any other identifier, such as the name of a rule
+TOKEN_PATTERN = re.compile(r"(?:^|(?<=\s))\$(\w*)[ \t]*=[ \t]?|[$#@!](\w*\*?)|(\w+)")
+
+# rule indexes are kept alongside the document they were built from
+_INDEXES = WeakKeyDictionary()
+
+
+class StringInfo():
+    ''' Definition and uses of a string identifier within a rule '''
+    def __init__(self, name: str, definition: lsp.Range):
+        self.name = name
+        self.definition = definition
+        self.uses = []
+
+    @property
+    def name_range(self) -> lsp.Range:
+        ''' Location of the identifier's name in its definition '''
+        start = self.definition.start
+        return lsp.Range(start=start, end=lsp.Position(line=start.line, char=start.char + len(self.name)))
+
+    def __repr__(self):
+        return "<StringInfo(name={}, uses={:d})>".format(self.name, len(self.uses))
+
+
+class RuleInfo():
+    '''A single rule in a document
+
+    The rule's own text is parsed into sections, string identifiers and the positions of
+    every other identifier the first time they are needed. Positions are kept relative to the start of the rule, so the rule
+    can be moved around by edits elsewhere in the document without being parsed again
+    '''
+    def __init__(self, name: str, modifiers: List[str], start_line: int, name_char: int, lines: List[str]):
+        self.name = name
+        self.modifiers = modifiers
+        self.start_line = start_line
+        self._name_char = name_char
+        # number of lines up to the closing brace, and up to the next rule declaration
+        self._length = len(lines)
+        self._end = self._find_end(lines)
+        self._lines = lines
+        self._sections = None
+        self._strings = None
+        self._identifiers = None
+        self._starts = None
+
+    @staticmethod
+    def _find_end(lines: List[str]) -> int:
+        ''' Relative line of the closing brace, or the last line if there is none '''
+        for index in range(len(lines) - 1, -1, -1):
+            if lines[index].rstrip().endswith("}"):
+                return index
+        return len(lines) - 1
+
+    @property
+    def end_line(self) -> int:
+        ''' Line of the rule's closing brace '''
+        return self.start_line + self._end
+
+    @property
+    def chunk_end(self) -> int:
+        ''' Last line before the next rule declaration '''
+        return self.start_line + self._length - 1
+
+    @property
+    def range(self) -> lsp.Range:
+        ''' Lines spanned by the rule, from its declaration to its closing brace '''
+        return lsp.Range(
+            start=lsp.Position(line=self.start_line, char=0),
+            end=lsp.Position(line=self.end_line, char=0)
+        )
+
+    @property
+    def name_range(self) -> lsp.Range:
+        ''' Location of the rule's name in its declaration '''
+        return lsp.Range(
+            start=lsp.Position(line=self.start_line, char=self._name_char),
+            end=lsp.Position(line=self.start_line, char=self._name_char + len(self.name))
+        )
+
+    def _parse(self):
+        '''Split the rule into sections and collect its string identifiers and other identifiers
+
+        Everything is found in a single scan over the rule's text. Identifiers are collected
+        up to the next rule declaration, so that they are also found in trailing comments
+        '''
+        text = "\n".join(self._lines)
+        starts = [0]
+        for line in self._lines[:-1]:
+            starts.append(starts[-1] + len(line) + 1)
+        # sections and strings end at the closing brace
+        rule_end = starts[self._end] + len(self._lines[self._end]) if self._lines else 0
+
+        def _position(offset: int) -> tuple:
+            line = bisect_right(starts, offset) - 1
+            return line, offset - starts[line]
+
+        self._sections = {}
+        matches = list(SECTION_PATTERN.finditer(text, 0, rule_end))
+        for index, match in enumerate(matches):
+            end = matches[index+1].start() if index + 1 < len(matches) else rule_end
+            self._sections.setdefault(match.group(1), (match.start(), end))
+        strings_start, strings_end = self._sections.get("strings", (0, 0))
+        condition_start, condition_end = self._sections.get("condition", (0, 0))
+        self._strings = {}
+        # identifiers are the bulk of the tokens, so only their offsets are kept until they are looked up
+        self._identifiers = identifiers = {}
+        for match in TOKEN_PATTERN.finditer(text):
+            if match.lastindex == 3:
+                identifiers.setdefault(match.group(3), []).append(match.start())
+                continue
+            start = match.start()
+            definition, use = match.group(1, 2)
+            if definition is not None and strings_start <= start < strings_end:
+                if definition not in self._strings:
+                    # the definition range skips the leading "$" and runs through the "=" sign
+                    self._strings[definition] = (_position(start + 1), _position(match.end()), [])
+            elif condition_start <= start < condition_end:
+                name = use if use is not None else definition
+                if name in self._strings:
+                    self._strings[name][2].append((_position(start + 1), _position(start + 1 + len(name))))
+        self._starts = starts
+        self._sections = {name: (_position(start), _position(end)) for name, (start, end) in self._sections.items()}
+
+    def _to_range(self, start: tuple, end: tuple) -> lsp.Range:
+        ''' Convert a pair of relative (line, char) tuples into a Range '''
+        return lsp.Range(
+            start=lsp.Position(line=self.start_line + start[0], char=start[1]),
+            end=lsp.Position(line=self.start_line + end[0], char=end[1])
+        )
+
+    @property
+    def sections(self) -> Dict[str, lsp.Range]:
+        ''' Ranges of the rule's meta, strings and condition sections '''
+        if self._sections is None:
+            self._parse()
+        return {name: self._to_range(start, end) for name, (start, end) in self._sections.items()}
+
+    @property
+    def strings(self) -> Dict[str, StringInfo]:
+        ''' String identifiers (without their leading "$") defined in the rule '''
+        if self._strings is None:
+            self._parse()
+        strings = {}
+        for name, (def_start, def_end, uses) in self._strings.items():
+            info = StringInfo(name, self._to_range(def_start, def_end))
+            info.uses = [self._to_range(start, end) for start, end in uses]
+            strings[name] = info
+        return strings
+
+    @property
+    def identifiers(self) -> List[str]:
+        ''' Every distinct identifier in the rule, including keywords and rule names '''
+        if self._identifiers is None:
+            self._parse()
+        return list(self._identifiers)
+
+    def occurrences(self, name: str) -> List[lsp.Range]:
+        ''' Every place an identifier, such as a rule name, appears in full in the rule '''
+        if self._identifiers is None:
+            self._parse()
+        locranges = []
+        for offset in self._identifiers.get(name, []):
+            line = bisect_right(self._starts, offset) - 1
+            char = offset - self._starts[line]
+            locranges.append(self._to_range((line, char), (line, char + len(name))))
+        return locranges
+
+    def __repr__(self):
+        return "<RuleInfo(name={}, start_line={:d}, end_line={:d})>".format(self.name, self.start_line, self.end_line)
+
+
+class RuleIndex():
+    '''Index of every rule in a document
+
+    After the first build, the index is updated from the document's edit log,
+    so only the rules around each edited line are scanned again
+    '''
+    def __init__(self):
+        self.revision = None
+        self.rules = []
+        self._by_name = {}
+        # identifier => rules it appears in, built on the first lookup after each update
+        self._identifiers = None
+        self._starts = []
+
+    def _scan(self, lines: List[str], start: int, end: int) -> List[RuleInfo]:
+        ''' Find the rules declared between the start and end lines (exclusive) '''
+        headers = []
+        for index in range(start, end):
+            match = HEADER_PATTERN.match(lines[index])
+            if match:
+                headers.append((index, match))
+        rules = []
+        for count, (index, match) in enumerate(headers):
+            chunk_end = headers[count+1][0] if count + 1 < len(headers) else end
+            modifiers = match.group(1).split()
+            rules.append(RuleInfo(match.group(2), modifiers, index, match.start(2), lines[index:chunk_end]))
+        return rules
+
+    def _rebuild(self, document: TextDocument):
+        ''' Index the whole document from scratch '''
+        self.rules = self._scan(document.lines, 0, document.line_count)
+
+    @staticmethod
+    def _extent(entry) -> tuple:
+        ''' First and last line covered by a rule or dirty span '''
+        if isinstance(entry, RuleInfo):
+            return entry.start_line, entry.chunk_end
+        return entry[0], entry[1]
+
+    def _apply_edits(self, document: TextDocument, edits: list):
+        '''Update the index for a list of (start line, old end line, new end line) edits
+
+        Rules overlapping an edit, and the rule right before it, are dropped and their
+        lines are marked as dirty. Rules after an edit are shifted by the number of lines
+        added or removed. Finally, every dirty span is scanned again up to the next rule
+        that was kept
+        '''
+        # entries are either RuleInfo objects or [start, end] lists for dirty spans
+        entries = list(self.rules)
+        for start, old_end, new_end in edits:
+            delta = new_end - old_end
+            # the first entry reaching the edit, plus the one before it
+            first = 0
+            while first < len(entries) and self._extent(entries[first])[1] < start:
+                first += 1
+            first = max(first - 1, 0)
+            last = first
+            lo, hi = start, new_end
+            while last < len(entries) and self._extent(entries[last])[0] <= old_end:
+                entry_start, entry_end = self._extent(entries[last])
+                lo = min(lo, entry_start)
+                hi = max(hi, entry_end + delta if entry_end > old_end else entry_end)
+                last += 1
+            for entry in entries[last:]:
+                if isinstance(entry, RuleInfo):
+                    entry.start_line += delta
+                else:
+                    entry[0] += delta
+                    entry[1] += delta
+            entries[first:last] = [[lo, hi]]
+        # scan each dirty span up to the start of the next rule that was kept
+        self.rules = []
+        index = 0
+        while index < len(entries):
+            entry = entries[index]
+            if isinstance(entry, RuleInfo):
+                self.rules.append(entry)
+                index += 1
+                continue
+            following = index + 1
+            while following < len(entries) and not isinstance(entries[following], RuleInfo):
+                following += 1
+            end = entries[following].start_line if following < len(entries) else document.line_count
+            self.rules.extend(self._scan(document.lines, entry[0], end))
+            index = following
+
+    def update(self, document: TextDocument):
+        ''' Bring the index up to date with the given document '''
+        if self.revision == document.revision:
+            return
+        edits = document.edits_since(self.revision) if self.revision is not None else None
+        if edits is None:
+            self._rebuild(document)
+        else:
+            self._apply_edits(document, edits)
+        self.revision = document.revision
+        self._identifiers = None
+        self._by_name = {}
+        for rule in self.rules:
+            self._by_name.setdefault(rule.name, []).append(rule)
+        self._starts = [rule.start_line for rule in self.rules]
+
+    def definitions(self, name: str) -> List[RuleInfo]:
+        ''' Rules declared with the given name '''
+        return self._by_name.get(name, [])
+
+    def references(self, name: str) -> List[lsp.Range]:
+        '''Every place an identifier, such as a rule name, appears in full in the document's rules
+
+        Rules are only scanned for identifiers once, and again after they change
+        '''
+        if self._identifiers is None:
+            self._identifiers = {}
+            for rule in self.rules:
+                for identifier in rule.identifiers:
+                    self._identifiers.setdefault(identifier, []).append(rule)
+        return [locrange for rule in self._identifiers.get(name, []) for locrange in rule.occurrences(name)]
+
+    def rules_between(self, start: int, end: int) -> List[RuleInfo]:
+        ''' Rules with any of their lines between the start and end lines (inclusive) '''
+        first = max(bisect_right(self._starts, start) - 1, 0)
+        last = bisect_right(self._starts, end)
+        return [rule for rule in self.rules[first:last] if rule.chunk_end >= start]
+
+    def rule_at(self, line: int) -> Optional[RuleInfo]:
+        ''' Rule containing the given line, if there is one '''
+        index = bisect_right(self._starts, line) - 1
+        if index >= 0 and line <= self.rules[index].chunk_end:
+            return self.rules[index]
+        return None
+
+
+def get_rule_index(document: TextDocument) -> RuleIndex:
+    '''Get the up-to-date rule index for a document
+
+    :document: Document to index. Indexes are cached for as long as the document exists
+    '''
+    index = _INDEXES.get(document)
+    if index is None:
+        index = RuleIndex()
+        _INDEXES[document] = index
+    index.update(document)
+    return index
+
+
+class WorkspaceIndex():
+    '''Index of the rule names declared in every file of a workspace
+
+    Maps each rule name to the files and ranges it is declared at, so looking up a
+    definition is a dictionary lookup instead of a read of every file. Files are
+    re-indexed lazily: changes only mark a file as stale until the next lookup
+    '''
+    def __init__(self):
+        # rule name => {file_uri => [name ranges]}
+        self._definitions = {}
+        # file_uri => rule names declared in it
+        self._files = {}
+        # file_uri => TextDocument waiting to be re-indexed
+        self._stale = {}
+
+    def __contains__(self, file_uri: str) -> bool:
+        return file_uri in self._files or file_uri in self._stale
+
+    def _index(self, file_uri: str, document: TextDocument):
+        ''' Replace the indexed rules for a file with the ones in the given document '''
+        self._unindex(file_uri)
+        names = []
+        for rule in get_rule_index(document).rules:
+            self._definitions.setdefault(rule.name, {}).setdefault(file_uri, []).append(rule.name_range)
+            names.append(rule.name)
+        self._files[file_uri] = names
+
+    def _unindex(self, file_uri: str):
+        ''' Drop every indexed rule for a file '''
+        for name in self._files.pop(file_uri, []):
+            files = self._definitions.get(name, {})
+            files.pop(file_uri, None)
+            if not files:
+                self._definitions.pop(name, None)
+
+    def _flush(self):
+        ''' Re-index every file that changed since the last lookup '''
+        while self._stale:
+            file_uri, document = self._stale.popitem()
+            self._index(file_uri, document)
+
+    def update_file(self, file_uri: str, document: TextDocument):
+        '''Mark a file as changed, to be re-indexed from the given document on the next lookup
+
+        :file_uri: URI of the file that changed
+        :document: Current contents of the file
+        '''
+        self._stale[file_uri] = document
+
+    def remove_file(self, file_uri: str):
+        ''' Stop tracking the rules declared in a deleted file '''
+        self._stale.pop(file_uri, None)
+        self._unindex(file_uri)
+
+    def definitions(self, name: str) -> List[lsp.Location]:
+        ''' Locations of every rule declared with the given name, across the workspace '''
+        self._flush()
+        return [
+            lsp.Location(locrange, file_uri)
+            for file_uri, locranges in self._definitions.get(name, {}).items()
+            for locrange in locranges
+        ]
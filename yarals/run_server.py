@@ -1,4 +1,4 @@
-''' Example script for running the YARA Language Server on a specific host/port '''
+''' Example script for running the YARA Language Server on a specific host/port, or over stdio '''
 #!/usr/bin/env python3
 import argparse
 import asyncio
@@ -6,7 +6,10 @@ import logging
 import logging.handlers
 from os import environ
 from pathlib import Path
+import sys
 
+from yarals.base import errors as ce
+from yarals.base.server import open_pipe_streams
 from yarals.yarals import YaraLanguageServer
 
 try:
@@ -22,11 +25,15 @@ def _build_cli():
     # default log file path is ~/.yara.log
     default_log_path = str(Path(environ.get("HOME")).joinpath(".yara.log"))
     parser = argparse.ArgumentParser(description="Start the YARA language server")
-    parser.add_argument("host", help="Interface to bind server to")
-    parser.add_argument("port", type=int, help="Port to bind server to")
+    parser.add_argument("host", nargs="?", help="Interface to bind server to")
+    parser.add_argument("port", nargs="?", type=int, help="Port to bind server to")
+    parser.add_argument("--stdio", action="store_true", help="Talk to a single client over stdin/stdout instead of binding to a port. Not supported on Windows")
     parser.add_argument("--log", "-l", default=default_log_path, help="Path to the log file")
     parser.add_argument("--verbose", "-v", action="count", default=0, help="Controls the verbosity of logs sent to the screen. All messages are sent to log file")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.stdio and (args.host is None or args.port is None):
+        parser.error("host and port are required unless --stdio is given")
+    return args
 
 def _build_logger(log_file: str, verbosity: int=0):
     ''' Configure the loggers appropriately '''
@@ -34,7 +41,8 @@ def _build_logger(log_file: str, verbosity: int=0):
     for lvl in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
         logging.addLevelName(getattr(logging, lvl), lvl.capitalize())
     yara_logger = logging.getLogger("yara")
-    screen_hdlr = logging.StreamHandler()
+    # stdout may be carrying messages to the client, so logs only ever go to stderr
+    screen_hdlr = logging.StreamHandler(sys.stderr)
     screen_fmt = logging.Formatter("[%(levelname)-5s - %(asctime)s] %(name)s.%(module)s : %(message)s", datefmt="%-H:%M:%S %p")
     screen_hdlr.setFormatter(screen_fmt)
     screen_log_lvl = logging.ERROR
@@ -59,6 +67,22 @@ async def run_server():
     logger = _build_logger(args.log, args.verbose)
     try:
         yarals = YaraLanguageServer()
+        if args.stdio:
+            logger.info("Starting YARA IO language server on stdio")
+            try:
+                reader, writer = await open_pipe_streams(sys.stdin, sys.stdout)
+            except (NotImplementedError, OSError) as err:
+                # such as on Windows, where the event loop can't wait on stdin/stdout
+                logger.error("Could not use stdio, connect with a host and port instead: %r", err)
+                return
+            try:
+                await yarals.handle_client(reader, writer)
+            except (ce.ServerExit, CancelledError):
+                logger.info("Server has successfully shutdown")
+            finally:
+                if not writer.is_closing():
+                    await yarals.remove_client(writer)
+            return
         logger.info("Starting YARA IO language server")
         socket_server = await asyncio.start_server(
             client_connected_cb=yarals.handle_client,
@@ -82,4 +106,4 @@ def main():
 
 
 if __name__ == "__main__":
-    run_server()
+    main()
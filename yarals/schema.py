@@ -0,0 +1,116 @@
+''' Completion data for the modules that YARA rules can import '''
+from bisect import bisect_left
+from functools import lru_cache
+import json
+from pathlib import Path
+from typing import List, Optional
+
+from .base import protocol as lsp
+
+# extra YARA module data from this path
+SCHEMA = Path(__file__).parent.joinpath("data", "modules.json").resolve()
+
+
+class SchemaNode():
+    '''One level of the module schema, such as the members of the "pe" module
+
+    Names are kept sorted so prefixes can be found with a binary search, and the
+    completion items offered for each name are built once, when the schema is loaded
+    '''
+    __slots__ = ("children", "names", "ranks", "items")
+
+    def __init__(self):
+        # name => node for each member that has members of its own
+        self.children = {}
+        # every member name, sorted
+        self.names = []
+        # name => position in the schema file, so results keep the file's order
+        self.ranks = {}
+        # name => completion items offered when the name matches
+        self.items = {}
+
+    def matches(self, prefix: str) -> List[str]:
+        ''' Member names starting with the given prefix, in the order they appear in the schema '''
+        if not prefix:
+            return list(self.ranks)
+        names = []
+        index = bisect_left(self.names, prefix)
+        while index < len(self.names) and self.names[index].startswith(prefix):
+            names.append(self.names[index])
+            index += 1
+        return sorted(names, key=self.ranks.__getitem__)
+
+
+class ModuleSchema():
+    '''Prefix tree of every module member, such as "pe.is_dll" or "cuckoo.network.dns_lookup"
+
+    :data: Parsed contents of the schema file
+    :separator: Character between the parts of a member's name, also used in each item's detail
+    '''
+    def __init__(self, data: dict, separator: str="."):
+        self.separator = separator
+        self.root = self._build(data, ())
+
+    def _item(self, label: str, item_type, path: tuple) -> lsp.CompletionItem:
+        ''' Completion item for a single member of the given type '''
+        item_type = str(item_type).lower()
+        if item_type == "enum":
+            return lsp.CompletionItem(label, lsp.CompletionItemKind.ENUM, detail=self.separator.join(path + (label,)))
+        if item_type == "property":
+            return lsp.CompletionItem(label, lsp.CompletionItemKind.PROPERTY, detail=self.separator.join(path + (label,)))
+        if item_type == "function":
+            snippet = "{}()".format(label)
+            return lsp.CompletionItem(label, lsp.CompletionItemKind.FUNCTION, insertText=snippet, detail=self.separator.join(path + (snippet,)))
+        # desired output: cuckoo.filesystem
+        return lsp.CompletionItem(label, lsp.CompletionItemKind.CLASS, detail=self.separator.join(path + (label,)))
+
+    def _build(self, members: dict, path: tuple) -> SchemaNode:
+        ''' Build the node for a level of the schema, and every level below it '''
+        node = SchemaNode()
+        for rank, (name, value) in enumerate(members.items()):
+            node.ranks[name] = rank
+            if isinstance(value, dict):
+                # completing a member with members of its own offers all of those members
+                node.children[name] = self._build(value, path + (name,))
+                node.items[name] = [self._item(label, item_type, path + (name,)) for label, item_type in value.items()]
+            elif isinstance(value, list):
+                # some module items are dictionaries with pre-set keys, such as pe.version_info,
+                # so show the user a snippet for each key. desired output: pe.version_info["CompanyName"]
+                items = []
+                for label in value:
+                    snippet = "{}[\"{}\"]".format(name, label)
+                    detail = self.separator.join(path + (snippet,))
+                    items.append(lsp.CompletionItem(label, lsp.CompletionItemKind.INTERFACE, detail=detail, insertText=snippet))
+                node.items[name] = items
+            else:
+                node.items[name] = [self._item(name, value, path)]
+        node.names = sorted(members)
+        return node
+
+    def node(self, path: List[str]) -> Optional[SchemaNode]:
+        ''' Node for a fully-typed member name, split into its parts, or None if there isn't one '''
+        node = self.root
+        for name in path:
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def complete(self, symbols: List[str]) -> List[lsp.CompletionItem]:
+        '''Completion items for a partially-typed member name
+
+        :symbols: Parts of the name. Every part but the last must be complete, and the last one is a prefix
+        '''
+        node = self.node(symbols[:-1])
+        if node is None:
+            return []
+        return [item for name in node.matches(symbols[-1]) for item in node.items[name]]
+
+
+@lru_cache(maxsize=None)
+def get_schema(separator: str=".") -> ModuleSchema:
+    '''Get the module schema, reading it from disk the first time it is needed
+
+    :separator: (Optional) character between the parts of a member's name
+    '''
+    return ModuleSchema(json.loads(SCHEMA.read_text()), separator)
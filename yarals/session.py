@@ -0,0 +1,75 @@
+''' State kept for each connected client, and state shared between clients working in the same folder '''
+import asyncio
+from pathlib import Path
+from typing import List, Optional
+
+from .base import protocol as lsp
+from .index import WorkspaceIndex
+
+
+class SharedWorkspace():
+    '''Everything built from the files on disk in a workspace folder
+
+    One of these is shared by every client with the same workspace folder open, so the
+    folder is only indexed once. It is reference counted, and dropped once the last
+    client working in the folder disconnects
+    '''
+    def __init__(self, root: Optional[Path]):
+        self.root = root
+        # index of the rules saved on disk. Unsaved changes are kept in each session instead
+        self.index = WorkspaceIndex()
+        # task building the index, started by the first client to open the folder
+        self.indexing = None
+        self.refs = 0
+
+    def __repr__(self):
+        return "<SharedWorkspace(root={}, refs={:d})>".format(self.root, self.refs)
+
+
+class Session():
+    '''Everything that belongs to a single client connection
+
+    Nothing in a session is visible to other clients, including unsaved changes
+    to documents that are also open in another client
+    '''
+    def __init__(self, workspace: SharedWorkspace, writer: Optional[asyncio.StreamWriter]=None):
+        self.workspace = workspace
+        self.writer = writer
+        self.has_started = False
+        self.config = {}
+        # file_uri => TextDocument for every file the client has open or changed
+        self.dirty_files = {}
+        # index of the rules in the client's unsaved documents, which takes precedence over the workspace index
+        self.index = WorkspaceIndex()
+        # "Message-{id}" => (method, task) for each of the client's requests that are still running
+        self.tasks = {}
+        self.hover_langs = [lsp.MarkupKind.Markdown, lsp.MarkupKind.Plaintext]
+        # file_uri => future for the compile of that file's latest version
+        self.compiles = {}
+        # file_uri => task waiting to publish diagnostics for that file's latest changes
+        self.pending_diagnostics = {}
+
+    @property
+    def root(self) -> Optional[Path]:
+        ''' Workspace folder the client opened, if it opened one '''
+        return self.workspace.root
+
+    def definitions(self, name: str) -> List[lsp.Location]:
+        ''' Locations of every rule declared with the given name, as this client sees the workspace '''
+        results = [loc for loc in self.workspace.index.definitions(name) if loc.uri not in self.index]
+        results.extend(self.index.definitions(name))
+        return results
+
+    def close(self):
+        ''' Stop any work still running for the client '''
+        # requests leave the registry by themselves once they finish
+        for _, task in self.tasks.values():
+            task.cancel()
+        for task in list(self.pending_diagnostics.values()) + list(self.compiles.values()):
+            task.cancel()
+        self.pending_diagnostics.clear()
+        self.compiles.clear()
+        self.dirty_files.clear()
+
+    def __repr__(self):
+        return "<Session(root={}, dirty_files={:d})>".format(self.root, len(self.dirty_files))
@@ -1,18 +1,31 @@
 ''' Implements the language server for YARA '''
 import asyncio
-from copy import deepcopy
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 import importlib
-from itertools import chain
 import json
 import logging
+import multiprocessing
+import os
 from pathlib import Path
 import re
+import signal
 import sys
+from typing import Optional, Union
 
 from .base import protocol as lsp
 from .base import errors as ce
-from .base.server import LanguageServer, RouteType
+from .base.document import TextDocument
+from .base.server import DocumentQueue, LanguageServer, RouteType
+from . import compiler
+from . import formatter
 from . import helpers
+from .index import get_rule_index
+from .schema import get_schema
+from .session import Session, SharedWorkspace
 
 try:
     # asyncio exceptions changed from 3.6 > 3.7 > 3.8
@@ -23,36 +36,77 @@ except ImportError:
     from concurrent.futures import CancelledError, TimeoutError as AsyncTimeoutError
 
 
-# extra YARA module data from this path
-SCHEMA = Path(__file__).parent.joinpath("data", "modules.json").resolve()
-
 
 class YaraLanguageServer(LanguageServer):
     ''' Implements the language server for YARA '''
     # variable symbols have a few possible first characters
     _varchar = ["$", "#", "@", "!"]
-    hover_langs = [lsp.MarkupKind.Markdown, lsp.MarkupKind.Plaintext]
-    modules = json.loads(SCHEMA.read_text())
     TASK_TIMEOUT = 2.0
+    # a new request for one of these methods replaces any earlier one that is still running
+    SUPERSEDED_METHODS = {"textDocument/documentHighlight", "textDocument/hover"}
+    # most requests and notifications to handle at the same time for a single client
+    MAX_CONCURRENT_TASKS = 16
+    # commands such as CompileAllRules may run for much longer than other requests
+    COMMAND_TIMEOUT = None
+    # number of processes to compile rules in. Defaults to the number of CPUs
+    COMPILE_WORKERS = None
+    # seconds to wait for a single document to compile
+    COMPILE_TIMEOUT = 10.0
+    # seconds to wait after the last change before compiling, when 'compile_on_change' is True
+    DIAGNOSTIC_DELAY = 0.3
+    # bounds for the cache of diagnostics for documents that have already been compiled
+    DIAGNOSTIC_CACHE_ENTRIES = 4096
+    DIAGNOSTIC_CACHE_BYTES = 16 * 1024 * 1024
+    # number of module completion results to keep already serialized
+    COMPLETION_CACHE_ENTRIES = 256
+    # number of rules to keep formatted, so formatting a document again only parses the rules that changed
+    FORMAT_CACHE_ENTRIES = 16384
+    # number of processes to format rules in. Defaults to the number of CPUs
+    FORMAT_WORKERS = None
+    # seconds to wait for rules to be formatted, plus more for every line that has to be parsed
+    FORMAT_TIMEOUT = 2.0
+    FORMAT_TIMEOUT_PER_LINE = 0.0002
+    # lines of rules to parse in a single job, so large documents are spread over every worker
+    FORMAT_BATCH_LINES = 2000
+    # formatting requests wait for their own timeout, scaled to the size of the document, instead of TASK_TIMEOUT
+    FORMATTING_METHODS = {"textDocument/formatting", "textDocument/rangeFormatting", "textDocument/onTypeFormatting"}
 
     def __init__(self):
         ''' Handle the particulars of the server's YARA implementation '''
         super().__init__()
         self._logger = logging.getLogger("yara")
-        self.workspace = False
+        # the compiler processes and compiled results are shared by every client.
+        # number of workers => pool, so a request for a different number never stops jobs running in another pool
+        self._compile_pools = {}
+        self._format_pools = {}
+        # number of workers => semaphore limiting jobs to one per worker, and queue of the workers' process IDs
+        self._compile_slots = {}
+        self._compile_pids = {}
+        self.diagnostic_cache = compiler.DiagnosticCache(self.DIAGNOSTIC_CACHE_ENTRIES, self.DIAGNOSTIC_CACHE_BYTES)
+        # (trigger, symbols) => serialized completion items, shared by every client since the schema never changes
+        self._completion_cache = OrderedDict()
+        self.format_cache = formatter.FormatCache(self.FORMAT_CACHE_ENTRIES)
+        # workspace folder => state shared by every client working in it
+        self._workspaces = {}
+        # session for handlers called outside of a client connection
+        self.session = Session(self._acquire_workspace(None))
         self.route("initialize", self.initialize, request_type=RouteType.FEATURE)
         self.route("shutdown", self.shutdown, request_type=RouteType.FEATURE)
         self.route("workspace/executeCommand", self.execute_command, request_type=RouteType.FEATURE)
         self.route("textDocument/completion", self.provide_code_completion, request_type=RouteType.FEATURE)
         self.route("textDocument/definition", self.provide_definition, request_type=RouteType.FEATURE)
         self.route("textDocument/formatting", self.provide_formatting, request_type=RouteType.FEATURE)
+        self.route("textDocument/rangeFormatting", self.provide_range_formatting, request_type=RouteType.FEATURE)
+        self.route("textDocument/onTypeFormatting", self.provide_on_type_formatting, request_type=RouteType.FEATURE)
         self.route("textDocument/documentHighlight", self.provide_highlight, request_type=RouteType.FEATURE)
         self.route("textDocument/hover", self.provide_hover, request_type=RouteType.FEATURE)
         self.route("textDocument/references", self.provide_reference, request_type=RouteType.FEATURE)
         self.route("textDocument/rename", self.provide_rename, request_type=RouteType.FEATURE)
         self.route("textDocument/didChange", self.event_did_change, request_type=RouteType.EVENT)
         self.route("textDocument/didClose", self.event_did_close, request_type=RouteType.EVENT)
+        self.route("textDocument/didOpen", self.event_did_open, request_type=RouteType.EVENT)
         self.route("textDocument/didSave", self.event_did_save, request_type=RouteType.EVENT)
+        self.route("workspace/didChangeWatchedFiles", self.event_did_change_watched_files, request_type=RouteType.EVENT)
         self.route("exit", self.event_exit, request_type=RouteType.EVENT)
         self.route("$/cancelRequest", self.event_cancel, request_type=RouteType.EVENT)
 
@@ -73,33 +127,47 @@ class YaraLanguageServer(LanguageServer):
     def _get_document(self, file_uri: str, dirty_files: dict) -> str:
         ''' Return the document text for a given file URI either from disk or memory '''
         if file_uri in dirty_files:
-            return dirty_files[file_uri]
+            return str(dirty_files[file_uri])
         file_path = helpers.parse_uri(file_uri, encoding=self.ENCODING)
         with open(file_path, "r") as rule_file:
             return rule_file.read()
 
+    def _get_text_document(self, file_uri: str, dirty_files: dict) -> TextDocument:
+        ''' Return the TextDocument for a given file URI, so its line index can be shared between features '''
+        document = dirty_files.get(file_uri)
+        if isinstance(document, TextDocument):
+            return document
+        return TextDocument(file_uri, self._get_document(file_uri, dirty_files))
+
+    def _read_file(self, file_path: Path) -> str:
+        ''' Read the text of a rule file from disk '''
+        with open(str(file_path), "rb") as rule_file:
+            return rule_file.read().decode(self.ENCODING)
+
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         '''React and respond to client messages
 
         :reader: asyncio StreamReader. The connected client will write to this stream
         :writer: asyncio.StreamWriter. The connected client will read from this stream
         '''
-        config = {}
-        # file_uri => contents
-        dirty_files = {}
-        has_started = False
+        # everything about this client, which other clients can't see
+        session = Session(self._acquire_workspace(None), writer)
+        queue = DocumentQueue(self.MAX_CONCURRENT_TASKS)
         self._logger.info("Client connected")
         self.num_clients += 1
         while True:
             try:
                 # first check if this client is still sending messages
-                if reader.at_eof():
+                if reader.at_eof() and not self.has_buffered_messages(reader):
                     self._logger.info("Client has closed")
                     self.num_clients -= 1
+                    # nobody is waiting on the responses anymore
+                    session.close()
+                    self._release_workspace(session.workspace)
                     break
                 elif self.num_clients <= 0:
                     # clear out memory
-                    dirty_files.clear()
+                    session.dirty_files.clear()
                     # remove connected clients
                     await self.remove_client(writer)
                 # finally read our data
@@ -108,51 +176,134 @@ class YaraLanguageServer(LanguageServer):
                 if "jsonrpc" in message:
                     method = message.get("method", "")
                     self._logger.debug("Client sent a '%s' message", method)
+                    # messages about the same document are handled in the order they were sent
+                    file_uri = self._get_message_uri(message)
                     # if an id is present, this is a JSON-RPC request
                     if "id" in message:
                         # TODO: Only send writer to functions that want it OR rewrite functions to not use writer
                         params = {
-                            "has_started": has_started,
-                            "dirty_files": dirty_files
+                            "config": session.config,
+                            "has_started": session.has_started,
+                            "dirty_files": session.dirty_files,
+                            "session": session
                         }
-                        await self.execute_method(method, message, writer, **params)
+                        if method in self.SUPERSEDED_METHODS:
+                            self._cancel_superseded(method, session.tasks)
+                        # keep reading messages while the request runs, so it can be cancelled
+                        task = queue.schedule(partial(self._handle_request, method, message, writer, **params), file_uri)
+                        self.track_request(task, message, writer, session.tasks)
                     # if no id is present, this is a JSON-RPC notification
                     else:
-                        if method in self.event_handlers:
+                        params = {
+                            "message": message,
+                            "config": session.config,
+                            "dirty_files": session.dirty_files,
+                            "writer": writer,
+                            "session": session
+                        }
+                        if method in self.event_handlers and file_uri:
+                            event = partial(self._handle_event, method, session.has_started, **params)
+                            queue.schedule(event, file_uri, writes=True)
+                        elif method in self.event_handlers:
                             # TODO: Only send writer to event handlers that want it OR rewrite handlers to not use writer
-                            await self.event_handlers[method](has_started, message=message, config=config, dirty_files=dirty_files, writer=writer)
-                        elif not has_started and method == "initialized":
+                            await self.event_handlers[method](session.has_started, tasks=session.tasks, **params)
+                        elif not session.has_started and method == "initialized":
                             # special type of event that just confirms response to 'initialize' request
-                            # ... local variable has_started needs to be modified in this function's context,
+                            # ... the session has to be marked as started before the next message is read,
                             # ... so it's easier to handle here instead of spinning it off to its own handler
                             self._logger.info("Client has been successfully initialized")
-                            has_started = True
+                            session.has_started = True
                             params = {"type": lsp.MessageType.INFO, "message": "Successfully connected"}
                             await self.send_notification("window/showMessageRequest", params, writer)
-                        elif has_started and method == "workspace/didChangeConfiguration":
+                        elif session.has_started and method == "workspace/didChangeConfiguration":
                             # special type of event that modifies the client's tracked configuration
-                            # ... local variable config needs to be modified in this function's context,
+                            # ... the new config has to be in place before the next message is read,
                             # ... so it's easier to handle here instead of spinning it off to its own handler
-                            config = message.get("params", {}).get("settings", {}).get("yara", {})
-                            self._logger.debug("Changed workspace config to %s", json.dumps(config))
+                            session.config = message.get("params", {}).get("settings", {}).get("yara", {})
+                            self._logger.debug("Changed workspace config to %s", json.dumps(session.config))
                         else:
                             # TODO: Figure out what else needs to be done when an unknown event is encountered
                             self._logger.warning("Encountered an unknown notification type '%s'. Ignoring.", method)
-            except ce.NoDependencyFound as warn:
-                self._logger.warning(warn)
-                params = {
-                    "type": lsp.MessageType.WARNING,
-                    "message": str(warn)
-                }
-                await self.send_notification("window/showMessage", params, writer)
-            except (ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, ce.HighlightError, \
-                    ce.HoverError, ce.RenameError, ce.SymbolReferenceError) as err:
-                self._logger.error(err)
-                params = {
-                    "type": lsp.MessageType.ERROR,
-                    "message": str(err)
-                }
-                await self.send_notification("window/showMessage", params, writer)
+            except (ce.NoDependencyFound, ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, \
+                    ce.HighlightError, ce.HoverError, ce.RenameError, ce.SymbolReferenceError) as err:
+                await self._notify_error(err, writer)
+
+    @staticmethod
+    def _get_message_uri(message: dict) -> Optional[str]:
+        ''' URI of the document a message is about, if it is about one '''
+        params = message.get("params")
+        text_document = params.get("textDocument") if isinstance(params, dict) else None
+        return text_document.get("uri") if isinstance(text_document, dict) else None
+
+    async def _handle_request(self, method: str, message: dict, writer: asyncio.StreamWriter, **params):
+        ''' Execute a request and show the user any errors it runs into '''
+        try:
+            await self.execute_method(method, message, writer, **params)
+        except (ce.NoDependencyFound, ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, \
+                ce.HighlightError, ce.HoverError, ce.RenameError, ce.SymbolReferenceError) as err:
+            await self._notify_error(err, writer)
+
+    async def _handle_event(self, method: str, has_started: bool, **kwargs):
+        ''' Handle a notification about a document and show the user any errors it runs into '''
+        try:
+            await self.event_handlers[method](has_started, **kwargs)
+        except (ce.NoDependencyFound, ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, \
+                ce.HighlightError, ce.HoverError, ce.RenameError, ce.SymbolReferenceError) as err:
+            await self._notify_error(err, kwargs["writer"])
+
+    async def _notify_error(self, err: Exception, writer: asyncio.StreamWriter):
+        ''' Show the user an error, or a warning for missing dependencies '''
+        if isinstance(err, ce.NoDependencyFound):
+            self._logger.warning(err)
+            msg_type = lsp.MessageType.WARNING
+        else:
+            self._logger.error(err)
+            msg_type = lsp.MessageType.ERROR
+        params = {
+            "type": msg_type,
+            "message": str(err)
+        }
+        await self.send_notification("window/showMessage", params, writer)
+
+    def _cancel_superseded(self, method: str, tasks: dict):
+        ''' Drop any earlier requests of the same kind, whose results the client no longer needs '''
+        for task_name, (other_method, task) in list(tasks.items()):
+            if other_method == method:
+                self._logger.debug("Dropping stale %s request %s", method, task_name)
+                del tasks[task_name]
+                task.cancel()
+
+    def _get_session(self, kwargs: dict) -> Session:
+        ''' Session of the client a handler was called for '''
+        return kwargs.get("session") or self.session
+
+    def _acquire_workspace(self, root: Optional[Path]) -> SharedWorkspace:
+        ''' Get the shared state for a workspace folder, creating it for the first client to open the folder '''
+        workspace = self._workspaces.get(root)
+        if workspace is None:
+            workspace = SharedWorkspace(root)
+            self._workspaces[root] = workspace
+        workspace.refs += 1
+        return workspace
+
+    def _release_workspace(self, workspace: SharedWorkspace):
+        ''' Drop the shared state for a workspace folder once the last client working in it is gone '''
+        workspace.refs -= 1
+        if workspace.refs <= 0:
+            if workspace.indexing is not None:
+                workspace.indexing.cancel()
+            if self._workspaces.get(workspace.root) is workspace:
+                del self._workspaces[workspace.root]
+
+    def _open_workspace(self, session: Session, root: Optional[Path]) -> SharedWorkspace:
+        ''' Move a session to a workspace folder, indexing the folder if no other client has it open '''
+        workspace = self._acquire_workspace(root)
+        self._release_workspace(session.workspace)
+        session.workspace = workspace
+        if root and workspace.indexing is None:
+            # build the workspace symbol index in the background
+            workspace.indexing = asyncio.get_event_loop().create_task(self._index_workspace(workspace))
+        return workspace
 
     async def initialize(self, message: dict, has_started: bool, **kwargs) -> dict:
         '''Announce language support methods
@@ -163,13 +314,14 @@ class YaraLanguageServer(LanguageServer):
         '''
         # pylint: disable=W0613
         if not has_started:
+            session = self._get_session(kwargs)
             rootdir = helpers.parse_uri(message["params"]["rootUri"], encoding=self.ENCODING)
             if rootdir:
-                self.workspace = Path(rootdir)
-                self._logger.info("Client workspace folder: %s", self.workspace)
+                workspace = self._open_workspace(session, Path(rootdir))
+                self._logger.info("Client workspace folder: %s (shared by %d clients)", workspace.root, workspace.refs)
             else:
                 self._logger.info("No client workspace specified")
-                self.workspace = False
+                self._open_workspace(session, None)
 
             client_options = message.get("params", {}).get("capabilities", {})
             doc_options = client_options.get("textDocument", {})
@@ -187,7 +339,7 @@ class YaraLanguageServer(LanguageServer):
             #     server_options["documentHighlightProvider"] = True
             if doc_options.get("hover", {}).get("dynamicRegistration", False):
                 server_options["hoverProvider"] = True
-                self.hover_langs = doc_options.get("hover", {}).get("contentFormat", self.hover_langs)
+                session.hover_langs = doc_options.get("hover", {}).get("contentFormat", session.hover_langs)
             if ws_options.get("executeCommand", {}).get("dynamicRegistration", False):
                 server_options["executeCommandProvider"] = {
                     "commands": []
@@ -201,35 +353,141 @@ class YaraLanguageServer(LanguageServer):
                     self._logger.warning("yara-python is not installed. Diagnostics and Compile commands are disabled")
             if doc_options.get("formatting", {}).get("dynamicRegistration", False):
                 server_options["documentFormattingProvider"] = True
+            if doc_options.get("rangeFormatting", {}).get("dynamicRegistration", False):
+                server_options["documentRangeFormattingProvider"] = True
+            if doc_options.get("onTypeFormatting", {}).get("dynamicRegistration", False):
+                # format a rule once its closing brace is typed
+                server_options["documentOnTypeFormattingProvider"] = {"firstTriggerCharacter": "}"}
             if doc_options.get("references", {}).get("dynamicRegistration", False):
                 server_options["referencesProvider"] = True
             if doc_options.get("rename", {}).get("dynamicRegistration", False):
                 server_options["renameProvider"] = True
             if doc_options.get("synchronization", {}).get("dynamicRegistration", False):
-                # Documents are synced by always sending the full content of the document
-                server_options["textDocumentSync"] = lsp.TextSyncKind.FULL
+                # Documents are synced by sending only the changed ranges of the document
+                server_options["textDocumentSync"] = lsp.TextSyncKind.INCREMENTAL
             return {"capabilities": server_options}
 
+    async def event_did_change(self, has_started: bool, **kwargs):
+        '''Overrides the base server's event_did_change()
+            Keep the workspace index in sync with unsaved changes
+            and, if 'compile_on_change' is True, schedule diagnostics for the changed document
+        '''
+        await super().event_did_change(has_started, **kwargs)
+        self._update_workspace_index(has_started, **kwargs)
+        config = kwargs.get("config", {})
+        file_uri = kwargs.get("message", {}).get("params", {}).get("textDocument", {}).get("uri", "")
+        document = kwargs.get("dirty_files", {}).get(file_uri)
+        if has_started and config.get("compile_on_change", False) and isinstance(document, TextDocument):
+            # delay is configured in milliseconds
+            delay = config.get("compile_on_change_delay")
+            delay = self.DIAGNOSTIC_DELAY if delay is None else float(delay) / 1000
+            per_rule = config.get("compile_per_rule", False)
+            self._schedule_diagnostics(self._get_session(kwargs), file_uri, document, delay, kwargs.get("writer"), per_rule)
+
+    def _schedule_diagnostics(self, session: Session, file_uri: str, document: TextDocument, delay: float, writer: asyncio.StreamWriter, per_rule: bool=False):
+        '''Publish diagnostics for a document once it has stopped changing for the given delay
+
+        Any diagnostics already scheduled or being compiled for the document are cancelled,
+        so a burst of changes results in a single compile of the latest version
+        '''
+        pending = session.pending_diagnostics.pop(file_uri, None)
+        if pending is not None:
+            pending.cancel()
+        task = asyncio.get_event_loop().create_task(self._publish_diagnostics_later(session, file_uri, document, delay, writer, per_rule))
+        session.pending_diagnostics[file_uri] = task
+
+    async def _publish_diagnostics_later(self, session: Session, file_uri: str, document: TextDocument, delay: float, writer: asyncio.StreamWriter, per_rule: bool=False):
+        ''' Wait out the debounce delay, then compile the document and publish its diagnostics '''
+        try:
+            await asyncio.sleep(delay)
+            revision = document.revision
+            diagnostics = await self.provide_diagnostic(document, file_uri=file_uri, per_rule=per_rule, session=session)
+            # drop results for a version of the document that has since changed
+            if diagnostics is None or document.revision != revision:
+                return
+            params = {
+                "uri": file_uri,
+                "diagnostics": diagnostics
+            }
+            await self.send_notification("textDocument/publishDiagnostics", params, writer)
+        except (ce.DiagnosticError, ce.NoDependencyFound) as err:
+            self._logger.warning("Could not provide diagnostics for %s: %s", file_uri, err)
+        finally:
+            if session.pending_diagnostics.get(file_uri) is asyncio.current_task():
+                del session.pending_diagnostics[file_uri]
+
+    async def event_exit(self, has_started: bool, **kwargs):
+        ''' Stop the compiler and formatter processes before exiting '''
+        if has_started:
+            for pool in list(self._compile_pools.values()) + list(self._format_pools.values()):
+                pool.shutdown(wait=False)
+            self._compile_pools = {}
+            self._format_pools = {}
+        await super().event_exit(has_started, **kwargs)
+
+    async def event_did_change_watched_files(self, has_started: bool, **kwargs):
+        ''' Re-index rule files that were created, changed, or deleted outside of the client '''
+        message = kwargs.pop("message", {})
+        dirty_files = kwargs.pop("dirty_files", {})
+        if has_started:
+            workspace = self._get_session(kwargs).workspace
+            for change in message.get("params", {}).get("changes", []):
+                file_uri = change.get("uri", "")
+                if change.get("type") == lsp.FileChangeType.DELETED:
+                    workspace.index.remove_file(file_uri)
+                # open files are kept up to date by the client's own notifications
+                elif file_uri and file_uri not in dirty_files:
+                    await self._index_file(file_uri, workspace)
+
+    async def event_did_close(self, has_started: bool, **kwargs):
+        '''Overrides the base server's event_did_close()
+            Unsaved changes are discarded on close, so re-index the file from disk
+        '''
+        await super().event_did_close(has_started, **kwargs)
+        session = self._get_session(kwargs)
+        file_uri = kwargs.get("message", {}).get("params", {}).get("textDocument", {}).get("uri", "")
+        pending = session.pending_diagnostics.pop(file_uri, None)
+        if pending is not None:
+            pending.cancel()
+        if has_started and file_uri:
+            session.index.remove_file(file_uri)
+            await self._index_file(file_uri, session.workspace)
+
+    async def event_did_open(self, has_started: bool, **kwargs):
+        '''Overrides the base server's event_did_open()
+            Index the rules in the opened file
+        '''
+        await super().event_did_open(has_started, **kwargs)
+        self._update_workspace_index(has_started, **kwargs)
+
     # @self.route("textDocument/didSave", request_type=RouteType.EVENT)
     async def event_did_save(self, has_started: bool, **kwargs):
         '''Overrides the base server's event_did_save()
-            If file was previously tracked as 'dirty', remove tracking.
             If 'compile_on_save' is True, analyze saved document and publish diagnostics
         '''
-        # first make sure the file is no longer tracked as dirty
         await super().event_did_save(has_started, **kwargs)
+        self._update_workspace_index(has_started, **kwargs)
+        session = self._get_session(kwargs)
         message = kwargs.pop("message", {})
         params = message.get("params", {})
         file_uri = params.get("textDocument", {}).get("uri", "")
+        document = kwargs.get("dirty_files", {}).get(file_uri)
+        if has_started and isinstance(document, TextDocument):
+            # the file on disk now matches the document, so every client sees its rules.
+            # take a copy, since the document keeps changing along with the client's edits
+            session.workspace.index.update_file(file_uri, TextDocument(file_uri, document.text))
         # then do the YARA-specific functionality of publishing diagnostics if configuration is set
         if has_started and file_uri:
             config = kwargs.pop("config", {})
             writer = kwargs.pop("writer")
             if config.get("compile_on_save", False):
                 file_path = helpers.parse_uri(file_uri)
-                with open(file_path, "rb") as ifile:
-                    document = ifile.read().decode(self.ENCODING)
-                diagnostics = await self.provide_diagnostic(document)
+                document = await asyncio.get_event_loop().run_in_executor(None, self._read_file, file_path)
+                per_rule = config.get("compile_per_rule", False)
+                diagnostics = await self.provide_diagnostic(document, file_uri=file_uri, per_rule=per_rule, session=session)
+                if diagnostics is None:
+                    # superseded by a compile of a newer version, which will publish its own diagnostics
+                    return
             else:
                 diagnostics = []
             params = {
@@ -243,9 +501,9 @@ class YaraLanguageServer(LanguageServer):
 
         Returns any results from the command
         '''
+        response = {"result": None}
         try:
             if has_started:
-                response = {"result": None}
                 cmd = message.get("params", {}).get("command", "")
                 args = message.get("params", {}).get("arguments", [])
                 dirty_files = kwargs.pop("dirty_files", {})
@@ -254,8 +512,10 @@ class YaraLanguageServer(LanguageServer):
                     self._logger.info("Compiling rule per user's request")
                 elif cmd == "yara.CompileAllRules":
                     writer = kwargs.pop("writer")
-                    for result in await self._compile_all_rules(dirty_files, self.workspace):
-                        await self.send_notification("textDocument/publishDiagnostics", result, writer)
+                    workers = kwargs.pop("config", {}).get("compile_workers")
+                    # each file's diagnostics are published as soon as they are ready
+                    workspace = self._get_session(kwargs).root
+                    await self._compile_all_rules(dirty_files, workspace, writer=writer, workers=workers)
                     # done with diagnostics - nothing needs to be returned
                 else:
                     self._logger.warning("Unknown command: %s [%s]", cmd, ",".join(args))
@@ -284,7 +544,13 @@ class YaraLanguageServer(LanguageServer):
             # by sending the full request message to each method
             if int(msg_id) >= 0 and method in self.request_handlers:
                 coroutine = self.request_handlers[method]
-                response = await asyncio.wait_for(coroutine(message=message, writer=writer, **params), self.TASK_TIMEOUT)
+                if method == "workspace/executeCommand":
+                    timeout = self.COMMAND_TIMEOUT
+                elif method in self.FORMATTING_METHODS:
+                    timeout = None
+                else:
+                    timeout = self.TASK_TIMEOUT
+                response = await asyncio.wait_for(coroutine(message=message, writer=writer, **params), timeout)
                 # if the method is either of these, the writer has been closed
                 # ... and the client is not reading messages anymore
                 if method not in ("shutdown", "exit"):
@@ -297,29 +563,186 @@ class YaraLanguageServer(LanguageServer):
             # always need to send a response to requests, even if it's just null
             await self.send_response(msg_id, None, writer)
 
+    async def _index_file(self, file_uri: str, workspace: SharedWorkspace):
+        ''' Re-index a rule file from disk, or drop it from the workspace index if it no longer exists '''
+        try:
+            text = await asyncio.get_event_loop().run_in_executor(None, self._get_document, file_uri, {})
+            workspace.index.update_file(file_uri, TextDocument(file_uri, text))
+        except (OSError, UnicodeDecodeError) as err:
+            self._logger.debug("Removing %s from workspace index: %s", file_uri, err)
+            workspace.index.remove_file(file_uri)
+
+    async def _index_workspace(self, workspace: SharedWorkspace):
+        '''Index the rules in every file of the workspace, one file at a time,
+           so other requests continue to be served while the index is being built
+        '''
+        loop = asyncio.get_event_loop()
+        file_paths = await loop.run_in_executor(None, lambda: list(helpers.find_rule_files(workspace.root)))
+        self._logger.info("Indexing %d rule files in %s", len(file_paths), workspace.root)
+        for file_path in file_paths:
+            file_uri = helpers.create_file_uri(file_path)
+            # files that were saved or changed on disk since indexing started are already up to date
+            if file_uri not in workspace.index:
+                await self._index_file(file_uri, workspace)
+        self._logger.info("Finished indexing %s", workspace.root)
+
+    def _update_workspace_index(self, has_started: bool, **kwargs):
+        ''' Mark a tracked document as changed in the client's own view of the workspace '''
+        file_uri = kwargs.get("message", {}).get("params", {}).get("textDocument", {}).get("uri", "")
+        document = kwargs.get("dirty_files", {}).get(file_uri)
+        if has_started and isinstance(document, TextDocument):
+            self._get_session(kwargs).index.update_file(file_uri, document)
+
+    def _get_compile_pool(self, workers: int=None) -> ProcessPoolExecutor:
+        '''Get the pool of worker processes that rules are compiled in, creating it when first needed
+
+        There is a pool for each number of workers asked for. Pools are only shut down when the
+        server exits or a compile in them times out, so jobs still running in one are never
+        stopped by a request for another size
+
+        :workers: (Optional) number of worker processes. Defaults to self.COMPILE_WORKERS, or the CPU count
+        '''
+        workers = workers or self.COMPILE_WORKERS or os.cpu_count() or 1
+        if workers not in self._compile_pools:
+            self._logger.debug("Starting %d compiler processes", workers)
+            self._compile_pids[workers] = multiprocessing.SimpleQueue()
+            self._compile_pools[workers] = ProcessPoolExecutor(
+                max_workers=workers, initializer=compiler.init_worker, initargs=(self._compile_pids[workers],)
+            )
+            self._compile_slots.setdefault(workers, asyncio.Semaphore(workers))
+        return self._compile_pools[workers]
+
+    def _stop_compile_pool(self, workers: int):
+        '''Kill the processes of a compile pool with a job that may never finish, and let the next job start a new pool
+
+        ProcessPoolExecutor can only wait for busy workers to finish, so they are killed with the IDs they reported.
+        Jobs from other requests that were running in the pool fail, and are run again in the new one
+        '''
+        pool = self._compile_pools.pop(workers, None)
+        pids = self._compile_pids.pop(workers, None)
+        if pool is None:
+            return
+        self._logger.warning("Stopping %d compiler processes", workers)
+        while not pids.empty():
+            try:
+                os.kill(pids.get(), signal.SIGTERM)
+            except OSError:
+                pass
+        pool.shutdown(wait=False)
+
+    async def _run_compile(self, workers: int, func, *args):
+        '''Run a compile job in the compiler processes, giving up after self.COMPILE_TIMEOUT seconds
+
+        Jobs wait for a free worker before they are timed, so only time spent compiling counts.
+        A job that times out is stopped along with the rest of its pool
+
+        :workers: Number of worker processes in the pool to compile in
+        :func: Function from the compiler module to run
+        '''
+        loop = asyncio.get_event_loop()
+        self._get_compile_pool(workers)
+        async with self._compile_slots[workers]:
+            while True:
+                pool = self._get_compile_pool(workers)
+                try:
+                    return await asyncio.wait_for(loop.run_in_executor(pool, func, *args), self.COMPILE_TIMEOUT)
+                except BrokenProcessPool:
+                    # the pool was stopped while this job was running, because another job timed out
+                    if self._compile_pools.get(workers) is pool:
+                        self._stop_compile_pool(workers)
+                        raise
+                except AsyncTimeoutError:
+                    if self._compile_pools.get(workers) is pool:
+                        self._stop_compile_pool(workers)
+                    raise
+
+    def _get_format_pool(self, workers: int=None) -> ProcessPoolExecutor:
+        '''Get the pool of worker processes that rules are formatted in, creating it when first needed
+
+        Like the compiler pools, there is one for each number of workers asked for, kept until the server exits
+
+        :workers: (Optional) number of worker processes. Defaults to self.FORMAT_WORKERS, or the CPU count
+        '''
+        workers = workers or self.FORMAT_WORKERS or os.cpu_count() or 1
+        if workers not in self._format_pools:
+            self._logger.debug("Starting %d formatter processes", workers)
+            # each worker builds its parser as soon as it starts, instead of on its first rule
+            self._format_pools[workers] = ProcessPoolExecutor(max_workers=workers, initializer=formatter.init_worker)
+        return self._format_pools[workers]
+
     # @self.route("yara.CompileAllRules", request_type=RouteType.COMMAND)
-    async def _compile_all_rules(self, dirty_files: dict, workspace=None) -> list:
-        # temp copy of filenames => contents
-        # do a deep copy in order to not mess with dirty file contents
-        diagnostics = []
-        documents = deepcopy(dirty_files)
+    async def _compile_all_rules(self, dirty_files: dict, workspace=None, writer=None, workers: int=None) -> list:
+        '''Compile every rule file in the workspace, plus any unsaved documents, in a pool of worker processes
+
+        Returns the diagnostics for every file that has any
+
+        :dirty_files: Documents with unsaved content, which are compiled instead of the files on disk
+        :workspace: (Optional) folder to compile every rule file in
+        :writer: (Optional) StreamWriter to publish each file's diagnostics to as soon as they are ready
+        :workers: (Optional) number of worker processes to compile with
+        '''
+        if not self._is_module_installed("yara"):
+            raise ce.NoDependencyFound("yara-python is not installed. Diagnostics and Compile commands are disabled")
+        loop = asyncio.get_event_loop()
+        workers = workers or self.COMPILE_WORKERS or os.cpu_count() or 1
+
+        async def _compile(document=None, file_path: Path=None) -> list:
+            ''' Compile a single document, or read it from disk first, skipping any unchanged since their last compile '''
+            if document is None:
+                document = await loop.run_in_executor(None, self._read_file, file_path)
+            key = self.diagnostic_cache.key(str(document))
+            diagnostics = self.diagnostic_cache.get(key)
+            if diagnostics is None:
+                results = await self._run_compile(workers, compiler.compile_source, str(document))
+                diagnostics = compiler.to_diagnostics(results, self.MAX_LINE)
+                self.diagnostic_cache.put(key, diagnostics)
+            return diagnostics
+
+        # task => file_uri for every file being compiled
+        jobs = {}
+        for file_uri, document in dirty_files.items():
+            jobs[loop.create_task(_compile(document=document))] = file_uri
         if workspace:
             self._logger.info("Compiling all rules in %s per user's request", workspace)
-            for file_path in chain(workspace.glob("**/*.yara"), workspace.glob("**/*.yar")):
+            file_paths = await loop.run_in_executor(None, lambda: list(helpers.find_rule_files(workspace)))
+            for file_path in file_paths:
                 file_uri = helpers.create_file_uri(file_path)
-                documents[file_uri] = self._get_document(file_uri, dirty_files)
+                if file_uri not in dirty_files:
+                    jobs[loop.create_task(_compile(file_path=file_path))] = file_uri
         else:
             self._logger.warning("No workspace specified. CompileAllRules will only work on open docs")
             self._logger.info("Compiling all unsaved files per user's request")
-            documents = dirty_files
-        # documents should be a list of file contents
-        for file_uri, document in documents.items():
-            diagnostic = await self.provide_diagnostic(document)
-            if diagnostic:
-                diagnostics.append({
-                    "uri": file_uri,
-                    "diagnostics": diagnostic
-                })
+        diagnostics = []
+        pending = set(jobs)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    file_uri = jobs[task]
+                    try:
+                        file_diagnostics = task.result()
+                    except AsyncTimeoutError:
+                        # checked first, as asyncio's TimeoutError is an OSError from Python 3.11
+                        self._logger.warning("Compiling %s took longer than %s seconds", file_uri, self.COMPILE_TIMEOUT)
+                        continue
+                    except (OSError, UnicodeDecodeError) as err:
+                        self._logger.warning("Could not read %s: %s", file_uri, err)
+                        continue
+                    except Exception as err:
+                        self._logger.error(err)
+                        raise ce.DiagnosticError("Could not compile rule: {}".format(err))
+                    if file_diagnostics:
+                        result = {
+                            "uri": file_uri,
+                            "diagnostics": file_diagnostics
+                        }
+                        diagnostics.append(result)
+                        if writer:
+                            await self.send_notification("textDocument/publishDiagnostics", result, writer)
+        finally:
+            # stop compiling if the request was cancelled or timed out
+            for task in pending:
+                task.cancel()
         return diagnostics
 
     async def provide_code_completion(self, message: dict, has_started: bool, **kwargs) -> list:
@@ -331,9 +754,8 @@ class YaraLanguageServer(LanguageServer):
             params = message.get("params", {})
             file_uri = params.get("textDocument", {}).get("uri", None)
             if has_started and file_uri:
-                results = []
                 dirty_files = kwargs.pop("dirty_files", {})
-                document = self._get_document(file_uri, dirty_files)
+                document = self._get_text_document(file_uri, dirty_files)
                 trigger = params.get("context", {}).get("triggerCharacter", ".")
                 # typically the trigger is at the end of a line, so subtract one to avoid an IndexError
                 pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"]-1)
@@ -342,52 +764,33 @@ class YaraLanguageServer(LanguageServer):
                     return []
                 # split up the symbols into component parts, leaving off the last trigger character
                 symbols = symbol.split(trigger)
-                schema = self.modules
-                for depth, symbol in enumerate(symbols):
-                    # if we're at the last symbol, return completion items
-                    if depth == len(symbols) - 1:
-                        possible_terms = list(filter(lambda k: str(k).startswith(symbol), schema))
-                        for term in possible_terms:
-                            completion_items = schema.get(term, {})
-                            # if we're at the bottom of the modules list construct a dictionary
-                            # so we can treat these the same as at any other point in the schema
-                            # ... it's confusing and terrible. I'm sorry
-                            if isinstance(completion_items, str):
-                                completion_items = {term: completion_items}
-                            # some module items are dictionaries with pre-set keys, such as pe.version_info
-                            # we define these in the schema as a list of such keys
-                            if isinstance(completion_items, list):
-                                # ... and we create a snippetstring to show the user all available options
-                                # desired output: pe.version_info["CompanyName"]
-                                for label in completion_items:
-                                    snippet = "{}[\"{}\"]".format(term, label)
-                                    detail = trigger.join(symbols[:depth] + [snippet])
-                                    results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.INTERFACE, detail=detail, insertText=snippet))
-                            elif isinstance(completion_items, dict):
-                                for label, item_type in completion_items.items():
-                                    # desired output: cuckoo.filesystem.
-                                    detail = trigger.join(symbols + [label])
-                                    if str(item_type).lower() == "enum":
-                                        detail = trigger.join(symbols[:depth] + [label])
-                                        results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.ENUM, detail=detail))
-                                    elif str(item_type).lower() == "property":
-                                        detail = trigger.join(symbols[:depth] + [label])
-                                        results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.PROPERTY, detail=detail))
-                                    elif str(item_type).lower() == "function":
-                                        snippet = "{}()".format(label)
-                                        detail = trigger.join(symbols[:depth] + [snippet])
-                                        results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.FUNCTION, insertText=snippet, detail=detail))
-                                    else:
-                                        results.append(lsp.CompletionItem(label, lsp.CompletionItemKind.CLASS, detail=detail))
-                    else:
-                        schema = schema[symbol]
-                return results
+                return self._get_completions(trigger, symbols)
         except CancelledError as err:
             raise err
         except Exception as err:
             self._logger.error(err)
             raise ce.CodeCompletionError("Could not offer completion items: {}".format(err))
 
+    def _get_completions(self, trigger: str, symbols: list) -> lsp.EncodedResult:
+        '''Completion items for a partially-typed module member, serialized ahead of time.
+           The most recently used results are cached, so typing the same thing again costs a dictionary lookup
+
+        :trigger: Character between the parts of the member's name
+        :symbols: Parts of the member's name, where the last part is a prefix
+        '''
+        key = (trigger, tuple(symbols))
+        result = self._completion_cache.get(key)
+        if result is not None:
+            self._completion_cache.move_to_end(key)
+            return result
+        # the schema is only read the first time it is needed
+        items = get_schema(trigger).complete(symbols)
+        result = lsp.EncodedResult(items, self.codec.encode(items))
+        self._completion_cache[key] = result
+        if len(self._completion_cache) > self.COMPLETION_CACHE_ENTRIES:
+            self._completion_cache.popitem(last=False)
+        return result
+
     async def provide_definition(self, message: dict, has_started: bool, **kwargs) -> list:
         '''Respond to the textDocument/definition request
 
@@ -400,7 +803,7 @@ class YaraLanguageServer(LanguageServer):
             if has_started and file_uri:
                 results = []
                 dirty_files = kwargs.pop("dirty_files", {})
-                document = self._get_document(file_uri, dirty_files)
+                document = kwargs.pop("document", None) or self._get_text_document(file_uri, dirty_files)
                 # the try/except statement after this uses the 'symbol' variable in the exception block
                 # so we need to separate the code before 'symbol' is instantiated from the code after
                 # there's probably a better way to do this
@@ -410,36 +813,21 @@ class YaraLanguageServer(LanguageServer):
                 symbol = helpers.resolve_symbol(document, pos)
                 if not symbol:
                     return []
-            try:
-                # check to see if the symbol is a variable or a rule name (currently the only valid symbols)
-                if symbol[0] in self._varchar:
-                    pattern = "\\${} =\\s".format("".join(symbol[1:]))
-                    rule_range = helpers.get_rule_range(document, pos)
-                    match_lines = document.split("\n")[rule_range.start.line:rule_range.end.line+1]
-                    rel_offset = rule_range.start.line
-                    # ignore the "$" variable identifier at the beginning of the match
-                    char_start_offset = 1
-                # else assume this is a rule symbol
-                else:
-                    pattern = "\\brule {}\\b".format(symbol)
-                    match_lines = document.split("\n")
-                    rel_offset = 0
-                    # ignore the "rule " string at the beginning of the match
-                    char_start_offset = 5
-
-                for index, line in enumerate(match_lines):
-                    for match in re.finditer(pattern, line):
-                        if match:
-                            offset = rel_offset + index
-                            locrange = lsp.Range(
-                                start=lsp.Position(line=offset, char=match.start() + char_start_offset),
-                                end=lsp.Position(line=offset, char=match.end())
-                            )
-                            results.append(lsp.Location(locrange, file_uri))
-                return results
-            except re.error:
-                self._logger.debug("Error building regex pattern: %s", pattern)
-                return []
+            rule_index = get_rule_index(document)
+            # check to see if the symbol is a variable or a rule name (currently the only valid symbols)
+            if symbol[0] in self._varchar:
+                rule = rule_index.rule_at(pos.line)
+                info = rule.strings.get(symbol[1:]) if rule else None
+                if info:
+                    results.append(lsp.Location(info.definition, file_uri))
+            # else assume this is a rule symbol
+            else:
+                for rule in rule_index.definitions(symbol):
+                    results.append(lsp.Location(rule.name_range, file_uri))
+                if not results:
+                    # the rule may be declared in another file, such as one that is included
+                    results = [loc for loc in self._get_session(kwargs).definitions(symbol) if loc.uri != file_uri]
+            return results
         except CancelledError as err:
             raise err
         except Exception as err:
@@ -449,128 +837,191 @@ class YaraLanguageServer(LanguageServer):
             else:
                 raise ce.DefinitionError("Could not find symbol for definition request")
 
-    async def provide_diagnostic(self, document: str) -> list:
-        ''' Respond to the textDocument/publishDiagnostics request
+    async def provide_diagnostic(self, document: Union[str, TextDocument], file_uri: str=None, per_rule: bool=False, session: Session=None) -> Optional[list]:
+        '''Respond to the textDocument/publishDiagnostics request
+
+        Rules are compiled in a worker process, so the event loop keeps serving other requests.
+        Returns None if a newer compile of the same file superseded this one
 
-        :document: Contents of YARA rule file
+        :document: Contents of YARA rule file, either as text or a TextDocument
+        :file_uri: (Optional) URI of the document. Starting a new compile for a URI cancels any older one from the same client
+        :per_rule: (Optional) compile each rule on its own, in parallel, to report every broken rule instead of just the first
+        :session: (Optional) session of the client that asked for the diagnostics
         '''
-        diagnostics = []
-        if self._is_module_installed("yara"):
-            # weird way to get around Python compiler that thinks yara is not installed
-            yara = importlib.import_module('yara')
-            try:
-                yara.compile(source=document)
-            except yara.SyntaxError as error:
-                line_no, msg = helpers.parse_result(str(error))
-                # VSCode is zero-indexed
-                line_no -= 1
-                first_char = helpers.get_first_non_whitespace_index(document.split("\n")[line_no])
-                symbol_range = lsp.Range(
-                    start=lsp.Position(line_no, first_char),
-                    end=lsp.Position(line_no, self.MAX_LINE)
-                )
-                diagnostics.append(
-                    lsp.Diagnostic(
-                        locrange=symbol_range,
-                        severity=lsp.DiagnosticSeverity.ERROR,
-                        message=msg
-                    )
-                )
-            except yara.WarningError as warning:
-                line_no, msg = helpers.parse_result(str(warning))
-                # VSCode is zero-indexed
-                line_no -= 1
-                first_char = helpers.get_first_non_whitespace_index(document.split("\n")[line_no])
-                symbol_range = lsp.Range(
-                    start=lsp.Position(line_no, first_char),
-                    end=lsp.Position(line_no, self.MAX_LINE)
-                )
-                diagnostics.append(
-                    lsp.Diagnostic(
-                        locrange=symbol_range,
-                        severity=lsp.DiagnosticSeverity.WARNING,
-                        message=msg
-                    )
-                )
-            except CancelledError as err:
-                raise err
-            except Exception as err:
-                self._logger.error(err)
-                raise ce.DiagnosticError("Could not compile rule: {}".format(err))
-        else:
+        if not self._is_module_installed("yara"):
             raise ce.NoDependencyFound("yara-python is not installed. Diagnostics and Compile commands are disabled")
-        return diagnostics
+        compiles = (session or self.session).compiles
+        stale = compiles.pop(file_uri, None) if file_uri else None
+        if stale is not None:
+            self._logger.debug("Cancelling stale compile of %s", file_uri)
+            stale.cancel()
+        key = self.diagnostic_cache.key(str(document), mode="rules" if per_rule else "")
+        diagnostics = self.diagnostic_cache.get(key)
+        if diagnostics is not None:
+            return diagnostics
+        workers = self.COMPILE_WORKERS or os.cpu_count() or 1
+        if per_rule:
+            document = helpers.to_document(document, file_uri or "")
+            chunks = compiler.split_rules(document)
+            duplicates = compiler.find_duplicate_rules(document)
+            # spread the rules over every worker
+            batches = [chunks[index::workers] for index in range(workers)]
+            jobs = [self._run_compile(workers, compiler.compile_chunks, batch) for batch in batches if batch]
+        else:
+            jobs = [self._run_compile(workers, compiler.compile_source, str(document))]
+        jobs = [asyncio.ensure_future(job) for job in jobs]
+        future = asyncio.gather(*jobs)
+        if file_uri:
+            compiles[file_uri] = future
+        try:
+            results = await future
+            if per_rule:
+                results = sorted(duplicates + [result for batch in results for result in batch], key=lambda result: result[1])
+            else:
+                results = results[0]
+            diagnostics = compiler.to_diagnostics(results, self.MAX_LINE)
+            self.diagnostic_cache.put(key, diagnostics)
+            return diagnostics
+        except CancelledError as err:
+            if file_uri and compiles.get(file_uri) is not future:
+                # a newer version of the document is being compiled instead
+                return None
+            raise err
+        except AsyncTimeoutError:
+            self._logger.warning("Compiling %s took longer than %s seconds", file_uri or "rules", self.COMPILE_TIMEOUT)
+            raise ce.DiagnosticError("Could not compile rule: timed out after {} seconds".format(self.COMPILE_TIMEOUT))
+        except Exception as err:
+            self._logger.error(err)
+            raise ce.DiagnosticError("Could not compile rule: {}".format(err))
+        finally:
+            # stop the rest of the rules once one of them fails
+            for job in jobs:
+                job.cancel()
+            if file_uri and compiles.get(file_uri) is future:
+                del compiles[file_uri]
 
-    async def provide_formatting(self, message: dict, has_started: bool, **kwargs) -> list:
-        '''Respond to the textDocument/formatting request
+    async def _format_chunks(self, chunks: list, config: dict) -> list:
+        '''Format chunks in the formatter processes, unless they are cached
+
+        Returns the formatted rules for each chunk, or None for chunks that were not formatted in time.
+        The timeout grows with the number of lines to parse, and jobs still waiting when it runs out are cancelled
+
+        :chunks: Chunks from formatter.split_chunks() to format
+        :config: Client configuration, with the number of workers and the timeout in milliseconds
+        '''
+        results = [self.format_cache.get(text) for _, text in chunks]
+        runs = formatter.group_chunks([(index, chunk) for index, chunk in enumerate(chunks) if results[index] is None], self.FORMAT_BATCH_LINES)
+        if not runs:
+            return results
+        loop = asyncio.get_event_loop()
+        pool = self._get_format_pool(config.get("format_workers"))
+        # job => [(index, chunk)] for every run of chunks being formatted
+        jobs = {loop.run_in_executor(pool, formatter.format_run, [chunk for _, chunk in run]): run for run in runs}
+        timeout = config.get("format_timeout")
+        timeout = self.FORMAT_TIMEOUT if timeout is None else float(timeout) / 1000
+        timeout += self.FORMAT_TIMEOUT_PER_LINE * sum(text.count("\n") + 1 for run in runs for _, (_, text) in run)
+        try:
+            done, pending = await asyncio.wait(jobs, timeout=timeout)
+        finally:
+            # jobs that have not started are dropped when the request is cancelled or times out
+            for job in jobs:
+                job.cancel()
+        if pending:
+            self._logger.warning("Formatting took longer than %.1f seconds. Only formatting %d of %d rule chunks", timeout, len(chunks) - sum(len(jobs[job]) for job in pending), len(chunks))
+        error = None
+        for job in done:
+            if job.exception() is not None:
+                error = error or job.exception()
+                continue
+            for (index, (_, text)), rules in zip(jobs[job], job.result()):
+                self.format_cache.put(text, rules)
+                results[index] = rules
+        # rules that were parsed are still cached, even if others could not be
+        if error is not None:
+            raise error
+        return results
+
+    async def _format_rules(self, document: TextDocument, chunks: list, options: dict, config: dict) -> list:
+        '''Format the rules in some chunks of a document
+
+        Returns a text edit for each rule whose formatted text differs from the document
+
+        :document: Document the chunks are from
+        :chunks: Chunks from formatter.split_chunks() to format
+        :options: FormattingOptions sent by the client
+        :config: Client configuration
+        '''
+        # extra check in case "options" key exists but is not a dictionary
+        if not isinstance(options, dict):
+            options = {}
+        tab_size = options.get("tabSize", 4)                            # Size of a tab in spaces
+        insert_spaces = options.get("insertSpaces", True)               # Prefer spaces over tabs
+        trim_whitespaces = options.get("trimTrailingWhitespace", True)  # Trim trailing whitespace on a line
+        insert_newline = options.get("insertFinalNewline", False)       # Insert a newline character at the end of the file if one does not exist
+        trim_newlines = options.get("trimFinalNewlines", True)          # Trim all newlines after the final newline at the end of the file
+        # post-process - re-add whitespace if desired
+        if not trim_whitespaces:
+            self._logger.warning("The YARA language server does not currently support keeping whitespaces during formatting")
+        num_newlines = 0
+        if not trim_newlines and str(document).endswith("\n"):
+            # in order to add blank newlines, another newline must be present on the last line
+            num_newlines = 1 + len(list(filter(lambda x: x == "", str(document).splitlines())))
+            self._logger.debug("Keeping %d newlines at end of rule", num_newlines)
+        edits = []
+        # easy mode: rules are rebuilt with plyara, unless their chunk is unchanged since it was last formatted
+        for (first_line, _), rules in zip(chunks, await self._format_chunks(chunks, config)):
+            # rules that could not be formatted in time are left as they are
+            for start_line, stop_line, rule_name, formatted_text in rules or []:
+                self._logger.debug("Received formatting request for '%s'", rule_name)
+                start_line += first_line
+                stop_line += first_line
+                # post-process - insert spaces instead of tabs
+                # ... by default, plyara uses tabs
+                if insert_spaces:
+                    formatted_text = formatted_text.expandtabs(tab_size)
+                # post-process - port newlines from raw document into formatted rule
+                if num_newlines:
+                    formatted_text += "\n"*num_newlines
+                # post-process - add a newline if desired (only applies if we are not also preserving newlines)
+                elif insert_newline:
+                    formatted_text += "\n"
+                # rules that are already formatted are left alone
+                if formatted_text == "\n".join(document.get_lines(start_line, stop_line)):
+                    continue
+                document_range = lsp.Range(
+                    start=lsp.Position(line=start_line, char=0),
+                    end=lsp.Position(line=stop_line, char=self.MAX_LINE)
+                )
+                edits.append(lsp.TextEdit(document_range, formatted_text))
+        return edits
+
+    async def _format_document(self, message: dict, has_started: bool, get_chunks, notify: bool=True, **kwargs) -> list:
+        '''Format some or all of the rules in the document a formatting request is for
 
         Returns a (possibly empty) list of text edits for the client to make
+
+        :get_chunks: Function taking the document and request parameters, and returning the chunks to format
+        :notify: (Optional) show the user a message if the rules could not be parsed
         '''
         edits = []
         if self._is_module_installed("plyara"):
             try:
-                plyara = importlib.import_module('plyara')
-                plyara_utils = importlib.import_module('plyara.utils', package='plyara')
                 params = message.get("params", {})
                 file_uri = params.get("textDocument", {}).get("uri", None)
                 if has_started and file_uri:
                     dirty_files = kwargs.pop("dirty_files", {})
-                    document = self._get_document(file_uri, dirty_files)
-                    # parse options
-                    options = params.get("options", {})
-                    # extra check in case "options" key exists but is not a dictionary
-                    if not isinstance(options, dict):
-                        options = {}
-                    tab_size = options.get("tabSize", 4)                            # Size of a tab in spaces
-                    insert_spaces = options.get("insertSpaces", True)               # Prefer spaces over tabs
-                    trim_whitespaces = options.get("trimTrailingWhitespace", True)  # Trim trailing whitespace on a line
-                    insert_newline = options.get("insertFinalNewline", False)       # Insert a newline character at the end of the file if one does not exist
-                    trim_newlines = options.get("trimFinalNewlines", True)          # Trim all newlines after the final newline at the end of the file
-                    parser = plyara.Plyara(store_raw_sections=True)
-                    contents = parser.parse_string(document)
+                    config = kwargs.pop("config", {})
+                    document = self._get_text_document(file_uri, dirty_files)
                     # plyara parses out each rule individually from the document
-                    for rule in contents:
-                        self._logger.debug("Received formatting request for '%s'", rule["rule_name"])
-                        if rule.get("imports"):
-                            del rule["imports"]
-                        # easy mode: rebuild rules with plyara too and post-process based on format options
-                        formatted_text = plyara_utils.rebuild_yara_rule(rule)
-                        # by default plyara appends a newline - remove it here and post-process later
-                        formatted_text = formatted_text.rstrip("\n")
-                        # post-process - insert spaces instead of tabs
-                        # ... by default, plyara uses tabs
-                        if insert_spaces:
-                            formatted_text = formatted_text.expandtabs(tab_size)
-                        # post-process - re-add whitespace if desired
-                        if not trim_whitespaces:
-                            self._logger.warning("The YARA language server does not currently support keeping whitespaces during formatting")
-                            # extra_spaces = filter(lambda x: x.endswith(" "), document.splitlines())
-                            # for line in extra_spaces:
-                            #     self._logger.debug("Supposed to keep whitespaces for %r", line)
-                        # post-process - port newlines from raw document into formatted rule
-                        if not trim_newlines and document.endswith("\n"):
-                            # in order to add blank newlines, another newline must be present on the last line
-                            num_newlines = 1 + len(list(filter(lambda x: x == "", document.splitlines())))
-                            self._logger.debug("Keeping %d newlines at end of rule", num_newlines)
-                            formatted_text += "\n"*num_newlines
-                        # post-process - add a newline if desired (only applies if we are not also preserving newlines)
-                        elif insert_newline:
-                            formatted_text += "\n"
-                       # vscode uses 0-based indices for lines, while plyara uses 1-based indices
-                       # ... so we need to subtract one from each line for the range
-                        document_range = lsp.Range(
-                            start=lsp.Position(line=rule["start_line"]-1, char=0),
-                            end=lsp.Position(line=rule["stop_line"]-1, char=self.MAX_LINE)
-                        )
-                        edits.append(lsp.TextEdit(document_range, formatted_text))
+                    edits = await self._format_rules(document, get_chunks(document, params), params.get("options", {}), config)
             except CancelledError as err:
                 raise err
-            except plyara.exceptions.ParseTypeError as err:
-                writer = kwargs.pop("writer")
+            except ce.FormatParseError as err:
+                writer = kwargs.pop("writer", None)
                 msg = "Could not format {} due to parsing error: {}".format(file_uri, err)
                 self._logger.warning(msg)
                 # notify user
-                if writer is not None:
+                if notify and writer is not None:
                     params = {"type": lsp.MessageType.ERROR, "message": msg}
                     await self.send_notification("window/showMessage", params, writer)
             except Exception as err:
@@ -580,6 +1031,36 @@ class YaraLanguageServer(LanguageServer):
             raise ce.NoDependencyFound("plyara is not installed. Formatting is disabled")
         return edits
 
+    async def provide_formatting(self, message: dict, has_started: bool, **kwargs) -> list:
+        '''Respond to the textDocument/formatting request
+
+        Returns a (possibly empty) list of text edits for the client to make
+        '''
+        return await self._format_document(message, has_started, lambda document, params: formatter.split_chunks(document), **kwargs)
+
+    async def provide_range_formatting(self, message: dict, has_started: bool, **kwargs) -> list:
+        '''Respond to the textDocument/rangeFormatting request
+
+        Only the rules overlapping the range are parsed and formatted, in full
+        '''
+        def _get_chunks(document: TextDocument, params: dict) -> list:
+            locrange = params.get("range", {})
+            start_line = locrange.get("start", {}).get("line", 0)
+            end_line = locrange.get("end", {}).get("line", start_line)
+            return formatter.split_chunks(document, start_line, end_line)
+        return await self._format_document(message, has_started, _get_chunks, **kwargs)
+
+    async def provide_on_type_formatting(self, message: dict, has_started: bool, **kwargs) -> list:
+        '''Respond to the textDocument/onTypeFormatting request
+
+        Formats the rule the user is typing in once they close one of its braces.
+        Rules are often incomplete while being typed, so parsing errors are not shown to the user
+        '''
+        def _get_chunks(document: TextDocument, params: dict) -> list:
+            line = params.get("position", {}).get("line", 0)
+            return formatter.split_chunks(document, line, line)
+        return await self._format_document(message, has_started, _get_chunks, notify=False, **kwargs)
+
     async def provide_highlight(self, message: dict, has_started: bool, **kwargs) -> list:
         ''' Respond to the textDocument/documentHighlight request '''
         # pylint: disable=W0613
@@ -604,12 +1085,16 @@ class YaraLanguageServer(LanguageServer):
             file_uri = params.get("textDocument", {}).get("uri", None)
             if has_started and file_uri:
                 dirty_files = kwargs.pop("dirty_files", {})
-                document = self._get_document(file_uri, dirty_files)
-                definitions = await self.provide_definition(message, has_started, dirty_files=dirty_files)
+                document = self._get_text_document(file_uri, dirty_files)
+                definitions = await self.provide_definition(
+                    message, has_started, dirty_files=dirty_files, document=document, session=self._get_session(kwargs)
+                )
+                # the line is read from this document, so skip rules declared in other workspace files
+                definitions = [definition for definition in definitions if definition.uri == file_uri]
                 if len(definitions) > 0:
                     # only care about the first definition; although there shouldn't be more
                     definition = definitions[0]
-                    line = document.split("\n")[definition.range.start.line]
+                    line = document.get_line(definition.range.start.line)
                     try:
                         words = line.split(" = ")
                         if len(words) > 1:
@@ -636,7 +1121,7 @@ class YaraLanguageServer(LanguageServer):
             if has_started and file_uri:
                 results = []
                 dirty_files = kwargs.pop("dirty_files", {})
-                document = self._get_document(file_uri, dirty_files)
+                document = kwargs.pop("document", None) or self._get_text_document(file_uri, dirty_files)
                 pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"])
                 symbol = helpers.resolve_symbol(document, pos)
                 if not symbol:
@@ -646,44 +1131,46 @@ class YaraLanguageServer(LanguageServer):
                 # will appear to the user if YARA can't compile it, so I won't worry too much
                 wildcard_found = ("*" in symbol)
                 if wildcard_found:
-                    # remove parentheses and replace the YARA wildcard with a Python re equivalent
-                    symbol = symbol.replace("*", ".*?").strip("()")
+                    # remove parentheses, such as in "any of ($a*)". The wildcard is translated by symbol_pattern()
+                    symbol = symbol.strip("()")
                 # check to see if the symbol is a variable or a rule name (currently the only valid symbols)
                 if symbol[0] in self._varchar:
-                    # any possible first character matching self._varchar must be treated as a reference
-                    pattern = "[{}]{}\\b".format("".join(self._varchar), "".join(symbol[1:]))
-                    rule_range = helpers.get_rule_range(document, pos)
-                    rule_lines = document.split("\n")[rule_range.start.line:rule_range.end.line+1]
-                    rel_offset = rule_range.start.line
-                    char_start_offset = 1
+                    rule = get_rule_index(document).rule_at(pos.line)
+                    if rule is None:
+                        return []
+                    strings = rule.strings
                     if wildcard_found:
-                        # only search strings section if this is a wildcard variable
-                        # figure out the bounds of the strings section
-                        strings_start = [idx for idx, line in enumerate(rule_lines) if "strings:" in line][0]
-                        strings_end = [idx for idx, line in enumerate(rule_lines) if "condition:" in line][0]
-                        rule_lines = rule_lines[strings_start:strings_end]
-                        rel_offset += strings_start
-                else:
-                    rel_offset = 0
-                    pattern = "{}\\b".format(symbol)
-                    rule_lines = document.split("\n")
-                    char_start_offset = 0
-
-                for index, line in enumerate(rule_lines):
-                    for match in re.finditer(pattern, line):
-                        if match:
-                            # index corresponds to line no. within each rule, not within file
-                            offset = rel_offset + index
-                            locrange = lsp.Range(
-                                start=lsp.Position(line=offset, char=match.start() + char_start_offset),
-                                end=lsp.Position(line=offset, char=match.end())
-                            )
-                            results.append(lsp.Location(locrange, file_uri))
+                        # only the string definitions can match a wildcard variable
+                        pattern = helpers.symbol_pattern("string", symbol[1:])
+                        matched = [info for name, info in strings.items() if pattern.fullmatch(name)]
+                        locranges = [info.name_range for info in matched]
+                    elif symbol[1:] in strings:
+                        info = strings[symbol[1:]]
+                        locranges = [info.name_range] + info.uses
+                    else:
+                        locranges = []
+                    locranges.sort(key=lambda locrange: (locrange.start.line, locrange.start.char))
+                    return [lsp.Location(locrange, file_uri) for locrange in locranges]
+                if not wildcard_found:
+                    # every identifier in each rule was recorded when the rule was scanned
+                    return [lsp.Location(locrange, file_uri) for locrange in get_rule_index(document).references(symbol)]
+                # search the whole document at once, and use its table of line offsets to find each match's line
+                pattern = helpers.symbol_pattern("rule", symbol)
+                line_starts = document.line_starts
+                for match in pattern.finditer(document.text):
+                    line = bisect_right(line_starts, match.start()) - 1
+                    char = match.start() - line_starts[line]
+                    # symbols never span more than one line
+                    locrange = lsp.Range(
+                        start=lsp.Position(line=line, char=char),
+                        end=lsp.Position(line=line, char=char + match.end() - match.start())
+                    )
+                    results.append(lsp.Location(locrange, file_uri))
                 return results
         except CancelledError as err:
             raise err
         except re.error:
-            self._logger.debug("Error building regex pattern: %s", pattern)
+            self._logger.debug("Error building regex pattern for symbol: %s", symbol)
             return []
         except Exception as err:
             self._logger.error(err)
@@ -696,7 +1183,7 @@ class YaraLanguageServer(LanguageServer):
             file_uri = params.get("textDocument", {}).get("uri", None)
             if has_started and file_uri:
                 dirty_files = kwargs.pop("dirty_files", {})
-                document = self._get_document(file_uri, dirty_files)
+                document = self._get_text_document(file_uri, dirty_files)
                 results = lsp.WorkspaceEdit(file_uri=file_uri, changes=[])
                 pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"])
                 old_text = helpers.resolve_symbol(document, pos)
@@ -707,9 +1194,13 @@ class YaraLanguageServer(LanguageServer):
                     self._logger.warning("New rename symbol is the same as the old. Skipping")
                 elif old_text.endswith("*"):
                     self._logger.warning("Cannot rename wildcard symbols. Skipping")
+                elif old_text[0] not in self._varchar and not get_rule_index(document).definitions(old_text) \
+                        and self._get_session(kwargs).definitions(old_text):
+                    # references are only found in this document, so the other file would keep the old name
+                    raise ce.RenameError("Cannot rename rule '{}' declared in another file".format(old_text))
                 # let provide_reference() determine symbol or rule
                 # and therefore what scope to look into
-                refs = await self.provide_reference(message, has_started, dirty_files=dirty_files)
+                refs = await self.provide_reference(message, has_started, dirty_files=dirty_files, document=document)
                 for ref in refs:
                     new_range = lsp.Range(
                         lsp.Position(ref.range.start.line, ref.range.start.char),
@@ -719,7 +1210,7 @@ class YaraLanguageServer(LanguageServer):
                 if len(results.changes) <= 0:
                     self._logger.warning("No symbol references found to rename. Skipping")
                 return results
-        except CancelledError as err:
+        except (CancelledError, ce.RenameError) as err:
             raise err
         except Exception as err:
             self._logger.error(err)